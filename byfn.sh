@@ -50,6 +50,7 @@ function printHelp () {
   echo "    -V <chaincode version>  - chaincode version to use for \"install\""
   echo "    -P <chaincode path>     - chaincode path to use for \"install\" (relative to chaincode/)"
   echo "    -t <timeout>            - CLI timeout duration in microseconds (defaults to 10000)"
+  echo "    -S <steps>              - comma separated steps done by network.py (e.g. \"certs,e2e,artifacts,join\")"
   echo
   echo "Typically, one would first generate the required certificates and "
   echo "genesis block, then bring up the network. e.g.:"
@@ -97,6 +98,17 @@ function askProceed () {
   done
 }
 
+# Return success if the named step was handed off to network.py with -S
+function skipStep () {
+  case ",${SKIP_STEPS}," in
+    *",$1,"*)
+      echo "skipping step '$1' (done by network.py)"
+      return 0
+    ;;
+  esac
+  return 1
+}
+
 # Obtain CONTAINER_IDS and remove them
 # TODO Might want to make this optional - could clear other containers
 function clearContainers () {
@@ -126,11 +138,43 @@ BLACKLISTED_VERSIONS="^1\.0\. ^1\.1\.0-preview ^1\.1\.0-alpha"
 # Do some basic sanity checking to make sure that the appropriate versions of fabric
 # binaries/images are available.  In the future, additional checking for the presence
 # of go or other items could be added.
-function checkPrereqs() {
+# Probed toolchain versions live here, one file per (configtxlator path and
+# mtime, fabric-tools image ID), so a probe is only repeated when either changes.
+TOOLCHAIN_CACHE_DIR="${FNB_CACHE_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/fabric-network-builder}/toolchain"
+
+function toolchainKey() {
+  local bin image_id
+  bin=$(command -v configtxlator) || return 1
+  image_id=$(docker image inspect --format '{{.Id}}' $IMAGENS/fabric-tools:$IMAGETAG 2>/dev/null) || return 1
+  printf '%s %s %s\n' "$bin" "$(stat -c %Y "$bin")" "$image_id" | sha256sum | cut -d' ' -f1
+}
+
+# Set LOCAL_VERSION and DOCKER_IMAGE_VERSION, from the cache when it is valid.
+function probeToolchain() {
+  local key cache
+  key=$(toolchainKey)
+  cache="$TOOLCHAIN_CACHE_DIR/$key"
+  if [ -n "$key" ] && [ -f "$cache" ]; then
+    { read -r LOCAL_VERSION; read -r DOCKER_IMAGE_VERSION; } <"$cache"
+    echo "Using cached toolchain versions ($cache)"
+    return
+  fi
   # Note, we check configtxlator externally because it does not require a config file, and peer in the
   # docker image because of FAB-8551 that makes configtxlator return 'development version' in docker
   LOCAL_VERSION=$(configtxlator version | sed -ne 's/ Version: //p')
   DOCKER_IMAGE_VERSION=$(docker run --rm $IMAGENS/fabric-tools:$IMAGETAG peer version | sed -ne 's/ Version: //p'|head -1)
+  if [ -z "$LOCAL_VERSION" ] || [ -z "$DOCKER_IMAGE_VERSION" ]; then
+    return
+  fi
+  # docker run may have just pulled the image, so key on its ID now
+  key=$(toolchainKey) || return
+  cache="$TOOLCHAIN_CACHE_DIR/$key"
+  mkdir -p "$TOOLCHAIN_CACHE_DIR" 2>/dev/null || return
+  printf '%s\n%s\n' "$LOCAL_VERSION" "$DOCKER_IMAGE_VERSION" >"$cache.$$" && mv "$cache.$$" "$cache"
+}
+
+function checkPrereqs() {
+  probeToolchain
 
   echo "LOCAL_VERSION=$LOCAL_VERSION"
   echo "DOCKER_IMAGE_VERSION=$DOCKER_IMAGE_VERSION"
@@ -561,9 +605,10 @@ CHAINCODE_LANG=golang
 
 DOMAIN_NAME=example.com
 ORG_COUNT=2
+SKIP_STEPS=""
 
 # Parse commandline args
-while getopts "h?fixm:s:c:t:C:K:V:W:P:d:n:l:" opt; do
+while getopts "h?fixm:s:c:t:C:K:V:W:P:d:n:l:S:" opt; do
   case "$opt" in
     h|\?)
       printHelp
@@ -599,6 +644,8 @@ while getopts "h?fixm:s:c:t:C:K:V:W:P:d:n:l:" opt; do
     ;;
     n)  ORG_COUNT=$OPTARG
     ;;
+    S)  SKIP_STEPS=$OPTARG
+    ;;
   esac
 done
 
@@ -637,7 +684,7 @@ askProceed
 if [ "${MODE}" == "up" ]; then
   networkUp
   createChannel
-  joinChannel
+  skipStep join || joinChannel
 elif [ "${MODE}" == "install" ]; then
   installChaincode
 elif [ "${MODE}" == "generatecc" ]; then
@@ -646,13 +693,13 @@ elif [ "${MODE}" == "down" ]; then ## Clear the network
   networkDown
 elif [ "${MODE}" == "generate" ]; then ## Generate Artifacts
   checkPrereqs
-  generateCerts
-  replacePrivateKey
-  generateChannelArtifacts
+  skipStep certs || generateCerts
+  skipStep e2e || replacePrivateKey
+  skipStep artifacts || generateChannelArtifacts
 elif [ "${MODE}" == "extend" ]; then ## Extend Artifacts
   checkPrereqs
-  extendCerts
-  replacePrivateKey
+  skipStep certs || extendCerts
+  skipStep e2e || replacePrivateKey
 elif [ "${MODE}" == "restart" ]; then ## Restart the network
   networkDown
   networkUp
@@ -5,27 +5,49 @@ network.  This script wraps byfn.sh and aims to replace it with improved functio
 networks with custom network topologies.
 '''
 
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from itertools import groupby
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from tempfile import TemporaryDirectory
 import argparse
+import contextlib
+import csv
+import functools
+import grp
+import gzip
 import hashlib
+import io
+import ipaddress
 import json
+import lzma
 import os
 import os.path
+import posixpath
+import pwd
+import random
+import re
 import shlex
 import shutil
+import stat
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 
-from jinja2 import Template
-from OpenSSL.crypto import load_certificate, FILETYPE_PEM
+import yaml
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ed25519, ed448
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, ed448
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
 
 class Network(object):
 
@@ -37,6 +59,7 @@ class Network(object):
         self.channel = 'luther'
         self.destination_path = '.'
         self.force = False
+        self.incremental = False
         self.storage = None
         self.log_spec = None
         self.domain_name = 'example.com'
@@ -49,6 +72,7 @@ class Network(object):
         self.sidedb_structure = 'shared'
         self.execute_timeout = 30
         self.compose_project_name = os.environ.get('COMPOSE_PROJECT_NAME', 'fnb')
+        self._rendered_changes = []
 
     def generate(self, args):
         if args.archive_path is not None:
@@ -62,13 +86,44 @@ class Network(object):
         if args.template is not False:
             self._render_template(args)
         # run cryptogen unless --template prevents it.
-        if not args.template:
+        if not args.template and self.incremental and \
+                os.path.isdir(os.path.join(self.destination_path, 'crypto-config')):
+            self._regenerate_stale(args)
+        elif not args.template:
             byfn_cmd = self._byfn_cmd('generate')
+            skip = ['e2e', 'artifacts']
+            if args.crypto_backend == 'python':
+                self._generate_crypto(replace=True)
+                skip.append('certs')
+            append_opt(byfn_cmd, '-S', ','.join(skip))
             run((byfn_cmd + [ '-d', args.domain_name, '-n', str(args.org_count) ]), chdir=self.destination_path)
-            if self.chown is not None:
-                cmd = ['chown', '-R', self.chown]
-                cmd.extend(self._crypto_gen_assets())
-                run(cmd, chdir=self.destination_path)
+            render_e2e_compose(self.destination_path, args.domain_name)
+            self._generate_channel_artifacts(args)
+            record_generated_inputs(self.destination_path, GENERATED_INPUTS)
+            self._chown_tree_maybe(*self._crypto_gen_assets())
+
+    def _regenerate_stale(self, args):
+        '''
+        --incremental over an existing crypto-config tree: extend the crypto
+        material when crypto-config.yaml changed since it was generated, and
+        regenerate the channel artifacts when it or configtx.yaml did.
+        '''
+        stale = stale_generated_inputs(self.destination_path, GENERATED_INPUTS,
+                                       self._rendered_changes)
+        if 'crypto-config.yaml' in stale:
+            print('crypto-config.yaml changed; extending crypto material (--incremental)')
+            self._extend_crypto(args)
+        else:
+            print('crypto-config exists; skipping crypto generation (--incremental)')
+        render_e2e_compose(self.destination_path, args.domain_name)
+        if stale:
+            print('{} changed; regenerating channel artifacts (--incremental)'.format(
+                ' and '.join(stale)))
+            self._generate_channel_artifacts(args)
+            record_generated_inputs(self.destination_path, GENERATED_INPUTS)
+            self._chown_tree_maybe(*self._crypto_gen_assets())
+        else:
+            self._chown_maybe(os.path.join(self.destination_path, 'docker-compose-e2e.yaml'))
 
     def _generate_archive(self, args):
         if args.template is not None:
@@ -80,31 +135,40 @@ class Network(object):
                 self._generate(args)
             finally:
                 self.destination_path = orig_destination_path
-            cmd = ["tar", "-cJf", 'archive.tar.xz']
-            cmd.extend(self._archive_filenames())
-            run(cmd, chdir=d)
-            mv = ['mv', os.path.join(d, 'archive.tar.xz'), args.archive_path]
-            run(mv, chdir=self.destination_path)
-            if self.chown is not None:
-                cmd = ['chown', '-R', self.chown]
-                cmd.append(args.archive_path)
-                run(cmd, chdir=self.destination_path)
+            self._write_archive(args, d)
 
     def extend(self, args):
+        if args.delta_from and args.archive_path is None:
+            raise SystemExit('--delta-from requires --archive')
         if args.archive_path is not None:
             self._extend_archive(args)
         else:
             self._extend(args)
 
     def _extend(self, args):
+        self._extend_crypto(args)
+        render_e2e_compose(self.destination_path, args.domain_name)
+        self._chown_tree_maybe(*self._crypto_gen_assets())
+
+    def _extend_crypto(self, args):
         byfn_cmd = self._byfn_cmd('extend') + [ '-d', args.domain_name ]
+        skip = ['e2e']
+        if args.crypto_backend == 'python':
+            if not os.path.isdir(os.path.join(self.destination_path, 'crypto-config')):
+                raise SystemExit('crypto-config certificate tree does not exist')
+            self._generate_crypto()
+            skip.append('certs')
+        append_opt(byfn_cmd, '-S', ','.join(skip))
         run((byfn_cmd), chdir=self.destination_path)
-        if self.chown is not None:
-            cmd = ['chown', '-R', self.chown]
-            cmd.extend(self._crypto_gen_assets())
-            run(cmd, chdir=self.destination_path)
 
     def _extend_archive(self, args):
+        if args.delta_from:
+            # A delta is relative to the tree the previous archive came from,
+            # so extend that tree in place.
+            self._extend(args)
+            self._write_archive(args, self.destination_path,
+                                read_archive_manifest(args.delta_from))
+            return
         with TemporaryDirectory(prefix='fabric-network', dir=self.destination_path) as d:
             orig_destination_path = self.destination_path
             self.destination_path = d
@@ -112,23 +176,77 @@ class Network(object):
                 self._extend(args)
             finally:
                 self.destination_path = orig_destination_path
-            cmd = ["tar", "-cJf", 'archive.tar.xz']
-            cmd.extend(self._archive_filenames())
-            run(cmd, chdir=d)
-            mv = ['mv', os.path.join(d, 'archive.tar.xz'), args.archive_path]
-            run(mv, chdir=self.destination_path)
-            if self.chown is not None:
-                cmd = ['chown', '-R', self.chown]
-                cmd.append(args.archive_path)
-                run(cmd, chdir=self.destination_path)
+            self._write_archive(args, d)
+
+    def _write_archive(self, args, root, previous=None):
+        '''
+        Archive the generated files under root with a manifest of their
+        hashes; given the previous archive's manifest, only new or changed
+        files go in (a delta for apply_delta).
+        '''
+        archive_path = os.path.join(self.destination_path, args.archive_path)
+        start = time.monotonic()
+        names = self._archive_filenames()
+        manifest = {'version': ARCHIVE_MANIFEST_VERSION, 'files': tree_manifest(root, names)}
+        if previous is not None:
+            manifest = archive_delta(previous, manifest['files'])
+            names = manifest['added'] + manifest['changed']
+            print('delta: {} added, {} changed, {} removed'.format(
+                len(manifest['added']), len(manifest['changed']), len(manifest['removed'])))
+        write_archive(archive_path, root, names, args.archive_format, args.archive_level,
+                      manifest)
+        print('wrote {} archive {} ({} bytes) in {:.2f}s'.format(
+            args.archive_format, args.archive_path, os.path.getsize(archive_path),
+            time.monotonic() - start))
+        self._chown_tree_maybe(args.archive_path)
+
+    def apply_delta(self, args):
+        manifest = apply_archive_delta(args.delta_path, args.dest)
+        print('applied {}: {} added, {} changed, {} removed; all hashes verified'.format(
+            args.delta_path, len(manifest['added']), len(manifest['changed']),
+            len(manifest['removed'])))
+        self._chown_tree_maybe(args.dest)
+
+    def _generate_channel_artifacts(self, args):
+        '''
+        Generate the genesis block, channel tx and anchor peer updates with
+        concurrent configtxgen runs instead of byfn.sh's serial loop, and
+        print each artifact's time.
+        '''
+        report = LifecycleReport()
+        start = time.monotonic()
+        print('generating {} channel artifacts'.format(args.org_count + 2))
+        ok = generate_channel_artifacts(self.destination_path, self.channel, args.org_count,
+                                        report, args.artifact_parallelism)
+        print()
+        print(report.summary())
+        print('total {:.2f}s'.format(time.monotonic() - start))
+        if not ok:
+            raise SystemExit('channel artifact generation failed: {}'.format(
+                '; '.join('{}: {}'.format(r['target'], r['detail'])
+                          for r in report.failures())))
+
+    def _generate_crypto(self, replace=False):
+        '''
+        Build crypto-config/ from the rendered crypto-config.yaml in-process
+        (--crypto-backend python) instead of running cryptogen.  With replace
+        an existing tree is removed first, as byfn.sh does for generate.
+        '''
+        crypto_dir = os.path.join(self.destination_path, 'crypto-config')
+        if replace and os.path.isdir(crypto_dir):
+            shutil.rmtree(crypto_dir)
+        config_path = os.path.join(self.destination_path, 'crypto-config.yaml')
+        created = generate_crypto_material(config_path, crypto_dir)
+        print('generated crypto material for {} orgs ({} new identities) in {}'.format(
+            len(created), sum(created.values()), crypto_dir))
 
     def _archive_filenames(self):
         return ['crypto-config', 'crypto-config.yaml',
                 'configtx.yaml', 'channel-artifacts',
-                'scripts']
+                'scripts', PORT_MAP_NAME]
 
     def _check_gen_dest(self):
-        if self.force:
+        if self.force or self.incremental:
             return
 
         check_files = ['crypto-config.yaml', 'configtx.yaml', 'crypto-config', 'channel-artifacts']
@@ -143,45 +261,141 @@ class Network(object):
 
     def _chown_maybe(self, fn):
         if self.chown is not None:
-            run(['chown', self.chown, fn])
+            chown_paths([fn], self.chown)
+
+    def _chown_tree_maybe(self, *names):
+        if self.chown is not None:
+            paths = [os.path.join(self.destination_path, n) for n in names]
+            chown_paths(paths, self.chown, recursive=True)
 
     def _render_template(self, args):
-        def mkdir(name):
-            path = os.path.join(self.destination_path, name)
-            run(['mkdir', '-p', path])
-            self._chown_maybe(path)
+        batch = FileBatch(self.destination_path, incremental=self.incremental)
         dirs = ['base', 'chaincodes', 'couchdb', 'scripts']
         for basename in dirs:
-            mkdir(basename)
+            batch.mkdir(basename)
+        jinja_files = [
+            'crypto-config.yaml', 'configtx.yaml',
+            'shiroclient.yaml', 'shiroclient_fast.yaml',
+            'fabric-client.yaml', 'fabric-client_fast.yaml', 'fabric-client_template.yaml',
+            'docker-compose-e2e-template.yaml',
+            'docker-compose-cli.yaml',
+            'docker-compose-couch.yaml',
+            'base/docker-compose-base.yaml',
+            'scripts/variables.sh',
+            'collections.json',
+            'core.yaml',
+        ]
+        env = template_env(self.template_base_path)
+        context = self._render_context(args)
+        context_digest = _sha256(json.dumps(context, sort_keys=True, default=str))
+        for jinja_file in jinja_files:
+            template_file = jinja_file + '.j2'
+            source = env.loader.get_source(env, template_file)[0]
+            input_digest = _sha256(context_digest + source)
+            if batch.is_fresh(jinja_file, input_digest):
+                continue
+            print("rendering template {}".format(template_file))
+            batch.write(jinja_file, env.get_template(template_file).render(context) + "\n",
+                        input_digest)
+        # the host port map is rendered from the context alone
+        port_map_digest = _sha256(context_digest + PORT_MAP_NAME)
+        if not batch.is_fresh(PORT_MAP_NAME, port_map_digest):
+            batch.write(PORT_MAP_NAME, json.dumps(context['PORT_MAP'], indent=2) + "\n",
+                        port_map_digest)
+        nonjinja_files = [ 'base/peer-base.yaml',
+                           'couchdb/local.ini',
+                           'scripts/channel.sh',
+                           'scripts/create_channel.sh',
+                           'scripts/init.sh',
+                           'scripts/install.sh',
+                           'scripts/generatecc.sh',
+                           'scripts/env.sh',
+                           'scripts/join_channel.sh',
+                           'scripts/luther_utils.sh' ]
+        for nonjinja_file in nonjinja_files:
+            batch.copy(os.path.join(self.template_base_path, nonjinja_file), nonjinja_file)
+        executable_files = [ 'scripts/channel.sh',
+                             'scripts/create_channel.sh',
+                             'scripts/init.sh',
+                             'scripts/install.sh',
+                             'scripts/generatecc.sh',
+                             'scripts/env.sh',
+                             'scripts/join_channel.sh', ]
+        for executable_file in executable_files:
+            batch.make_executable(executable_file)
+        batch.finish(self.chown)
+        self._rendered_changes = [name for name, _, _ in batch.changed]
+        if self.incremental:
+            self._report_affected_services(batch.changed, context)
+
+    # Rendered compose files: services are compared definition by definition.
+    _COMPOSE_FILES = ('docker-compose-e2e-template.yaml',
+                      'docker-compose-cli.yaml',
+                      'docker-compose-couch.yaml',
+                      'base/docker-compose-base.yaml')
+
+    def _report_affected_services(self, changed, context):
+        '''
+        Print the docker-compose services whose effective configuration is
+        touched by the rewritten files, so only those need restarting.
+        '''
+        peers = [peer['name'] for peer in context['PEERS']]
+        couchdbs = ['couch' + p for p in peers]
+        services = set()
+        notes = []
+        for name, previous, content in changed:
+            if name in self._COMPOSE_FILES:
+                services.update(_changed_services(previous, content))
+            elif name.startswith('scripts/') or name == 'collections.json':
+                services.add('cli')
+            elif name == 'base/peer-base.yaml':
+                services.update(peers)
+            elif name == 'couchdb/local.ini':
+                services.update(couchdbs)
+            elif name in ('crypto-config.yaml', 'configtx.yaml'):
+                notes.append('{} changed; crypto material and channel artifacts '
+                             'may need regenerating'.format(name))
+        if 'docker-compose-e2e-template.yaml' in (c[0] for c in changed):
+            notes.append('docker-compose-e2e-template.yaml changed; '
+                         'docker-compose-e2e.yaml must be regenerated')
+        for note in notes:
+            print(note)
+        if services:
+            print('affected services: {}'.format(' '.join(sorted(services))))
+        else:
+            print('affected services: none')
+
+    def _render_context(self, args):
+        '''
+        Compute the variables shared by every network template.  The result is
+        built once per generate and reused for each file, so it must only hold
+        re-iterable values (lists, not zip iterators).
+        '''
         connect_domain_name = args.connect_domain_name or args.domain_name
-        def make_orderer(i):
-            return {'host': 'orderer{}.{}'.format(i, connect_domain_name),
-                    'dir': 'orderer{}.{}'.format(i, args.domain_name),
-                    'port': '7050',
-                    'server_cert_path': '',
-                    'client_cert_path': ''}
-        orderers = [make_orderer(i) for i in range(0, args.orderer_count)]
+        spec = getattr(args, 'topology', None)
+        if spec is None:
+            spec = topology_spec(args.org_count, args.peer_count, args.orderer_count)
+        elif (args.org_count != len(spec['orgs']) or args.peer_count is not None
+              or args.orderer_count is not None):
+            raise SystemExit('--org-count, --peer-count and --orderer-count cannot be '
+                             'combined with --config; its orgs and orderers set the topology')
+        flag_ranges = dict(r.partition('=')[::2] for r in getattr(args, 'port_ranges', None) or [])
+        ranges = port_ranges(spec.get('ports'), flag_ranges)
+        index = build_network_index(spec, args.domain_name, connect_domain_name, ranges)
+        orgs = index['orgs']
+        orderers = index['orderers']
         orderer_addresses = [('{}:{}').format(o['host'], o['port']) for o in orderers]
-        org_indices = list(map(str, range(1, (args.org_count + 1))))
-        ca_ports = list(map((lambda x : str((1000 * x) + 6054)), range(1, (args.org_count + 1))))
-        peer_indices = list(map(str, range(0, args.peer_count)))
-        orderer_indices = [i for i in range(0, args.orderer_count)]
-        orderer_ports = [ str(int(orderers[i]['port'])+(1000 * i)) for i in orderer_indices ]
-        # ijbp: i = index of org, j = index of peer, b = bootstrap peer, p = port prefix
-        # ijbp is used in docker-compose-base
-        ijbp = []
-        p = 70
-        for i in range(1, (args.org_count + 1)):
-            for j in range(0, args.peer_count):
-                b = '0' # TODO: analyze whether there is a benefit to setting the bootstrap peer differently
-                ijbp.append([str(i), str(j), str(b), str(p)])
-                p += 10
+        org_indices = [org['index'] for org in orgs]
+        peer_total = len(index['peers'])
+        # the union of every org's peer indices (all of them when orgs are uniform)
+        peer_indices = list(map(str, range(max(len(org['peers']) for org in orgs))))
+        orderer_indices = [o['index'] for o in orderers]
         sidedb_req_peer_count = args.req_peer_count
         if sidedb_req_peer_count == -1:
-            sidedb_req_peer_count = ((args.org_count * args.peer_count) // 2)
+            sidedb_req_peer_count = (peer_total // 2)
         sidedb_max_peer_count = args.max_peer_count
         if sidedb_max_peer_count == -1:
-            sidedb_max_peer_count = ((args.org_count * args.peer_count) - 1)
+            sidedb_max_peer_count = (peer_total - 1)
         policy_other_users = ["'Org{}MSP.member'".format(i) for i in range(2, (args.org_count + 1))]
         policy_other_users_str = ", ".join(policy_other_users)
         policy_users = ["'Org{}MSP.member'".format(i) for i in range(1, (args.org_count + 1))]
@@ -227,72 +441,29 @@ class Network(object):
         collections_json = json.dumps(collections, indent=4)
         # use --min-endorsers=-1 for automatic majority calculation
         if args.min_endorsers == -1:
-            args.min_endorsers = (((args.org_count * args.peer_count) // 2) + 1)
-        jinja_files = [
-            'crypto-config.yaml', 'configtx.yaml',
-            'shiroclient.yaml', 'shiroclient_fast.yaml',
-            'fabric-client.yaml', 'fabric-client_fast.yaml', 'fabric-client_template.yaml',
-            'docker-compose-e2e-template.yaml',
-            'docker-compose-cli.yaml',
-            'docker-compose-couch.yaml',
-            'base/docker-compose-base.yaml',
-            'scripts/variables.sh',
-            'collections.json',
-            'core.yaml',
-        ]
-        for jinja_file in jinja_files:
-            template_file = jinja_file + '.j2'
-            print("rendering template {}".format(template_file))
-            with open(os.path.join(self.template_base_path, template_file)) as src_file:
-                template = Template(src_file.read())
-            with open(os.path.join(self.destination_path, jinja_file), 'w') as dst_file:
-                dst_file.write(template.render(CC_NAME=args.cc_name,
-                                               DOMAIN_NAME=args.domain_name,
-                                               CONNECT_DOMAIN_NAME=connect_domain_name,
-                                               ENABLE_NODE_OUS=args.enable_node_ous,
-                                               ORG_COUNT=str(args.org_count),
-                                               ORG_INDICES=org_indices,
-                                               ZIP_ORG_INDICES_CA_PORTS=zip(org_indices, ca_ports),
-                                               PEER_COUNT=str(args.peer_count),
-                                               PEER_INDICES=peer_indices,
-                                               ORDERER_COUNT=str(args.orderer_count),
-                                               ORDERER_INDICES=orderer_indices,
-                                               ZIP_ORDERER_INDICES_ORDERER_PORTS=zip(orderer_indices, orderer_ports),
-                                               ORDERERORGS_TEMPLATE_COUNT=str(args.orderer_count),
-                                               ORDERERS=orderers,
-                                               ORDERER_TYPE=args.orderer_type,
-                                               ORDERER_ADDRESSES=json.dumps(orderer_addresses),
-                                               IJBP=ijbp,
-                                               ENDORSEMENT_POLICY=endorsement_policy,
-                                               COLLECTIONS_JSON=collections_json,
-                                               MIN_ENDORSERS=str(args.min_endorsers),
-                                               EXECUTE_TIMEOUT=(str(args.execute_timeout)+"s"),
-                                               ORDERER_SAN_DOMAINS=args.orderer_san_domains,
-                                               PEER_SAN_DOMAINS=args.peer_san_domains,
-                               ) + "\n")
-                self._chown_maybe(os.path.join(self.destination_path, jinja_file))
-        nonjinja_files = [ 'base/peer-base.yaml',
-                           'couchdb/local.ini',
-                           'scripts/channel.sh',
-                           'scripts/create_channel.sh',
-                           'scripts/init.sh',
-                           'scripts/install.sh',
-                           'scripts/generatecc.sh',
-                           'scripts/env.sh',
-                           'scripts/join_channel.sh',
-                           'scripts/luther_utils.sh' ]
-        for nonjinja_file in nonjinja_files:
-            run(['cp', os.path.join(self.template_base_path, nonjinja_file), os.path.join(self.destination_path, nonjinja_file)])
-            self._chown_maybe(os.path.join(self.destination_path, nonjinja_file))
-        executable_files = [ 'scripts/channel.sh',
-                             'scripts/create_channel.sh',
-                             'scripts/init.sh',
-                             'scripts/install.sh',
-                             'scripts/generatecc.sh',
-                             'scripts/env.sh',
-                             'scripts/join_channel.sh', ]
-        for executable_file in executable_files:
-            run(['chmod', '+x', os.path.join(self.destination_path, executable_file)])
+            args.min_endorsers = ((peer_total // 2) + 1)
+        return dict(CC_NAME=args.cc_name,
+                    DOMAIN_NAME=args.domain_name,
+                    CONNECT_DOMAIN_NAME=connect_domain_name,
+                    ENABLE_NODE_OUS=args.enable_node_ous,
+                    ORG_COUNT=str(len(orgs)),
+                    ORG_INDICES=org_indices,
+                    ORGS=orgs,
+                    PEERS=index['peers'],
+                    PEER_INDICES=peer_indices,
+                    ORDERER_COUNT=str(len(orderers)),
+                    ORDERER_INDICES=orderer_indices,
+                    ORDERERORGS_TEMPLATE_COUNT=str(len(orderers)),
+                    ORDERERS=orderers,
+                    ORDERER_TYPE=args.orderer_type,
+                    ORDERER_ADDRESSES=json.dumps(orderer_addresses),
+                    PORT_MAP=index['port_map'],
+                    ENDORSEMENT_POLICY=endorsement_policy,
+                    COLLECTIONS_JSON=collections_json,
+                    MIN_ENDORSERS=str(args.min_endorsers),
+                    EXECUTE_TIMEOUT=(str(args.execute_timeout)+"s"),
+                    ORDERER_SAN_DOMAINS=args.orderer_san_domains,
+                    PEER_SAN_DOMAINS=args.peer_san_domains)
 
     def _crypto_gen_assets(self):
         return ['crypto-config', 'channel-artifacts', 'docker-compose-e2e.yaml']
@@ -302,7 +473,32 @@ class Network(object):
         append_opt(byfn_cmd, '-V', args.cc_version)
         if args.log_spec:
             append_opt(byfn_cmd, '-l', args.log_spec)
+        if not args.sequential:
+            append_opt(byfn_cmd, '-S', 'join')
         run(byfn_cmd, chdir=self.destination_path, setenv=self._compose_setenv())
+        if not args.sequential:
+            self._join_parallel(args)
+
+    def _join_parallel(self, args):
+        '''
+        Join every peer to the channel concurrently (bounded by --parallelism),
+        each retrying on its own jittered backoff, then update every org's
+        anchor peer.  All failures are reported together.
+        '''
+        cli = FabricCLI(load_script_vars(
+            os.path.join(self.destination_path, 'scripts', 'variables.sh')))
+        report = LifecycleReport()
+        start = time.monotonic()
+        print('joining {} peers to channel {}'.format(len(cli.all_peers()), self.channel))
+        if join_channel(cli, report, self.channel, args.parallelism, args.join_deadline):
+            update_anchor_peers(cli, report, self.channel, args.parallelism)
+        print()
+        print(report.summary())
+        print('total {:.2f}s'.format(time.monotonic() - start))
+        failures = report.failures()
+        if failures:
+            raise SystemExit('{} peer(s) failed to join channel {}: {}'.format(
+                len(failures), self.channel, '; '.join(r['detail'] for r in failures)))
 
     def install(self, args):
         '''
@@ -314,6 +510,9 @@ class Network(object):
             cc_variants: string
             cc_path: string
         '''
+        if not args.sequential:
+            self._install_parallel(args)
+            return
         byfn_cmd = self._byfn_cmd('install')
         append_opt(byfn_cmd, '-C', args.cc_name)
         append_opt(byfn_cmd, '-K', args.cc_pkg_name)
@@ -324,6 +523,34 @@ class Network(object):
             byfn_cmd.append('-i')
         run(byfn_cmd, chdir=self.destination_path, setenv=self._compose_setenv())
 
+    def _install_parallel(self, args):
+        '''
+        Drive the chaincode lifecycle from here instead of scripts/install.sh:
+        each phase runs for every chaincode variant on every peer (install) or
+        org (approve, readiness, verify) at once, bounded by --parallelism,
+        and every step's outcome and duration is reported per chaincode.
+        '''
+        script_vars = load_script_vars(
+            os.path.join(self.destination_path, 'scripts', 'variables.sh'))
+        cli = FabricCLI(script_vars)
+        report = LifecycleReport()
+        start = time.monotonic()
+        names = args.cc_variants.split()
+        print('installing {} at {} on {} peers in {} orgs'.format(
+            ', '.join(names), args.cc_version, len(cli.all_peers()), len(cli.orgs)))
+        failed = install_chaincodes(cli, report, self.channel, names, args.cc_version,
+                                    posixpath.dirname(args.cc_path), args.init_required,
+                                    args.parallelism)
+        print()
+        print(report.summary())
+        print()
+        print(report.group_summary())
+        print('total {:.2f}s'.format(time.monotonic() - start))
+        if failed:
+            raise SystemExit('chaincode install failed for {}: {}'.format(
+                ', '.join(sorted(failed)),
+                '; '.join(r['detail'] for r in report.failures())))
+
     def generate_chaincodes(self, args):
         '''
         params:
@@ -335,6 +562,10 @@ class Network(object):
         '''
         if args.image_override and not args.ccaas:
             raise SystemExit("--image-override requires --ccaas")
+        if args.packager == 'python':
+            self._generate_chaincodes_native(args)
+            self.generate_chaincodes_compose(args.cc_variants.split(), args.image_override)
+            return
         byfn_cmd = self._byfn_cmd('generatecc')
         append_opt(byfn_cmd, '-C', args.cc_name)
         append_opt(byfn_cmd, '-V', args.cc_version)
@@ -345,6 +576,28 @@ class Network(object):
         run(byfn_cmd, chdir=self.destination_path, setenv=self._compose_setenv())
         self.generate_chaincodes_compose(args.cc_variants.split(), args.image_override)
 
+    def _generate_chaincodes_native(self, args):
+        '''
+        Build the chaincode packages and their package IDs in-process instead
+        of with scripts/generatecc.sh, so no peer binary is needed.
+        '''
+        names = args.cc_variants.split()
+        if not names:
+            print("No chaincodes to generate, skipping...")
+            return
+        # cc_path is given as the cli container sees it, e.g. /chaincodes/cc.car.
+        src_path = os.path.join(self.destination_path, args.cc_path.lstrip('/'))
+        start = time.monotonic()
+        packages = generate_chaincode_packages(src_path, names, args.cc_version, args.ccaas,
+                                               cache=args.cache)
+        for name in names:
+            path, package_id, cached = packages[name]
+            self._chown_maybe(path)
+            self._chown_maybe(path[:-len('.tar.gz')] + '.id')
+            print('{}\t{}{}'.format(package_id, path, ' (cached)' if cached else ''))
+        print('generated {} package(s), {} from cache, in {:.2f}s'.format(
+            len(names), sum(1 for p in packages.values() if p[2]), time.monotonic() - start))
+
     DEFAULT_CCAAS_IMAGE = 'luthersystems/substrate:$CHAINCODE_VERSION'
 
     @staticmethod
@@ -371,24 +624,22 @@ class Network(object):
             print("skipping ccaas compose file...")
             return
         overrides = self._parse_image_overrides(image_overrides or [], chaincode_names)
-        # Define the base port for the external chaincodes
-        base_port = 9080
+        # Host ports come from the ccaas range of the generated port map
+        services = [f"{cc_name}-peer0" for cc_name in chaincode_names]
+        ports = allocate_ccaas_ports(self.destination_path, services)
 
         # Prepare the data for the template
         chaincodes_data = []
-        for idx, cc_name in enumerate(chaincode_names):
+        for service_name, cc_name in zip(services, chaincode_names):
             chaincodes_data.append({
-                'service_name': f"{cc_name}-peer0",
+                'service_name': service_name,
                 'ccid_env_var': f"CCID_{cc_name.upper()}",
-                'port': base_port + idx,
+                'port': ports[service_name],
                 'image': overrides.get(cc_name, self.DEFAULT_CCAAS_IMAGE),
             })
 
-        # Load and render the Jinja template
-        template_file = 'docker-compose-ccaas.yaml.j2'
-        with open(os.path.join(self.template_base_path, template_file)) as src_file:
-            template = Template(src_file.read())
-
+        # Render the Jinja template
+        template = template_env(self.template_base_path).get_template('docker-compose-ccaas.yaml.j2')
         docker_compose_content = template.render(chaincodes=chaincodes_data)
 
         # Write the rendered content to a file
@@ -413,8 +664,17 @@ class Network(object):
             run(['docker', 'rmi'] + images.decode('utf-8').split())
 
     def cert_expiries(self, args):
-        for e, p in cert_expiries('crypto-config'):
-            print('{}\t{}'.format(e, p))
+        now = datetime.now(timezone.utc)
+        records = stream_cert_records(args.crypto_config, now=now,
+                                      expiring_within=args.expiring_within)
+        if args.format == 'text':
+            for r in sorted(records, key=lambda r: (r['expiry'], r['path'])):
+                print('{}\t{}'.format(r['expiry'], r['path']))
+            return
+        writer = RecordWriter(args.format, CERT_RECORD_FIELDS)
+        for r in records:
+            writer.write(r)
+        writer.close()
 
     def reissue(self, args):
         '''
@@ -428,8 +688,12 @@ class Network(object):
         '''
         if args.days is not None and args.days < 1:
             raise SystemExit('--days must be a positive integer')
+        text = args.format == 'text'
+        # machine-readable formats keep stdout for records only
+        say = print if text else functools.partial(print, file=sys.stderr)
         kinds = ['signcert', 'tls'] if args.type == 'both' else [args.type]
-        entries = discover_leaf_certs(args.crypto_config, kinds)
+        index = scan_crypto_config(args.crypto_config)
+        entries = discover_leaf_certs(args.crypto_config, kinds, index=index)
         if not entries:
             raise SystemExit(
                 'no leaf certificates found under {}'.format(args.crypto_config))
@@ -446,6 +710,10 @@ class Network(object):
                 raise SystemExit(
                     'no nodes matched --node: {}'.format(', '.join(unmatched)))
 
+        if args.expiring_within is not None:
+            cutoff = now + timedelta(days=args.expiring_within)
+            entries = [e for e in entries if e['expiry'] <= cutoff]
+
         selecting = args.all or args.all_expired or bool(args.node)
 
         def is_selected(e):
@@ -455,41 +723,97 @@ class Network(object):
                 return False
             return True
 
+        entries.sort(key=lambda e: (e['org'], e['node'], e['kind']))
         targets = []
-        print('{:<42} {:<9} {:<22} {}'.format(
-            'NODE', 'KIND', 'EXPIRES', 'STATUS'))
-        for e in sorted(entries, key=lambda e: (e['org'], e['node'], e['kind'])):
+        if text:
+            print('{:<42} {:<9} {:<22} {}'.format(
+                'NODE', 'KIND', 'EXPIRES', 'STATUS'))
+        for e in entries:
             status = 'EXPIRED' if e['expired'] else 'ok'
-            chosen = selecting and is_selected(e)
-            if chosen:
+            e['selected'] = selecting and is_selected(e)
+            if e['selected']:
                 targets.append(e)
                 status += ' -> reissue'
-            print('{:<42} {:<9} {:<22} {}'.format(
-                e['node'], e['kind'],
-                e['expiry'].strftime('%Y-%m-%dT%H:%M:%SZ'), status))
+            if text:
+                print('{:<42} {:<9} {:<22} {}'.format(
+                    e['node'], e['kind'],
+                    e['expiry'].strftime('%Y-%m-%dT%H:%M:%SZ'), status))
 
+        failures = self._reissue_targets(targets, args, now, index, say) \
+            if selecting and targets else 0
         if not selecting:
-            print('\nNo targets selected. Re-run with --node NAME, '
-                  '--all-expired, or --all to reissue.')
-            return
-        if not targets:
-            print('\nNothing matched the selection.')
-            return
+            say('\nNo targets selected. Re-run with --node NAME, '
+                '--all-expired, or --all to reissue.')
+        elif not targets:
+            say('\nNothing matched the selection.')
+
+        if not text:
+            writer = RecordWriter(args.format, REISSUE_RECORD_FIELDS)
+            for e in entries:
+                rec = index.records[index.files[e['cert_path']]]
+                writer.write(dict(
+                    cert_record(index.root, e['cert_path'], rec, now),
+                    expired=e['expired'], selected=e['selected'],
+                    result=e.get('result'), new_expiry=e.get('new_expiry'),
+                    error=e.get('error')))
+            writer.close()
+        if failures:
+            raise SystemExit(
+                '{} certificate(s) could not be reissued'.format(failures))
 
-        print()
+    def _reissue_targets(self, targets, args, now, index, say):
+        '''
+        Plan, sign and write every target, recording the outcome on each entry.
+        Returns the number of targets that could not be reissued.
+        '''
+        say()
         failures = 0
+        resolver = CAResolver(index)
+        plans = []
         for e in targets:
             try:
-                self._reissue_one(e, args, now)
+                plans.append(self._plan_reissue(e, args, now, resolver))
             except ReissueError as err:
                 failures += 1
-                print('  SKIP {} {}: {}'.format(e['node'], e['kind'], err))
-        if failures:
-            raise SystemExit(
-                '{} certificate(s) could not be reissued'.format(failures))
-
-    def _reissue_one(self, e, args, now):
-        ca_cert, ca_key = resolve_ca(e['ca_dir'], e['cert'])
+                e['result'], e['error'] = 'failed', str(err)
+                say('  SKIP {} {}: {}'.format(e['node'], e['kind'], err))
+        if args.dry_run:
+            for p in plans:
+                p['entry'].update(result='dry-run', new_expiry=p['new_expiry'])
+                say('  DRY-RUN {} -> {}{}'.format(p['label'], p['new_expiry'], p['note']))
+        elif plans:
+            sign_all(plans, jobs=args.jobs)
+            write_reissued(plans, backup=not args.no_backup)
+            for p in plans:
+                p['entry'].update(result='reissued', new_expiry=p['new_expiry'])
+                say('  OK {} -> {}{}'.format(p['label'], p['new_expiry'], p['note']))
+        return failures
+
+    def metrics(self, args):
+        '''
+        Serve certificate expiries as OpenMetrics gauges.  The tree is
+        re-scanned every --interval seconds; thanks to the persistent cert
+        index a poll only stats files, and scrapes are answered from the last
+        rendered exposition.
+        '''
+        exporter = CertMetrics(args.crypto_config)
+        exporter.refresh()
+        if args.once:
+            sys.stdout.write(exporter.body)
+            return
+        server = exporter.serve(args.listen, args.port, args.interval)
+        print('serving {} metrics on http://{}:{}/metrics'.format(
+            args.crypto_config, *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            exporter.stop()
+            server.server_close()
+
+    def _plan_reissue(self, e, args, now, resolver):
+        ca_cert, ca_key = resolver.resolve(e['ca_dir'], e['cert'])
         ca_expiry = _not_after(ca_cert)
         if ca_expiry <= now:
             raise ReissueError(
@@ -503,17 +827,15 @@ class Network(object):
             requested = now + timedelta(days=args.days)
             not_after = min(requested, ca_expiry)
             capped = requested > ca_expiry
-        note = ' (capped at CA expiry)' if capped else ''
-        label = '{} {}'.format(e['node'], e['kind'])
-        new_expiry = not_after.strftime('%Y-%m-%dT%H:%M:%SZ')
-        if args.dry_run:
-            print('  DRY-RUN {} -> {}{}'.format(label, new_expiry, note))
-            return
-        new_bytes = build_reissued_cert(e['cert'], ca_cert, ca_key, not_after)
-        if not args.no_backup:
-            shutil.copy2(str(e['cert_path']), str(_backup_path(e['cert_path'])))
-        e['cert_path'].write_bytes(new_bytes)
-        print('  OK {} -> {}{}'.format(label, new_expiry, note))
+        return {
+            'entry': e,
+            'ca_cert': ca_cert,
+            'ca_key': ca_key,
+            'not_after': not_after,
+            'label': '{} {}'.format(e['node'], e['kind']),
+            'new_expiry': not_after.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'note': ' (capped at CA expiry)' if capped else '',
+        }
 
     def config_parameters(self):
         return ['channel']
@@ -540,8 +862,8 @@ class Network(object):
 
     def main(self):
         parser = argparse.ArgumentParser()
-        # TODO: read a yaml config
-        parser.add_argument('--config', help='configuration file path')
+        parser.add_argument('--config', help='YAML topology file for generate: orgs (each with '
+                                             'its own peers), orderers and generate settings')
         parser.add_argument('--channel', help='the channel used on the network',
                             default=self.channel)
         parser.add_argument('--chown', help='set the user:group of generated files',
@@ -602,8 +924,29 @@ class Network(object):
                                 action='store_false',
                                 default=None,
                                 dest='template')
-        parser_gen.add_argument('--archive', '-a', help='generate a tar.xz for distribution',
+        parser_gen.add_argument('--archive', '-a', help='generate a compressed tarball for distribution '
+                                '(see --archive-format)',
                                 dest='archive_path')
+        parser_gen.add_argument('--archive-format', choices=sorted(ARCHIVE_FORMATS),
+                                default='xz', dest='archive_format',
+                                help='archive compression: multithreaded xz, zstd or gzip '
+                                '(default: xz)')
+        parser_gen.add_argument('--archive-level', type=int, dest='archive_level',
+                                help='compression level (default: the codec\'s own default)')
+        parser_gen.add_argument('--incremental', help='re-render over an existing network, rewriting '
+                                                      'only files whose content changed',
+                                action='store_true',
+                                default=self.incremental)
+        parser_gen.add_argument('--crypto-backend', choices=['cryptogen', 'python'],
+                                default='cryptogen', dest='crypto_backend',
+                                help='tool used to generate crypto material (default: cryptogen)')
+        parser_gen.add_argument('--artifact-parallelism', type=int, dest='artifact_parallelism',
+                                help='maximum concurrent configtxgen runs for channel '
+                                     'artifacts (default: CPU count)')
+        parser_gen.add_argument('--port-range', action='append', default=[], dest='port_ranges',
+                                metavar='KIND=START-END',
+                                help='host port range for one kind of port ({}); '
+                                     'repeatable'.format(', '.join(sorted(PORT_RANGES))))
         parser_gen.add_argument('--orderer-san-domains', nargs='+',
                                 help='domain suffixes to add to SAN field of orderer certificates')
         parser_gen.add_argument('--peer-san-domains', nargs='+',
@@ -611,16 +954,45 @@ class Network(object):
         parser_gen.set_defaults(func=self.generate)
 
         parser_ext = subparsers.add_parser('extend', help='extend an existing network')
-        parser_ext.add_argument('--archive', '-a', help='generate a tar.xz for distribution',
+        parser_ext.add_argument('--archive', '-a', help='generate a compressed tarball for distribution '
+                                '(see --archive-format)',
                                 dest='archive_path')
+        parser_ext.add_argument('--archive-format', choices=sorted(ARCHIVE_FORMATS),
+                                default='xz', dest='archive_format',
+                                help='archive compression: multithreaded xz, zstd or gzip '
+                                '(default: xz)')
+        parser_ext.add_argument('--archive-level', type=int, dest='archive_level',
+                                help='compression level (default: the codec\'s own default)')
+        parser_ext.add_argument('--delta-from', dest='delta_from', metavar='PREVIOUS',
+                                help='with --archive, extend the tree in place and archive '
+                                     'only files that are new or changed since PREVIOUS '
+                                     '(an earlier archive or its manifest)')
         parser_ext.add_argument('--domain-name', help='infrastructure domain name',
                                 default=self.domain_name)
+        parser_ext.add_argument('--crypto-backend', choices=['cryptogen', 'python'],
+                                default='cryptogen', dest='crypto_backend',
+                                help='tool used to extend crypto material (default: cryptogen)')
         parser_ext.set_defaults(func=self.extend)
 
+        parser_apply = subparsers.add_parser('apply_delta',
+                                             help='merge an extend --delta-from archive into '
+                                                  'a tree, verifying hashes')
+        parser_apply.add_argument('delta_path', help='path to the delta archive')
+        parser_apply.add_argument('--dest', default='.',
+                                  help='tree to apply the delta to (default: .)')
+        parser_apply.set_defaults(func=self.apply_delta)
+
         parser_up = subparsers.add_parser('up', help='launch a network')
         parser_up.add_argument('--log-spec', help='set FABRIC_LOGGING_SPEC value',
                                type=str, default=self.log_spec)
         parser_up.add_argument('--cc-version', help='chaincode version (for CCAAS)')
+        parser_up.add_argument('--parallelism', type=int, default=8,
+                               help='maximum concurrent channel joins (default: 8)')
+        parser_up.add_argument('--join-deadline', type=float, default=60, dest='join_deadline',
+                               help='seconds each peer keeps retrying its join (default: 60)')
+        parser_up.add_argument('--sequential', action='store_true',
+                               help='join peers one at a time with scripts/join_channel.sh '
+                                    '(fallback)')
         parser_up.set_defaults(func=self.up)
         parser_install = subparsers.add_parser('install', help='install a chaincode archive (.tar.gz)')
         parser_install.add_argument('--init-required', help='set chaincode to require init',
@@ -631,6 +1003,11 @@ class Network(object):
         parser_install.add_argument('cc_version', help='deployment version')
         parser_install.add_argument('cc_variants', help='deployment variants')
         parser_install.add_argument('cc_path', help='path to the packaged chaincode tarball')
+        parser_install.add_argument('--parallelism', type=int, default=8,
+                                    help='maximum concurrent peer commands (default: 8)')
+        parser_install.add_argument('--sequential', action='store_true',
+                                    help='run the lifecycle one peer at a time with '
+                                         'scripts/install.sh (fallback)')
         parser_install.set_defaults(func=self.install)
 
         parser_generatecc = subparsers.add_parser('generatecc', help='generate chaincode archives (.tar.gz)')
@@ -641,6 +1018,14 @@ class Network(object):
                                     metavar='NAME=IMAGE',
                                     help='override image for a CCaaS service (repeatable); '
                                          'NAME must match a chaincode in cc_variants')
+        parser_generatecc.add_argument('--packager', choices=['python', 'peer'],
+                                       default='python',
+                                       help='build packages in-process, or with '
+                                            'scripts/generatecc.sh and the peer binary '
+                                            '(default: python)')
+        parser_generatecc.add_argument('--no-cache', action='store_false', dest='cache',
+                                       help='always rebuild packages instead of reusing '
+                                            'cached ones (python packager)')
         parser_generatecc.add_argument('cc_name', help='chaincode name used to invoke its methods')
         parser_generatecc.add_argument('cc_version', help='deployment version')
         parser_generatecc.add_argument('cc_variants', help='deployment variants')
@@ -650,6 +1035,10 @@ class Network(object):
         parser_down = subparsers.add_parser('down', help='teardown network containers')
         parser_down.set_defaults(func=self.down)
         parser_cert_expiries = subparsers.add_parser('cert_expiries', help='print expiration values for certs')
+        parser_cert_expiries.add_argument('--crypto-config', default='crypto-config',
+                                          dest='crypto_config',
+                                          help='path to the crypto-config tree (default: crypto-config)')
+        add_record_args(parser_cert_expiries)
         parser_cert_expiries.set_defaults(func=self.cert_expiries)
 
         parser_reissue = subparsers.add_parser(
@@ -677,8 +1066,35 @@ class Network(object):
                                     help='show what would change without writing')
         parser_reissue.add_argument('--no-backup', action='store_true', dest='no_backup',
                                     help='do not write .bak copies of replaced certs')
+        parser_reissue.add_argument('--jobs', '-j', type=int, default=None,
+                                    help='number of signing threads (default: CPU count)')
+        add_record_args(parser_reissue)
         parser_reissue.set_defaults(func=self.reissue)
 
+        parser_metrics = subparsers.add_parser(
+            'metrics', help='serve certificate expiries as OpenMetrics gauges')
+        parser_metrics.add_argument('--crypto-config', default='crypto-config',
+                                    dest='crypto_config',
+                                    help='path to the crypto-config tree (default: crypto-config)')
+        parser_metrics.add_argument('--listen', default='127.0.0.1',
+                                    help='address to bind (default: 127.0.0.1)')
+        parser_metrics.add_argument('--port', type=int, default=9444,
+                                    help='port to serve /metrics on (default: 9444)')
+        parser_metrics.add_argument('--interval', type=float, default=30,
+                                    help='seconds between mtime polls of the tree (default: 30)')
+        parser_metrics.add_argument('--once', action='store_true',
+                                    help='print the exposition once and exit')
+        parser_metrics.set_defaults(func=self.metrics)
+
+        pre = argparse.ArgumentParser(add_help=False)
+        pre.add_argument('--config')
+        config_path = pre.parse_known_args()[0].config
+        if config_path:
+            settings, spec = load_topology_config(config_path)
+            parser.set_defaults(channel=settings.pop('channel', self.channel))
+            parser_gen.set_defaults(topology=spec, org_count=len(spec['orgs']),
+                                    peer_count=None, orderer_count=None, **settings)
+
         args = parser.parse_args()
         for k, v in vars(args).items():
             if k in vars(self):
@@ -686,6 +1102,543 @@ class Network(object):
         args.func(args)
 
 
+def cache_dir(*parts):
+    '''
+    Return a per-user cache directory for fabric-network-builder, creating it if
+    necessary.  FNB_CACHE_DIR overrides the default under $XDG_CACHE_HOME.
+    Returns None when the directory cannot be created (e.g. a read-only home).
+    '''
+    base = os.environ.get('FNB_CACHE_DIR')
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        base = os.path.join(xdg, 'fabric-network-builder')
+    path = os.path.join(base, *parts)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+_template_envs = {}
+
+
+def template_env(template_base_path):
+    '''
+    Return the shared jinja Environment for a template directory.  Parsed
+    templates are kept in memory for the life of the process and compiled
+    bytecode is cached on disk so repeated generate runs skip the parse step.
+    '''
+    env = _template_envs.get(template_base_path)
+    if env is None:
+        bytecode_dir = cache_dir('jinja')
+        bytecode_cache = None
+        if bytecode_dir is not None:
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        env = Environment(loader=FileSystemLoader(template_base_path),
+                          bytecode_cache=bytecode_cache,
+                          cache_size=-1)
+        _template_envs[template_base_path] = env
+    return env
+
+
+def parse_chown(spec):
+    '''
+    Resolve a chown(1) style "user[:group]" spec (names or numeric ids) to a
+    (uid, gid) pair.  A missing half is returned as -1, which os.chown leaves
+    unchanged.
+    '''
+    user, _, group = spec.partition(':')
+    uid = gid = -1
+    if user:
+        uid = int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+    if group:
+        gid = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+    return uid, gid
+
+
+def chown_paths(paths, spec, recursive=False):
+    '''
+    Native replacement for `chown [-R] spec paths...`.  Symlinks are changed
+    themselves and never followed, matching chown -R.
+    '''
+    uid, gid = parse_chown(spec)
+    count = 0
+    for path in paths:
+        os.chown(path, uid, gid, follow_symlinks=False)
+        count += 1
+        if not recursive or not os.path.isdir(path) or os.path.islink(path):
+            continue
+        for root, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                os.chown(os.path.join(root, name), uid, gid, follow_symlinks=False)
+                count += 1
+    return count
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _changed_services(previous, content):
+    '''
+    Names of compose services that differ between two renderings of a compose
+    file, including services that were added or removed.
+    '''
+    old = (yaml.safe_load(previous) if previous else None) or {}
+    new = (yaml.safe_load(content) if content else None) or {}
+    old_services = old.get('services') or {}
+    new_services = new.get('services') or {}
+    changed = set()
+    for name in set(old_services) | set(new_services):
+        if old_services.get(name) != new_services.get(name):
+            changed.add(name)
+    # A changed top-level volume or network touches the services using it.
+    for section in ('volumes', 'networks'):
+        old_defs = old.get(section) or {}
+        new_defs = new.get(section) or {}
+        touched = {k for k in set(old_defs) | set(new_defs)
+                   if old_defs.get(k) != new_defs.get(k)}
+        for name, svc in new_services.items():
+            refs = (svc or {}).get(section) or []
+            if section == 'volumes':
+                refs = [str(v).split(':')[0] for v in refs]
+            if touched.intersection(refs):
+                changed.add(name)
+    return changed
+
+
+def _sha256(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_sha256(path):
+    try:
+        with open(path, 'rb') as f:
+            return _sha256(f.read())
+    except FileNotFoundError:
+        return None
+
+
+# Rendered-file manifest kept in the generate destination directory.
+MANIFEST_NAME = '.fnb-manifest.json'
+
+
+# Rendered files that crypto material and channel artifacts are generated from.
+GENERATED_INPUTS = ('crypto-config.yaml', 'configtx.yaml')
+
+
+def _load_manifest(dest):
+    try:
+        with open(os.path.join(dest, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def record_generated_inputs(dest, names):
+    '''
+    Note in the manifest the digests of names as they were when crypto
+    material and channel artifacts were generated from them.
+    '''
+    manifest = _load_manifest(dest)
+    manifest.setdefault('version', 1)
+    manifest.setdefault('files', {})
+    manifest['generated'] = {name: _file_sha256(os.path.join(dest, name)) for name in names}
+    path = os.path.join(dest, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def stale_generated_inputs(dest, names, changed=()):
+    '''
+    The names whose content differs from the digests record_generated_inputs
+    noted.  Trees generated before those were recorded fall back to the
+    files the current render changed.
+    '''
+    generated = _load_manifest(dest).get('generated')
+    if generated is None:
+        return [name for name in names if name in changed]
+    return [name for name in names
+            if generated.get(name) != _file_sha256(os.path.join(dest, name))]
+
+
+class FileBatch(object):
+    '''
+    Materializes generated files under a destination directory with os/shutil
+    calls instead of a mkdir/cp/chmod/chown subprocess per file.  Mode and
+    ownership changes are queued and applied together by finish(), which
+    prints a single summary line.
+
+    Every file is recorded in a manifest (MANIFEST_NAME) with the digest of
+    its render inputs and of its output.  In incremental mode a file whose
+    inputs are unchanged is not re-rendered, and a file whose output is
+    unchanged is not rewritten, so mtimes only move when content does.
+    '''
+
+    def __init__(self, destination_path, incremental=False):
+        self.destination_path = destination_path
+        self.incremental = incremental
+        self.umask = _umask()
+        self.dirs = []
+        self.files = []
+        self.executables = []
+        # (name, previous text or None, new text) for every rewritten file
+        self.changed = []
+        self.unchanged = []
+        self.previous = {}
+        if incremental:
+            self.previous = self._load_manifest()
+        self.manifest = {}
+
+    def _path(self, name):
+        return os.path.join(self.destination_path, name)
+
+    def _load_manifest(self):
+        return _load_manifest(self.destination_path).get('files', {})
+
+    def mkdir(self, name):
+        path = self._path(name)
+        os.makedirs(path, exist_ok=True)
+        self.dirs.append(path)
+        return path
+
+    def is_fresh(self, name, input_digest):
+        '''
+        True (and the file is kept as-is) when incremental mode is on, the
+        manifest recorded the same input digest, and the file on disk still
+        holds the recorded output.
+        '''
+        prev = self.previous.get(name)
+        if not self.incremental or prev is None or prev.get('input') != input_digest:
+            return False
+        if _file_sha256(self._path(name)) != prev.get('output'):
+            return False
+        self.manifest[name] = prev
+        self.unchanged.append(name)
+        self.files.append(self._path(name))
+        return True
+
+    def write(self, name, content, input_digest=None):
+        path = self._path(name)
+        output_digest = _sha256(content)
+        self.manifest[name] = {'input': input_digest or output_digest,
+                               'output': output_digest}
+        self.files.append(path)
+        previous = None
+        if self.incremental and os.path.exists(path):
+            with open(path) as f:
+                previous = f.read()
+            if previous == content:
+                self.unchanged.append(name)
+                return path
+        with open(path, 'w') as dst_file:
+            dst_file.write(content)
+        self.changed.append((name, previous, content))
+        return path
+
+    def copy(self, src, name):
+        # Like cp(1): an existing destination keeps its mode, a new one takes
+        # the source mode filtered through the umask.
+        path = self._path(name)
+        with open(src, 'rb') as f:
+            data = f.read()
+        digest = _sha256(data)
+        self.manifest[name] = {'input': digest, 'output': digest}
+        self.files.append(path)
+        existed = os.path.exists(path)
+        if self.incremental and existed and _file_sha256(path) == digest:
+            self.unchanged.append(name)
+            return path
+        shutil.copyfile(src, path)
+        if not existed:
+            os.chmod(path, stat.S_IMODE(os.stat(src).st_mode) & ~self.umask)
+        self.changed.append((name, None, None))
+        return path
+
+    def make_executable(self, name):
+        self.executables.append(self._path(name))
+
+    def _save_manifest(self):
+        path = self._path(MANIFEST_NAME)
+        tmp = path + '.tmp'
+        manifest = {'version': 1, 'files': self.manifest}
+        generated = _load_manifest(self.destination_path).get('generated')
+        if generated:
+            manifest['generated'] = generated
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+        self.files.append(path)
+
+    def finish(self, chown=None):
+        # chmod +x honours the umask, so only add the execute bits it allows.
+        xbits = 0o111 & ~self.umask
+        for path in self.executables:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            if mode | xbits != mode:
+                os.chmod(path, mode | xbits)
+        self._save_manifest()
+        owned = 0
+        if chown is not None:
+            owned = chown_paths(self.dirs + self.files, chown)
+        summary = 'materialized {} dirs, {} files ({} executable) in {}'.format(
+            len(self.dirs), len(self.files), len(self.executables),
+            self.destination_path)
+        if self.incremental:
+            summary += ' ({} changed, {} unchanged)'.format(
+                len(self.changed), len(self.unchanged))
+        if owned:
+            summary += ', chown {} to {}'.format(owned, chown)
+        print(summary)
+
+
+# --archive-format -> (compressor command, valid levels, default level).  The
+# external compressors run multithreaded; gzip is written in-process.
+ARCHIVE_FORMATS = {
+    'xz': (['xz', '-T0', '-c'], range(0, 10), 6),
+    'zstd': (['zstd', '-T0', '-q', '-c'], range(1, 20), 3),
+    'gzip': (None, range(1, 10), 6),
+}
+
+
+# Content hashes of every file in an --archive tarball, stored as its first
+# member and, once a delta is applied, in the tree it was applied to.
+ARCHIVE_MANIFEST = '.fnb-archive-manifest.json'
+ARCHIVE_MANIFEST_VERSION = 1
+
+
+def write_archive(archive_path, root, names, fmt='xz', level=None, manifest=None):
+    '''
+    Write the files and directories names (relative to root) to archive_path
+    as a compressed tarball, preceded by manifest (as ARCHIVE_MANIFEST) when
+    given.  Tar entries are streamed straight into the compressor, which
+    writes archive_path directly; a failed run removes the partial archive.
+    xz falls back to the (single-threaded) lzma module when the xz binary is
+    missing.
+    '''
+    command, levels, default = ARCHIVE_FORMATS[fmt]
+    level = default if level is None else level
+    if level not in levels:
+        raise SystemExit('--archive-level for {} must be {}-{}'.format(
+            fmt, levels[0], levels[-1]))
+    if command is not None and shutil.which(command[0]) is None:
+        if fmt != 'xz':
+            raise SystemExit('{} not found; install it or use another --archive-format'.format(
+                command[0]))
+        command = None
+
+    def fill(tar):
+        if manifest is not None:
+            data = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+            info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+        for name in names:
+            tar.add(os.path.join(root, name), arcname=name)
+
+    with open(archive_path, 'wb') as out:
+        try:
+            if command is not None:
+                proc = subprocess.Popen(command + ['-{}'.format(level)],
+                                        stdin=subprocess.PIPE, stdout=out)
+                try:
+                    with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                        fill(tar)
+                finally:
+                    proc.stdin.close()
+                    if proc.wait():
+                        raise SystemExit('{} exited with status {}'.format(
+                            command[0], proc.returncode))
+            else:
+                if fmt == 'xz':
+                    compressor = lzma.LZMAFile(out, 'wb', preset=level)
+                else:
+                    compressor = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level,
+                                               mtime=0)
+                with compressor, tarfile.open(fileobj=compressor, mode='w|') as tar:
+                    fill(tar)
+        except BaseException:
+            out.close()
+            os.unlink(archive_path)
+            raise
+
+
+@contextlib.contextmanager
+def _read_archive(path):
+    '''A streaming TarFile over any archive write_archive produces.'''
+    with open(path, 'rb') as f:
+        zstd = f.read(4) == b'\x28\xb5\x2f\xfd'
+    if not zstd:
+        with tarfile.open(path, 'r|*') as tar:
+            yield tar
+        return
+    if shutil.which('zstd') is None:
+        raise SystemExit('zstd not found; cannot read {}'.format(path))
+    proc = subprocess.Popen(['zstd', '-dc', '-q', path], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def tree_manifest(root, names, workers=None):
+    '''{path relative to root: sha256} for every regular file under names.'''
+    paths = []
+    for name in names:
+        top = os.path.join(root, name)
+        if os.path.isfile(top):
+            paths.append(top)
+        else:
+            paths.extend(entry.path for entry in _walk_files(top))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = list(pool.map(_stream_sha256, paths))
+    return {os.path.relpath(p, root).replace(os.sep, '/'): d for p, d in zip(paths, digests)}
+
+
+def read_archive_manifest(path):
+    '''
+    The manifest of a previous archive: path is either the archive itself
+    (only its first member is read) or a manifest file.
+    '''
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    with _read_archive(path) as tar:
+        member = tar.next()
+        if member is None or member.name != ARCHIVE_MANIFEST:
+            raise SystemExit('{}: no {} (archive written before manifests?)'.format(
+                path, ARCHIVE_MANIFEST))
+        return json.load(tar.extractfile(member))
+
+
+def archive_delta(previous, files):
+    '''
+    The delta manifest taking a tree from the previous manifest's files to
+    files: the full new file list plus what was added, changed or removed and
+    the previous hashes of the changed and removed files.
+    '''
+    old = previous['files']
+    added = sorted(p for p in files if p not in old)
+    changed = sorted(p for p in files if p in old and old[p] != files[p])
+    removed = sorted(p for p in old if p not in files)
+    return {'version': ARCHIVE_MANIFEST_VERSION, 'files': files,
+            'base': {p: old[p] for p in changed + removed},
+            'added': added, 'changed': changed, 'removed': removed}
+
+
+def apply_archive_delta(archive_path, dest):
+    '''
+    Merge a delta archive into the tree at dest.  The tree must hold the
+    delta's base versions of every changed or removed file.  Each new file is
+    staged beside its target and its sha256 checked against the manifest
+    before anything is replaced, so a mismatch leaves dest untouched.
+    Returns the delta manifest.
+    '''
+    with _read_archive(archive_path) as tar:
+        member = tar.next()
+        if member is None or member.name != ARCHIVE_MANIFEST:
+            raise SystemExit('{}: not an archive with a manifest'.format(archive_path))
+        manifest = json.load(tar.extractfile(member))
+        if 'base' not in manifest:
+            raise SystemExit('{}: a full archive, not a delta'.format(archive_path))
+        files = manifest['files']
+        unsafe = [p for p in list(files) + manifest['removed']
+                  if posixpath.isabs(p) or '..' in p.split('/')]
+        if unsafe:
+            raise SystemExit('{}: unsafe paths {}'.format(archive_path, ', '.join(unsafe)))
+        wanted = set(manifest['added']) | set(manifest['changed'])
+        mismatched = [p for p, digest in manifest['base'].items()
+                      if _file_sha256(os.path.join(dest, p)) != digest]
+        mismatched += [p for p in manifest['added']
+                       if _file_sha256(os.path.join(dest, p)) not in (None, files[p])]
+        if mismatched:
+            raise SystemExit('{} does not match the delta\'s base: {}'.format(
+                dest, ', '.join(sorted(mismatched))))
+        staged = []
+        try:
+            for member in tar:
+                if not member.isfile() or member.name == ARCHIVE_MANIFEST:
+                    continue
+                if member.name not in wanted:
+                    raise SystemExit('{}: unexpected member {}'.format(archive_path, member.name))
+                target = os.path.join(dest, member.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target),
+                                           prefix='.{}.'.format(os.path.basename(target)))
+                staged.append((tmp, target))
+                sha = hashlib.sha256()
+                src = tar.extractfile(member)
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: src.read(_PACKAGE_CHUNK), b''):
+                        sha.update(chunk)
+                        f.write(chunk)
+                os.chmod(tmp, member.mode & 0o777)
+                if sha.hexdigest() != files[member.name]:
+                    raise SystemExit('{}: hash mismatch for {}'.format(archive_path,
+                                                                        member.name))
+                wanted.discard(member.name)
+            if wanted:
+                raise SystemExit('{}: missing {}'.format(archive_path, ', '.join(sorted(wanted))))
+        except BaseException:
+            for tmp, _ in staged:
+                os.unlink(tmp)
+            raise
+    for tmp, target in staged:
+        os.replace(tmp, target)
+    for p in manifest['removed']:
+        os.unlink(os.path.join(dest, p))
+    _write_atomic(os.path.join(dest, ARCHIVE_MANIFEST),
+                  json.dumps({'version': ARCHIVE_MANIFEST_VERSION, 'files': files},
+                             indent=1, sort_keys=True).encode('utf-8'),
+                  0o666 & ~_umask())
+    return manifest
+
+
+# Stand-ins for each org's CA key file name in docker-compose-e2e-template.yaml.
+_CA_KEY_PLACEHOLDER = re.compile(r'CA(\d+)_PRIVATE_KEY')
+
+
+def ca_private_key_name(ca_dir):
+    '''The name of the *_sk key file in an org's ca/ directory.'''
+    try:
+        with os.scandir(ca_dir) as it:
+            keys = [e.name for e in it if e.name.endswith('_sk') and e.is_file()]
+    except FileNotFoundError:
+        raise SystemExit('{}: CA directory not found'.format(ca_dir))
+    if len(keys) != 1:
+        raise SystemExit('{}: expected one *_sk CA key, found {}'.format(
+            ca_dir, len(keys) or 'none'))
+    return keys[0]
+
+
+def render_e2e_compose(dest, domain_name):
+    '''
+    Write docker-compose-e2e.yaml from the rendered template in dest,
+    substituting each CA<i>_PRIVATE_KEY with the key file of org<i>'s CA:
+    one directory scan per org and a single substitution pass.  The file is
+    staged beside its target, so concurrent generates never share scratch
+    files.
+    '''
+    template = Path(dest, 'docker-compose-e2e-template.yaml').read_text()
+    keys = {i: ca_private_key_name(os.path.join(
+                dest, 'crypto-config', 'peerOrganizations',
+                'org{}.{}'.format(i, domain_name), 'ca'))
+            for i in sorted(set(_CA_KEY_PLACEHOLDER.findall(template)), key=int)}
+    content = _CA_KEY_PLACEHOLDER.sub(lambda m: keys[m.group(1)], template)
+    _write_atomic(os.path.join(dest, 'docker-compose-e2e.yaml'), content.encode('utf-8'),
+                  0o666 & ~_umask())
+
+
 def envsubst(in_path, out_path, submap):
     cmd = ['bash', '-c', 'envsubst ' + ("'" + (" ".join(map((lambda x: ("$" + x)), submap.keys()))) + "'") + ' < ' + shlex.quote(in_path)]
     output = capture(cmd, setenv=submap)
@@ -728,6 +1681,321 @@ def _private_collection(name, policy, sidedb_req_peer_count, sidedb_max_peer_cou
         "memberOnlyWrite": False,
     }
 
+
+# Top-level keys of a --config file that stand in for generate flags (by
+# argparse dest, with '-' accepted for '_').  Flags given explicitly win.
+TOPOLOGY_SETTINGS = ('channel', 'cc_name', 'domain_name', 'connect_domain_name',
+                     'enable_node_ous', 'min_endorsers', 'private_structure',
+                     'req_peer_count', 'max_peer_count', 'execute_timeout',
+                     'orderer_type', 'orderer_san_domains', 'peer_san_domains')
+_ORG_KEYS = ('name', 'peers', 'ca_port')
+_PEER_KEYS = ('port', 'events_port', 'couchdb_port', 'operations_port', 'bootstrap', 'anchor')
+_ORDERER_KEYS = ('port', 'operations_port')
+_ORG_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_-]*$')
+
+
+def topology_spec(org_count, peer_count, orderer_count):
+    '''The topology spec the --org-count/--peer-count/--orderer-count flags describe.'''
+    return {'orgs': [{'peers': peer_count} for _ in range(org_count)],
+            'orderers': orderer_count}
+
+
+def _check_keys(what, entry, allowed):
+    if not isinstance(entry, dict):
+        raise SystemExit('{}: expected a mapping, got {!r}'.format(what, entry))
+    unknown = sorted(set(entry) - set(allowed))
+    if unknown:
+        raise SystemExit('{}: unknown key(s) {} (expected {})'.format(
+            what, ', '.join(unknown), ', '.join(allowed)))
+
+
+def _node_entries(what, value):
+    '''A node list given as a count or as a list of per-node override mappings.'''
+    if isinstance(value, bool) or not isinstance(value, (int, list)):
+        raise SystemExit('{}: expected a count or a list, got {!r}'.format(what, value))
+    if isinstance(value, int):
+        value = [{}] * value
+    if not value:
+        raise SystemExit('{}: at least one node is required'.format(what))
+    return [{} if v is None else v for v in value]
+
+
+def _port(what, value):
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 < value < 65536:
+        raise SystemExit('{}: invalid port {!r}'.format(what, value))
+    return str(value)
+
+
+def load_topology_config(path):
+    '''
+    Read a --config YAML file.  Returns (settings, spec): generate flag
+    defaults keyed by argparse dest, and the topology spec (orgs, orderers)
+    that build_network_index turns into the node index.
+    '''
+    try:
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    except OSError as e:
+        raise SystemExit('cannot read config {}: {}'.format(path, e.strerror))
+    except yaml.YAMLError as e:
+        raise SystemExit('invalid YAML in config {}: {}'.format(path, e))
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        raise SystemExit('{}: expected a mapping at the top level'.format(path))
+    config = {str(k).replace('-', '_'): v for k, v in config.items()}
+    _check_keys(path, config, TOPOLOGY_SETTINGS + ('orgs', 'orderers', 'ports'))
+    if 'orgs' not in config:
+        raise SystemExit('{}: orgs is required'.format(path))
+    orgs = config.pop('orgs')
+    if not isinstance(orgs, list) or not orgs:
+        raise SystemExit('{}: orgs must be a non-empty list'.format(path))
+    spec = {'orgs': [{'peers': 1} if org is None else org for org in orgs],
+            'orderers': config.pop('orderers', 1),
+            'ports': config.pop('ports', None) or {}}
+    _check_keys(path + ' ports', spec['ports'], tuple(sorted(PORT_RANGES)))
+    return config, spec
+
+
+# Inclusive host port ranges each kind of port falls back to, in node order,
+# when its preferred port is taken or out of bounds.  Peers take two ports
+# each (listen, events); operations covers peers and orderers.  Override with
+# --port-range KIND=START-END or ports: in --config.
+PORT_RANGES = {
+    'orderer': (7050, 7099),
+    'peer': (7100, 8999),
+    'ca': (9000, 9099),
+    'ccaas': (9100, 9199),
+    'couchdb': (10000, 10999),
+    'operations': (11000, 11999),
+}
+PORT_MAP_NAME = 'ports.json'
+
+# The host port the n-th port of a kind has always had, used while it is free
+# and the kind's range is the default, so topologies that fit keep their ports.
+PREFERRED_PORTS = {
+    'orderer': lambda n: 7050 + 1000 * n,
+    'peer': lambda n: 7051 + 1000 * (n // 2) + 2 * (n % 2),
+    'ca': lambda n: 7054 + 1000 * n,
+    'ccaas': lambda n: 9080 + n,
+}
+
+
+def parse_port_range(kind, value):
+    '''A port range given as 'START-END' or [START, END]; returns (start, end).'''
+    if kind not in PORT_RANGES:
+        raise SystemExit('unknown port range {} (expected {})'.format(
+            kind, ', '.join(sorted(PORT_RANGES))))
+    if isinstance(value, str):
+        value = value.split('-', 1)
+    try:
+        start, end = (int(v) for v in value)
+    except (TypeError, ValueError):
+        raise SystemExit('{} port range: expected START-END, got {!r}'.format(kind, value))
+    if not 0 < start <= end < 65536:
+        raise SystemExit('{} port range {}-{} is not within 1-65535'.format(kind, start, end))
+    return start, end
+
+
+def port_ranges(*overrides):
+    '''
+    PORT_RANGES with each mapping of kind -> range applied in turn; ranges
+    may not overlap.
+    '''
+    ranges = dict(PORT_RANGES)
+    for override in overrides:
+        for kind, value in (override or {}).items():
+            ranges[kind] = parse_port_range(kind, value)
+    spans = sorted((start, end, kind) for kind, (start, end) in ranges.items())
+    for (start, end, kind), (next_start, next_end, next_kind) in zip(spans, spans[1:]):
+        if next_start <= end:
+            raise SystemExit('port ranges overlap: {} {}-{} and {} {}-{}'.format(
+                kind, start, end, next_kind, next_start, next_end))
+    return ranges
+
+
+class PortAllocator(object):
+    '''
+    Hands out host ports from per-kind ranges in request order.  Explicit
+    ports are claimed first with reserve(), then preferred ports with prefer(),
+    and allocation steps around them all, so every port has exactly one owner;
+    two explicit claims on one port, or a range running out, exit naming the
+    nodes involved.
+    '''
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.owners = {}
+        self._next = {kind: start for kind, (start, _) in ranges.items()}
+
+    def preferred(self, kind, n):
+        '''The preferred port of the n-th port of kind, or None.'''
+        if kind not in PREFERRED_PORTS or tuple(self.ranges[kind]) != PORT_RANGES[kind]:
+            return None
+        return PREFERRED_PORTS[kind](n)
+
+    def prefer(self, port, owner):
+        '''Claim port for owner if it is valid and free; returns whether it was.'''
+        if port is None or port > 65535 or port in self.owners:
+            return False
+        self.owners[port] = owner
+        return True
+
+    def reserve(self, port, owner):
+        if port in self.owners:
+            raise SystemExit('host port collision: {} ({}, {})'.format(
+                port, self.owners[port], owner))
+        self.owners[port] = owner
+        return port
+
+    def allocate(self, kind, owner):
+        start, end = self.ranges[kind]
+        port = self._next[kind]
+        while port in self.owners:
+            port += 1
+        if port > end:
+            raise SystemExit('{} port range {}-{} is exhausted at {} (widen it with '
+                             '--port-range {}=START-END)'.format(kind, start, end, owner, kind))
+        self._next[kind] = port + 1
+        self.owners[port] = owner
+        return port
+
+
+def build_network_index(spec, domain_name, connect_domain_name=None, ranges=None):
+    '''
+    Validate a topology spec and expand it into the node index the templates
+    render from: every org with its peers, and every orderer, carrying names,
+    addresses, host ports and crypto-config paths.  Orgs are numbered from 1
+    and peers/orderers from 0 in spec order; MSP IDs and domains follow the
+    numbering, so an org's name only labels it.  Host ports keep their
+    PREFERRED_PORTS where those are free, fall back to a PortAllocator over
+    ranges (default PORT_RANGES) and are listed per node in index['port_map'].
+    '''
+    connect_domain_name = connect_domain_name or domain_name
+    # (node, key, kind, owner, explicit port or None) in allocation order
+    claims = []
+    orderers = []
+    for x, overrides in enumerate(_node_entries('orderers', spec['orderers'])):
+        orderer_name = 'orderer{}.{}'.format(x, domain_name)
+        _check_keys(orderer_name, overrides, _ORDERER_KEYS)
+        orderer = {
+            'index': x,
+            'host': 'orderer{}.{}'.format(x, connect_domain_name),
+            'dir': orderer_name,
+            'port': '7050',
+            'server_cert_path': '',
+            'client_cert_path': '',
+        }
+        orderers.append(orderer)
+        claims.append((orderer, 'host_port', 'orderer', orderer_name, overrides.get('port')))
+        claims.append((orderer, 'operations_port', 'operations', orderer_name,
+                       overrides.get('operations_port')))
+    orgs = []
+    names = set()
+    for x, entry in enumerate(spec['orgs'], 1):
+        i = str(x)
+        what = 'org {}'.format(i)
+        _check_keys(what, entry, _ORG_KEYS)
+        name = entry.get('name', 'Org' + i)
+        if not isinstance(name, str) or not _ORG_NAME.match(name):
+            raise SystemExit('{}: invalid name {!r}'.format(what, name))
+        if name in names:
+            raise SystemExit('{}: duplicate org name {}'.format(what, name))
+        names.add(name)
+        domain = 'org{}.{}'.format(i, domain_name)
+        org_dir = 'crypto-config/peerOrganizations/' + domain
+        peer_entries = _node_entries(name + ' peers', entry.get('peers', 1))
+        peers = []
+        for y, overrides in enumerate(peer_entries):
+            j = str(y)
+            peer_name = 'peer{}.{}'.format(j, domain)
+            _check_keys(peer_name, overrides, _PEER_KEYS)
+            b = overrides.get('bootstrap', 0)
+            if isinstance(b, bool) or not isinstance(b, int) or not 0 <= b < len(peer_entries):
+                raise SystemExit('{}: bootstrap must be a peer index of {}, got {!r}'.format(
+                    peer_name, name, b))
+            anchor = overrides.get('anchor', True)
+            if not isinstance(anchor, bool):
+                raise SystemExit('{}: anchor must be true or false'.format(peer_name))
+            peer = {
+                'org': i,
+                'index': j,
+                'name': peer_name,
+                'host': 'peer{}.org{}.{}'.format(j, i, connect_domain_name),
+                'address': peer_name + ':7051',
+                'bootstrap': 'peer{}.{}:7051'.format(b, domain),
+                'anchor': anchor,
+                'msp_dir': '{}/peers/{}/msp'.format(org_dir, peer_name),
+                'tls_dir': '{}/peers/{}/tls'.format(org_dir, peer_name),
+            }
+            peers.append(peer)
+            for key, kind in (('port', 'peer'), ('events_port', 'peer'),
+                              ('couchdb_port', 'couchdb'), ('operations_port', 'operations')):
+                claims.append((peer, key, kind, peer_name, overrides.get(key)))
+        if not any(peer['anchor'] for peer in peers):
+            raise SystemExit('{}: at least one peer must be an anchor peer'.format(name))
+        org = {
+            'index': i,
+            'name': name,
+            'msp_id': 'Org{}MSP'.format(i),
+            'domain': domain,
+            'msp_dir': org_dir + '/msp',
+            'peers': peers,
+        }
+        orgs.append(org)
+        claims.append((org, 'ca_port', 'ca', 'ca.' + domain, entry.get('ca_port')))
+    ports = PortAllocator(ranges or PORT_RANGES)
+    for node, key, _, owner, port in claims:
+        if port is not None:
+            node[key] = str(ports.reserve(int(_port(owner, port)), owner))
+    counts = Counter()
+    pending = []
+    for node, key, kind, owner, port in claims:
+        preferred = ports.preferred(kind, counts[kind])
+        counts[kind] += 1
+        if port is None:
+            if ports.prefer(preferred, owner):
+                node[key] = str(preferred)
+            else:
+                pending.append((node, key, kind, owner))
+    for node, key, kind, owner in pending:
+        node[key] = str(ports.allocate(kind, owner))
+    port_map = {}
+    for node, key, _, owner, _ in claims:
+        port_map.setdefault(owner, {})[key] = int(node[key])
+    return {'orgs': orgs, 'orderers': orderers,
+            'peers': [peer for org in orgs for peer in org['peers']],
+            'port_map': {'ranges': {k: list(v) for k, v in sorted(ports.ranges.items())},
+                         'nodes': port_map}}
+
+
+def allocate_ccaas_ports(dest, services):
+    '''
+    Give each CCaaS service its preferred host port (9080 upward), or one
+    from the ccaas range of the port map generate wrote to dest, stepping
+    around every port the map assigns.  Without a map the default
+    PORT_RANGES apply.
+    '''
+    try:
+        with open(os.path.join(dest, PORT_MAP_NAME)) as f:
+            port_map = json.load(f)
+    except FileNotFoundError:
+        port_map = {'ranges': {}, 'nodes': {}}
+    ports = PortAllocator(port_ranges(port_map['ranges']))
+    for owner, assigned in sorted(port_map['nodes'].items()):
+        for port in assigned.values():
+            ports.reserve(port, owner)
+    assigned = {}
+    for n, service in enumerate(services):
+        preferred = ports.preferred('ccaas', n)
+        if ports.prefer(preferred, service):
+            assigned[service] = preferred
+    for service in services:
+        if service not in assigned:
+            assigned[service] = ports.allocate('ccaas', service)
+    return {service: assigned[service] for service in services}
+
+
 class ReissueError(Exception):
     '''Raised when a leaf certificate cannot be safely reissued.'''
 
@@ -774,73 +2042,400 @@ def _node_matches(node_name, patterns):
     return False
 
 
-def discover_leaf_certs(crypto_config, kinds):
+# Certificate file suffixes picked up by the crypto-config scanner.
+_CERT_SUFFIXES = ('.pem', '.crt')
+
+# Persistent scan results, kept beside the tree as .<tree name>-index.json.
+CERT_INDEX_VERSION = 1
+
+
+def cert_index_path(crypto_config):
+    root = Path(crypto_config)
+    return root.with_name('.{}-index.json'.format(root.name))
+
+
+def _walk_files(root):
     '''
-    Walk a cryptogen-style crypto-config tree and return one entry per
-    (node, kind) leaf certificate found, where kind is 'signcert' or 'tls'.
+    Yield an os.DirEntry for every regular file under root, calling scandir
+    exactly once per directory.  Directories are visited breadth first, so a
+    file is never yielded before a shallower one.
+    '''
+    queue = deque([str(root)])
+    while queue:
+        try:
+            it = os.scandir(queue.popleft())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    queue.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def _read_digest(path):
+    data = Path(path).read_bytes()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def _key_id(cert, ext_class):
+    try:
+        value = cert.extensions.get_extension_for_class(ext_class).value
+    except x509.ExtensionNotFound:
+        return None
+    key_id = getattr(value, 'digest', None) or getattr(value, 'key_identifier', None)
+    return key_id.hex() if key_id else None
+
+
+def _cert_record(cert):
+    '''The parsed fields of cert kept in the persistent index.'''
+    return {
+        'not_after': int(_not_after(cert).timestamp()),
+        'subject': cert.subject.rfc4514_string(),
+        'issuer': cert.issuer.rfc4514_string(),
+        'ski': _key_id(cert, x509.SubjectKeyIdentifier),
+        'aki': _key_id(cert, x509.AuthorityKeyIdentifier),
+    }
+
+
+class LeafEntry(dict):
+    '''
+    A discovered leaf certificate.  The parsed 'cert' is loaded on first
+    access, so scans answered from the persistent index parse nothing.
+    '''
+
+    def __init__(self, index, **fields):
+        super(LeafEntry, self).__init__(**fields)
+        self._index = index
+
+    def __missing__(self, key):
+        if key != 'cert':
+            raise KeyError(key)
+        cert = self['cert'] = self._index.cert(self['cert_path'])
+        return cert
+
+
+class CertIndex(object):
+    '''
+    Parsed view of a crypto-config tree, built by scan_crypto_config.
+
+    files maps every certificate file to its content digest and records maps
+    each digest to its parsed fields (expiry, subject, issuer, SKI/AKI), so
+    identical copies (msp/cacerts, admincerts, ...) are parsed once.  Leaf
+    certificates are additionally indexed by org, node, kind and issuer.
+    '''
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.files = {}
+        self.records = {}
+        self.leaves = []
+        self.by_org = {}
+        self.by_node = {}
+        self.by_kind = {}
+        self.by_issuer = {}
+        self.parsed = 0
+        self._certs = {}
+
+    def cert(self, path):
+        '''The parsed certificate at path, loaded at most once per digest.'''
+        digest = self.files[Path(path)]
+        if digest not in self._certs:
+            self._certs[digest] = _load_cert(path)
+        return self._certs[digest]
+
+    def expiry(self, path):
+        not_after = self.records[self.files[Path(path)]]['not_after']
+        return datetime.fromtimestamp(not_after, timezone.utc)
+
+    def certs_in(self, directory, pattern='*'):
+        '''Parsed certificates directly inside directory, sorted by path.'''
+        directory = Path(directory)
+        return [self.cert(p) for p in sorted(self.files)
+                if p.parent == directory and p.match(pattern)]
+
+    def add_leaf(self, entry):
+        self.leaves.append(entry)
+        self.by_org.setdefault(entry['org'], []).append(entry)
+        self.by_node.setdefault(entry['node'], []).append(entry)
+        self.by_kind.setdefault(entry['kind'], []).append(entry)
+        issuer = self.records[self.files[entry['cert_path']]]['issuer']
+        self.by_issuer.setdefault(issuer, []).append(entry)
+
+    def leaf_certs(self, kinds):
+        return [e for e in self.leaves if e['kind'] in kinds]
+
+    def expiries(self):
+        '''
+        One [expiry, path] pair per unique certificate, reporting the copies
+        with the fewest path components (the CA's own dir over msp/cacerts).
+        '''
+        paths_by_digest = {}
+        for path, digest in self.files.items():
+            paths_by_digest.setdefault(digest, []).append(path)
+        k = lambda p: len(p.parts)
+        certs_info = []
+        for paths in paths_by_digest.values():
+            expiry = self.expiry(paths[0]).strftime('%Y-%m-%dT%H:%M:%SZ')
+            shortest = list(next(groupby(sorted(paths, key=k), k))[1])
+            for c in shortest:
+                certs_info.append([expiry, str(c)])
+        return sorted(certs_info)
+
+
+def _load_cert_index(path):
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(saved, dict) or saved.get('version') != CERT_INDEX_VERSION:
+        return {}
+    return saved.get('files', {})
+
+
+def _save_cert_index(path, files):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'version': CERT_INDEX_VERSION, 'files': files}, f,
+                      sort_keys=True)
+        os.replace(tmp, str(path))
+    except OSError:
+        # A read-only tree just means the next scan parses again.
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def _leaf_match(root, path):
+    '''
+    Classify path as a leaf (node_dir, kind, role) where role is 'cert' or
+    'key', or return None.  Leaves live at
+    <kind>Organizations/<org>/{peers,orderers,users}/<node>/<spec path>.
+    '''
+    parts = path.relative_to(root).parts
+    if len(parts) < 5 or not parts[0].endswith('Organizations') \
+            or parts[2] not in _NODE_PARENTS:
+        return None
+    rest = PurePosixPath(*parts[4:])
+    for kind, (cert_glob, key_glob, _) in _LEAF_SPECS.items():
+        for role, pattern in (('cert', cert_glob), ('key', key_glob)):
+            if len(rest.parts) == pattern.count('/') + 1 and rest.match(pattern):
+                return root.joinpath(*parts[:4]), kind, role
+    return None
+
+
+def _parse_record(data):
+    try:
+        cert = x509.load_pem_x509_certificate(data)
+    except ValueError:
+        # a key or stray file with a certificate suffix
+        return None, {'error': 'not a certificate'}
+    return cert, _cert_record(cert)
+
+
+# Stale certificate files read/parsed per thread-pool round while streaming.
+_SCAN_BATCH = 64
+
+
+def iter_cert_files(crypto_config, workers=None, cache=True, visit=None):
+    '''
+    Yield (path, record, cert) for every certificate file under crypto_config,
+    shallowest directories first, where record holds the fields kept in the
+    persistent index and cert is the freshly parsed certificate (None when the
+    record came from the index).  Files with a certificate suffix that do not
+    parse are recorded in the index as 'not a certificate' and skipped.
+
+    Records are persisted beside the tree (see cert_index_path) keyed by
+    (path, mtime, size, inode) - the inode catches certs swapped in by rename
+    within one mtime tick; files whose stat still matches are not read at all.
+    Everything else is read and hashed in a thread pool, _SCAN_BATCH files at a
+    time, and each new content digest is parsed exactly once, also in the pool.
+    The index is rewritten once the walk completes.  visit, if given, is
+    called with the os.DirEntry of every file walked.
     '''
     root = Path(crypto_config)
-    entries = []
-    for parent in _NODE_PARENTS:
-        for node_dir in sorted(root.glob('*Organizations/*/{}/*'.format(parent))):
-            if not node_dir.is_dir():
+    index_path = cert_index_path(root)
+    saved = _load_cert_index(index_path) if cache else {}
+    known = {rec['sha256']: rec for rec in saved.values()}
+    current = {}
+    pending = []
+
+    def flush(pool):
+        stale = [item for item in pending if item[3] is None]
+        blobs = {}
+        read = pool.map(_read_digest, [path for path, _, _, _ in stale])
+        for (_, rel, st, _), (data, digest) in zip(stale, read):
+            current[rel] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                            'ino': st.st_ino, 'sha256': digest}
+            if digest not in known:
+                blobs.setdefault(digest, data)
+        digests = list(blobs)
+        fresh = {}
+        for digest, (cert, rec) in zip(
+                digests, pool.map(_parse_record, [blobs[d] for d in digests])):
+            known[digest] = dict(rec, sha256=digest)
+            fresh[digest] = cert
+        for path, rel, _, _ in pending:
+            rec = current[rel]
+            rec.update((k, v) for k, v in known[rec['sha256']].items() if k not in rec)
+            if 'error' not in rec:
+                yield path, rec, fresh.pop(rec['sha256'], None)
+        del pending[:]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stale_count = 0
+        for entry in _walk_files(root):
+            if visit is not None:
+                visit(entry)
+            if not entry.name.endswith(_CERT_SUFFIXES):
                 continue
-            org_dir = node_dir.parent.parent
-            for kind in kinds:
-                cert_glob, key_glob, ca_subdir = _LEAF_SPECS[kind]
-                cert_paths = sorted(node_dir.glob(cert_glob))
-                if not cert_paths:
+            path = Path(entry.path)
+            st = entry.stat()
+            rel = path.relative_to(root).as_posix()
+            rec = saved.get(rel)
+            if rec is not None and rec['mtime_ns'] == st.st_mtime_ns \
+                    and rec['size'] == st.st_size and rec.get('ino') == st.st_ino:
+                current[rel] = rec
+                if not pending:
+                    if 'error' not in rec:
+                        yield path, rec, None
+                    continue
+            else:
+                rec = None
+                stale_count += 1
+            pending.append((path, rel, st, rec))
+            if stale_count >= _SCAN_BATCH:
+                yield from flush(pool)
+                stale_count = 0
+        yield from flush(pool)
+    if cache and current != saved:
+        _save_cert_index(index_path, current)
+
+
+def scan_crypto_config(crypto_config, workers=None, cache=True):
+    '''
+    Walk a crypto-config tree once (see iter_cert_files) and return its
+    CertIndex.
+    '''
+    root = Path(crypto_config)
+    index = CertIndex(root)
+    leaf_files = {}
+
+    def visit(entry):
+        path = Path(entry.path)
+        leaf = _leaf_match(root, path)
+        if leaf is not None:
+            leaf_files.setdefault(leaf, []).append(path)
+
+    for path, rec, cert in iter_cert_files(root, workers, cache, visit):
+        index.files[path] = rec['sha256']
+        index.records[rec['sha256']] = rec
+        if cert is not None:
+            index._certs[rec['sha256']] = cert
+            index.parsed += 1
+
+    order = {parent: i for i, parent in enumerate(_NODE_PARENTS)}
+    nodes = sorted({node_dir for node_dir, _, _ in leaf_files},
+                   key=lambda n: (order[n.parent.name], str(n)))
+    for node_dir in nodes:
+        org_dir = node_dir.parent.parent
+        for kind, (_, _, ca_subdir) in _LEAF_SPECS.items():
+            certs = sorted(p for p in leaf_files.get((node_dir, kind, 'cert'), ())
+                           if p in index.files)
+            if not certs:
+                continue
+            keys = sorted(leaf_files.get((node_dir, kind, 'key'), ()))
+            index.add_leaf(LeafEntry(
+                index,
+                node=node_dir.name,
+                org=org_dir.name,
+                kind=kind,
+                cert_path=certs[0],
+                key_path=keys[0] if keys else None,
+                ca_dir=org_dir / ca_subdir,
+                expiry=index.expiry(certs[0]),
+            ))
+    return index
+
+
+def discover_leaf_certs(crypto_config, kinds, index=None):
+    '''
+    Walk a cryptogen-style crypto-config tree and return one entry per
+    (node, kind) leaf certificate found, where kind is 'signcert' or 'tls'.
+    '''
+    if index is None:
+        index = scan_crypto_config(crypto_config)
+    return index.leaf_certs(kinds)
+
+
+class CAResolver(object):
+    '''
+    Resolves issuing CAs for many leaf certificates.  Each CA directory is read
+    once: its certificates are parsed (or taken from a CertIndex) and its *_sk
+    keys loaded and paired on first use, then every later lookup against that
+    directory is a dict hit.
+    '''
+
+    def __init__(self, index=None):
+        self._dirs = {}
+        self._index = index
+
+    def _load_dir(self, ca_dir):
+        loaded = self._dirs.get(ca_dir)
+        if loaded is not None:
+            return loaded
+        if self._index is not None and ca_dir.is_relative_to(self._index.root):
+            certs = self._index.certs_in(ca_dir, '*.pem')
+        else:
+            certs = []
+            for c in sorted(ca_dir.glob('*.pem')):
+                try:
+                    certs.append(_load_cert(c))
+                except ValueError:
                     continue
-                cert_path = cert_paths[0]
-                cert = _load_cert(cert_path)
-                entries.append({
-                    'node': node_dir.name,
-                    'org': org_dir.name,
-                    'kind': kind,
-                    'cert_path': cert_path,
-                    'cert': cert,
-                    'key_path': next(iter(sorted(node_dir.glob(key_glob))), None),
-                    'ca_dir': org_dir / ca_subdir,
-                    'expiry': _not_after(cert),
-                })
-    return entries
+        keys = {}
+        for k in sorted(ca_dir.glob('*_sk')):
+            try:
+                key = load_pem_private_key(k.read_bytes(), password=None)
+            except Exception:
+                continue
+            keys.setdefault(_pub_der(key.public_key()), key)
+        loaded = self._dirs[ca_dir] = (certs, keys)
+        return loaded
+
+    def resolve(self, ca_dir, leaf_cert):
+        '''
+        Locate the CA certificate that issued leaf_cert (matched by issuer name)
+        and its paired private key inside ca_dir. Raises ReissueError if either
+        is missing - notably when only the CA cert (not its key) is on the
+        filesystem, as with fabric-ca issued material.
+        '''
+        ca_dir = Path(ca_dir)
+        if not ca_dir.is_dir():
+            raise ReissueError('CA directory not found: {}'.format(ca_dir))
+        certs, keys = self._load_dir(ca_dir)
+        ca_cert = next((c for c in certs if c.subject == leaf_cert.issuer), None)
+        if ca_cert is None:
+            raise ReissueError(
+                'no CA certificate in {} matches issuer {}'.format(
+                    ca_dir, leaf_cert.issuer.rfc4514_string()))
+        ca_key = keys.get(_pub_der(ca_cert.public_key()))
+        if ca_key is None:
+            raise ReissueError(
+                'no CA private key (*_sk) in {} pairs with the CA certificate - '
+                'the CA key is not on this filesystem (fabric-ca material must use '
+                'fabric-ca-client reenroll)'.format(ca_dir))
+        return ca_cert, ca_key
 
 
 def resolve_ca(ca_dir, leaf_cert):
     '''
-    Locate the CA certificate that issued leaf_cert (matched by issuer name) and
-    its paired private key inside ca_dir. Raises ReissueError if either is
-    missing - notably when only the CA cert (not its key) is on the filesystem,
-    as with fabric-ca issued material.
-    '''
-    ca_dir = Path(ca_dir)
-    if not ca_dir.is_dir():
-        raise ReissueError('CA directory not found: {}'.format(ca_dir))
-    ca_cert = None
-    for c in sorted(ca_dir.glob('*.pem')):
-        candidate = _load_cert(c)
-        if candidate.subject == leaf_cert.issuer:
-            ca_cert = candidate
-            break
-    if ca_cert is None:
-        raise ReissueError(
-            'no CA certificate in {} matches issuer {}'.format(
-                ca_dir, leaf_cert.issuer.rfc4514_string()))
-    ca_key = None
-    for k in sorted(ca_dir.glob('*_sk')):
-        try:
-            candidate = load_pem_private_key(k.read_bytes(), password=None)
-        except Exception:
-            continue
-        if _pub_der(candidate.public_key()) == _pub_der(ca_cert.public_key()):
-            ca_key = candidate
-            break
-    if ca_key is None:
-        raise ReissueError(
-            'no CA private key (*_sk) in {} pairs with the CA certificate - '
-            'the CA key is not on this filesystem (fabric-ca material must use '
-            'fabric-ca-client reenroll)'.format(ca_dir))
-    return ca_cert, ca_key
+    Locate the CA certificate that issued leaf_cert and its paired private key
+    inside ca_dir.  See CAResolver.resolve.
+    '''
+    return CAResolver().resolve(ca_dir, leaf_cert)
 
 
 def build_reissued_cert(old_cert, ca_cert, ca_key, not_after):
@@ -880,42 +2475,1395 @@ def _backup_path(cert_path):
     return bak
 
 
-def cert_expiries(path):
-    p = Path(path)
-    certs = list(p.glob('**/*.pem')) + list(p.glob('**/*.crt'))
-
-    date_in_fmt = '%Y%m%d%H%M%SZ'
-    date_out_fmt = '%Y-%m-%dT%H:%M:%SZ'
-
-    # group cert files by their md5 hash
-    certs_by_hashes = dict()
-    for c in certs:
-        cert_bytes = c.read_bytes()
-        h = hashlib.md5()
-        h.update(cert_bytes)
-        md5 = h.hexdigest()
-        x509 = load_certificate(FILETYPE_PEM, cert_bytes)
-        cert_expiry = x509.get_notAfter().decode()
-        if md5 not in certs_by_hashes:
-            certs_by_hashes[md5] = {
-                'paths': list(),
-                'expiry': datetime.strptime(cert_expiry, date_in_fmt).strftime(date_out_fmt)
-            }
-            certs_by_hashes[md5]['paths'].append(c)
+def sign_all(plans, jobs=None):
+    '''
+    Re-sign every planned certificate, fanning the signatures out to a thread
+    pool.  Stores the new PEM bytes on each plan under 'new_bytes'.
+    '''
+    def sign(p):
+        return build_reissued_cert(p['entry']['cert'], p['ca_cert'], p['ca_key'],
+                                   p['not_after'])
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        for p, new_bytes in zip(plans, pool.map(sign, plans)):
+            p['new_bytes'] = new_bytes
+
+
+def _stage_file(path, data):
+    '''
+    Write data to a temp file beside path, carrying over path's mode and (where
+    permitted) ownership, and return the temp path for a later os.replace.
+    '''
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.{}.'.format(path.name))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if path.exists():
+            st = path.stat()
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def write_reissued(plans, backup=True):
+    '''
+    Replace every planned certificate in bulk.  All new contents are staged to
+    temp files first, so a failure while writing leaves every original cert in
+    place; each one is then swapped in with an atomic rename.
+    '''
+    staged = []
+    try:
+        for p in plans:
+            staged.append(_stage_file(p['entry']['cert_path'], p['new_bytes']))
+    except BaseException:
+        for tmp in staged:
+            os.unlink(tmp)
+        raise
+    for p, tmp in zip(plans, staged):
+        cert_path = p['entry']['cert_path']
+        if backup:
+            shutil.copy2(str(cert_path), str(_backup_path(cert_path)))
+        os.replace(tmp, str(cert_path))
+
+
+def cert_expiries(path, index=None):
+    if index is None:
+        index = scan_crypto_config(path)
+    return index.expiries()
+
+
+# Columns of the machine-readable cert_expiries / reissue records.
+CERT_RECORD_FIELDS = ('path', 'org', 'node', 'kind', 'subject', 'issuer',
+                      'expiry', 'days_remaining')
+REISSUE_RECORD_FIELDS = CERT_RECORD_FIELDS + (
+    'expired', 'selected', 'result', 'new_expiry', 'error')
+
+# MSP sub-directory -> kind reported for the certificates inside it
+_MSP_KINDS = {
+    'cacerts': 'ca',
+    'tlscacerts': 'tlsca',
+    'intermediatecerts': 'intermediateca',
+    'tlsintermediatecerts': 'tlsintermediateca',
+    'admincerts': 'admincert',
+    'signcerts': 'signcert',
+}
+
 
-    k = lambda p: len(p.parts)
+def add_record_args(parser):
+    parser.add_argument('--format', choices=['text', 'json', 'ndjson', 'csv'],
+                        default='text',
+                        help='output format; ndjson streams one record per cert '
+                             '(default: text)')
+    parser.add_argument('--expiring-within', type=int, default=None,
+                        metavar='DAYS', dest='expiring_within',
+                        help='only report certs expiring within DAYS days '
+                             '(expired certs included)')
+
+
+def cert_location(root, path):
+    '''
+    Return (org, node, kind) for a certificate file in a crypto-config tree.
+    node is None for org-level material (ca/, tlsca/, msp/).
+    '''
+    parts = Path(path).relative_to(root).parts
+    org = parts[1] if len(parts) > 2 else None
+    node = parts[3] if len(parts) > 4 and parts[2] in _NODE_PARENTS else None
+    leaf = _leaf_match(Path(root), Path(path))
+    if leaf is not None:
+        kind = leaf[1]
+    elif len(parts) > 2 and parts[2] in ('ca', 'tlsca'):
+        kind = parts[2]
+    elif len(parts) > 1 and parts[-2] == 'tls':
+        kind = 'tlsca' if parts[-1] == 'ca.crt' else 'tls'
+    else:
+        kind = _MSP_KINDS.get(parts[-2] if len(parts) > 1 else '', 'other')
+    return org, node, kind
+
+
+def cert_record(root, path, rec, now):
+    '''The machine-readable record for one certificate file.'''
+    org, node, kind = cert_location(root, path)
+    not_after = datetime.fromtimestamp(rec['not_after'], timezone.utc)
+    return {
+        'path': str(path),
+        'org': org,
+        'node': node,
+        'kind': kind,
+        'subject': rec['subject'],
+        'issuer': rec['issuer'],
+        'expiry': not_after.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'days_remaining': int((rec['not_after'] - now.timestamp()) // 86400),
+    }
+
+
+def stream_cert_records(crypto_config, now, expiring_within=None, cache=True):
+    '''
+    Yield a record per unique certificate as the scan discovers it, keeping
+    the same shallowest copies as cert_expiries (the walk is breadth first,
+    so the first copy of a digest seen is at the shallowest depth).  With
+    expiring_within, certs expiring later than that many days are dropped.
+    '''
+    root = Path(crypto_config)
+    cutoff = None
+    if expiring_within is not None:
+        cutoff = now.timestamp() + expiring_within * 86400
+    depths = {}
+    for path, rec, _ in iter_cert_files(root, cache=cache):
+        depth = len(path.parts)
+        if depths.setdefault(rec['sha256'], depth) != depth:
+            continue
+        if cutoff is not None and rec['not_after'] > cutoff:
+            continue
+        yield cert_record(root, path, rec, now)
+
+
+class RecordWriter(object):
+    '''
+    Writes dict records to out as they arrive: a single JSON array, NDJSON
+    (one object per line, flushed) or CSV with a header row.
+    '''
+
+    def __init__(self, fmt, fields, out=None):
+        self.fmt = fmt
+        self.fields = fields
+        self.out = out if out is not None else sys.stdout
+        self.count = 0
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(self.out, fieldnames=fields,
+                                       extrasaction='ignore', lineterminator='\n')
+            self._csv.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self._csv.writerow(record)
+        else:
+            line = json.dumps({k: record.get(k) for k in self.fields})
+            if self.fmt == 'json':
+                self.out.write(('[\n' if not self.count else ',\n') + line)
+            else:
+                self.out.write(line + '\n')
+                self.out.flush()
+        self.count += 1
+
+    def close(self):
+        if self.fmt == 'json':
+            self.out.write('\n]\n' if self.count else '[]\n')
+        self.out.flush()
+
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _metric_label(value):
+    value = '' if value is None else str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_cert_metrics(index, now):
+    '''
+    OpenMetrics exposition for a CertIndex: the expiry of every leaf cert and
+    of each org's ca/ and tlsca/ certificates.
+    '''
+    samples = []
+    for e in index.leaves:
+        samples.append((e['org'], e['node'], e['kind'], e['cert_path']))
+    for path in index.files:
+        parts = path.relative_to(index.root).parts
+        if len(parts) == 4 and parts[2] in ('ca', 'tlsca'):
+            samples.append((parts[1], None, parts[2], path))
+    lines = [
+        '# TYPE fabric_cert_not_after_seconds gauge',
+        '# UNIT fabric_cert_not_after_seconds seconds',
+        '# HELP fabric_cert_not_after_seconds Certificate expiry (notAfter) as a unix timestamp.',
+    ]
+    for org, node, kind, path in sorted(samples, key=lambda s: str(s[3])):
+        rec = index.records[index.files[path]]
+        lines.append('fabric_cert_not_after_seconds{{org="{}",node="{}",kind="{}"}} {}'.format(
+            _metric_label(org), _metric_label(node), _metric_label(kind),
+            rec['not_after']))
+    lines += [
+        '# TYPE fabric_cert_index_refresh_timestamp_seconds gauge',
+        '# UNIT fabric_cert_index_refresh_timestamp_seconds seconds',
+        '# HELP fabric_cert_index_refresh_timestamp_seconds When the crypto-config tree was last polled.',
+        'fabric_cert_index_refresh_timestamp_seconds {:.3f}'.format(now.timestamp()),
+        '# TYPE fabric_cert_index_files gauge',
+        '# HELP fabric_cert_index_files Certificate files found by the last poll.',
+        'fabric_cert_index_files {}'.format(len(index.files)),
+        '# EOF',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+class CertMetrics(object):
+    '''
+    Keeps a rendered OpenMetrics exposition of a crypto-config tree current
+    by polling it; see Network.metrics.
+    '''
 
-    # for each cert hash, take the matching paths with shortest component length
-    # and store them as a tuple with the cert's expiration date
-    certs_info = []
-    for certs_group in certs_by_hashes.values():
-        paths = sorted(certs_group['paths'], key=k)
-        shortest = list(next(groupby(paths, k))[1])
-        expiry = certs_group['expiry']
-        for c in shortest:
-            certs_info.append([expiry, str(c)])
+    def __init__(self, crypto_config):
+        self.crypto_config = crypto_config
+        self.body = ''
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def refresh(self):
+        index = scan_crypto_config(self.crypto_config)
+        body = render_cert_metrics(index, datetime.now(timezone.utc))
+        with self._lock:
+            self.body = body
+        return index
+
+    def _poll(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception as err:
+                print('metrics refresh failed: {}'.format(err), file=sys.stderr)
+
+    def serve(self, host, port, interval):
+        '''Start polling and return an HTTP server (not yet serving).'''
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                with exporter._lock:
+                    body = exporter.body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._poll, args=(interval,), daemon=True).start()
+        return server
+
+    def stop(self):
+        self._stopped.set()
+
+
+# Defaults cryptogen applies to every CA subject.
+_CA_COUNTRY = 'US'
+_CA_PROVINCE = 'California'
+_CA_LOCALITY = 'San Francisco'
+
+# cryptogen issues CA and leaf certificates valid for ten years.
+_CRYPTO_VALIDITY = timedelta(days=3650)
+
+_NODE_OUS_CONFIG = """NodeOUs:
+  Enable: true
+  ClientOUIdentifier:
+    Certificate: cacerts/{ca}
+    OrganizationalUnitIdentifier: client
+  PeerOUIdentifier:
+    Certificate: cacerts/{ca}
+    OrganizationalUnitIdentifier: peer
+  AdminOUIdentifier:
+    Certificate: cacerts/{ca}
+    OrganizationalUnitIdentifier: admin
+  OrdererOUIdentifier:
+    Certificate: cacerts/{ca}
+    OrganizationalUnitIdentifier: orderer
+"""
+
+
+def _go_template(text, data):
+    '''Render the {{.Field}} subset of Go templates used in crypto-config.yaml.'''
+    def field(m):
+        return str(data[m.group(1)])
+    return re.sub(r'{{\s*\.(\w+)\s*}}', field, text)
+
+
+def _render_node_spec(spec, domain, prefix, index=None):
+    data = {'Prefix': prefix, 'Index': index, 'Domain': domain,
+            'Hostname': spec.get('Hostname', '')}
+    hostname = _go_template(spec.get('Hostname', ''), data)
+    data['Hostname'] = hostname
+    common_name = _go_template(spec.get('CommonName') or '{{.Hostname}}.{{.Domain}}', data)
+    data['CommonName'] = common_name
+    sans = []
+    for san in [common_name, hostname] + [_go_template(s, data) for s in spec.get('SANS') or []]:
+        if san not in sans:
+            sans.append(san)
+    return {'hostname': hostname, 'common_name': common_name, 'sans': sans}
+
+
+def load_crypto_config(path):
+    '''
+    Parse a cryptogen crypto-config.yaml into a list of org specs, expanding
+    Template and Specs sections into concrete node names the way cryptogen does.
+    '''
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    orgs = []
+    for kind, key, prefix in (('orderer', 'OrdererOrgs', 'orderer'),
+                              ('peer', 'PeerOrgs', 'peer')):
+        for org in config.get(key) or []:
+            domain = org['Domain']
+            nodes = [_render_node_spec(spec, domain, prefix)
+                     for spec in org.get('Specs') or []]
+            template = org.get('Template') or {}
+            start = template.get('Start', 0)
+            for i in range(start, start + template.get('Count', 0)):
+                spec = {'Hostname': template.get('Hostname') or '{{.Prefix}}{{.Index}}',
+                        'SANS': template.get('SANS')}
+                nodes.append(_render_node_spec(spec, domain, prefix, i))
+            user_count = (org.get('Users') or {}).get('Count', 0)
+            orgs.append({
+                'kind': kind,
+                'name': org['Name'],
+                'domain': domain,
+                'node_ous': bool(org.get('EnableNodeOUs', False)),
+                'ca_hostname': (org.get('CA') or {}).get('Hostname') or 'ca',
+                'nodes': nodes,
+                'users': ['User{}@{}'.format(i, domain) for i in range(1, user_count + 1)],
+            })
+    return orgs
+
+
+def _ski(public_key):
+    # cryptogen derives the SKI from the SHA-256 of the uncompressed EC point.
+    raw = public_key.public_bytes(serialization.Encoding.X962,
+                                  serialization.PublicFormat.UncompressedPoint)
+    return hashlib.sha256(raw).digest()
+
+
+def _ca_subject(org_name, common_name):
+    return x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, _CA_COUNTRY),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, _CA_PROVINCE),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, _CA_LOCALITY),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, org_name),
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+    ])
+
+
+def _leaf_subject(common_name, ou=None):
+    attrs = [
+        x509.NameAttribute(NameOID.COUNTRY_NAME, _CA_COUNTRY),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, _CA_PROVINCE),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, _CA_LOCALITY),
+    ]
+    if ou:
+        attrs.append(x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, ou))
+    attrs.append(x509.NameAttribute(NameOID.COMMON_NAME, common_name))
+    return x509.Name(attrs)
+
+
+def _key_usage(digital_signature=False, key_encipherment=False, cert_sign=False):
+    return x509.KeyUsage(
+        digital_signature=digital_signature, content_commitment=False,
+        key_encipherment=key_encipherment, data_encipherment=False,
+        key_agreement=False, key_cert_sign=cert_sign, crl_sign=cert_sign,
+        encipher_only=False, decipher_only=False)
+
+
+_AUTH_EKU = x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH,
+                                   ExtendedKeyUsageOID.SERVER_AUTH])
+
+
+def _cert_builder(subject, issuer, public_key, now):
+    return (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer)
+        .public_key(public_key)
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + _CRYPTO_VALIDITY)
+    )
+
+
+def _write_pem(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _key_pem(key):
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def _cert_pem(cert):
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+def _new_ca(ca_dir, org_name, common_name, now):
+    '''Create a self-signed CA in ca_dir, or load the one already there.'''
+    cert_path = ca_dir / '{}-cert.pem'.format(common_name)
+    key_path = ca_dir / 'priv_sk'
+    if cert_path.exists() and key_path.exists():
+        return (load_pem_private_key(key_path.read_bytes(), password=None),
+                _load_cert(cert_path))
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = _ca_subject(org_name, common_name)
+    cert = (
+        _cert_builder(subject, subject, key.public_key(), now)
+        .add_extension(_key_usage(digital_signature=True, key_encipherment=True,
+                                  cert_sign=True), critical=True)
+        .add_extension(_AUTH_EKU, critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier(_ski(key.public_key())), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    _write_pem(key_path, _key_pem(key))
+    _write_pem(cert_path, _cert_pem(cert))
+    return key, cert
+
+
+def _sign_leaf(ca, common_name, now, ou=None, sans=None, tls=False):
+    ca_key, ca_cert = ca
+    key = ec.generate_private_key(ec.SECP256R1())
+    builder = (
+        _cert_builder(_leaf_subject(common_name, ou), ca_cert.subject, key.public_key(), now)
+        .add_extension(_key_usage(digital_signature=True, key_encipherment=tls),
+                       critical=True)
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.AuthorityKeyIdentifier(_ski(ca_cert.public_key()), None, None),
+                       critical=False)
+    )
+    if tls:
+        builder = builder.add_extension(_AUTH_EKU, critical=False)
+    if sans:
+        names = []
+        for san in sans:
+            try:
+                names.append(x509.IPAddress(ipaddress.ip_address(san)))
+            except ValueError:
+                names.append(x509.DNSName(san))
+        builder = builder.add_extension(x509.SubjectAlternativeName(names), critical=False)
+    return key, builder.sign(ca_key, hashes.SHA256())
+
+
+def _write_verifying_msp(msp_dir, ca_cert, tlsca_cert, node_ous):
+    ca_name = '{}-cert.pem'.format(ca_cert.subject.get_attributes_for_oid(
+        NameOID.COMMON_NAME)[0].value)
+    tlsca_name = '{}-cert.pem'.format(tlsca_cert.subject.get_attributes_for_oid(
+        NameOID.COMMON_NAME)[0].value)
+    (msp_dir / 'admincerts').mkdir(parents=True, exist_ok=True)
+    _write_pem(msp_dir / 'cacerts' / ca_name, _cert_pem(ca_cert))
+    _write_pem(msp_dir / 'tlscacerts' / tlsca_name, _cert_pem(tlsca_cert))
+    if node_ous:
+        (msp_dir / 'config.yaml').write_text(_NODE_OUS_CONFIG.format(ca=ca_name))
+
+
+def _write_local_msp(node_dir, common_name, sans, ca, tlsca, ou, node_ous, client):
+    '''Write a node's msp/ and tls/ directories, mirroring cryptogen's layout.'''
+    now = datetime.now(timezone.utc)
+    msp_dir = node_dir / 'msp'
+    _write_verifying_msp(msp_dir, ca[1], tlsca[1], node_ous)
+    sign_key, sign_cert = _sign_leaf(ca, common_name, now, ou=ou if node_ous else None)
+    _write_pem(msp_dir / 'keystore' / 'priv_sk', _key_pem(sign_key))
+    _write_pem(msp_dir / 'signcerts' / '{}-cert.pem'.format(common_name), _cert_pem(sign_cert))
+    tls_key, tls_cert = _sign_leaf(tlsca, common_name, now, sans=sans, tls=True)
+    tls_dir = node_dir / 'tls'
+    prefix = 'client' if client else 'server'
+    _write_pem(tls_dir / 'ca.crt', _cert_pem(tlsca[1]))
+    _write_pem(tls_dir / '{}.crt'.format(prefix), _cert_pem(tls_cert))
+    _write_pem(tls_dir / '{}.key'.format(prefix), _key_pem(tls_key))
+    return sign_cert
+
+
+def _generate_org_material(org, output_dir):
+    '''
+    Generate (or extend) the crypto material for one org.  Runs in a worker
+    process, so it takes and returns plain data only.  Nodes and users that
+    already have a signing cert are left untouched, as with cryptogen extend.
+    '''
+    now = datetime.now(timezone.utc)
+    domain = org['domain']
+    org_dir = Path(output_dir) / '{}Organizations'.format(org['kind']) / domain
+    ca = _new_ca(org_dir / 'ca', domain, '{}.{}'.format(org['ca_hostname'], domain), now)
+    tlsca = _new_ca(org_dir / 'tlsca', domain, 'tlsca.{}'.format(domain), now)
+    node_ous = org['node_ous']
+    created = 0
+
+    def missing(node_dir):
+        return not any((node_dir / 'msp' / 'signcerts').glob('*.pem'))
+
+    admin_cn = 'Admin@{}'.format(domain)
+    admin_dir = org_dir / 'users' / admin_cn
+    if missing(admin_dir):
+        _write_local_msp(admin_dir, admin_cn, None, ca, tlsca, 'admin', node_ous, client=True)
+        created += 1
+    admin_cert = _load_cert(admin_dir / 'msp' / 'signcerts' / '{}-cert.pem'.format(admin_cn))
+    for user_cn in org['users']:
+        user_dir = org_dir / 'users' / user_cn
+        if missing(user_dir):
+            _write_local_msp(user_dir, user_cn, None, ca, tlsca, 'client', node_ous, client=True)
+            created += 1
+
+    nodes_dir = org_dir / ('orderers' if org['kind'] == 'orderer' else 'peers')
+    admin_targets = [org_dir / 'msp']
+    for node in org['nodes']:
+        node_dir = nodes_dir / node['common_name']
+        admin_targets.append(node_dir / 'msp')
+        if missing(node_dir):
+            _write_local_msp(node_dir, node['common_name'], node['sans'], ca, tlsca,
+                             org['kind'], node_ous, client=False)
+            created += 1
+
+    _write_verifying_msp(org_dir / 'msp', ca[1], tlsca[1], node_ous)
+    if not node_ous:
+        # Without NodeOUs admins are recognised by their cert in admincerts.
+        for msp_dir in admin_targets:
+            _write_pem(msp_dir / 'admincerts' / '{}-cert.pem'.format(admin_cn),
+                       _cert_pem(admin_cert))
+    return org['name'], created
+
+
+def generate_crypto_material(config_path, output_dir, workers=None):
+    '''
+    Native replacement for `cryptogen generate|extend`: build the crypto-config
+    tree described by config_path under output_dir.  Orgs are independent, so
+    each one is generated in its own worker process.  Existing orgs and nodes
+    are reused, which makes this serve `extend` as well.
+    '''
+    orgs = load_crypto_config(config_path)
+    if not orgs:
+        return {}
+    workers = workers or min(len(orgs), os.cpu_count() or 1)
+    results = {}
+    if workers == 1:
+        for org in orgs:
+            name, created = _generate_org_material(org, output_dir)
+            results[name] = created
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_generate_org_material, org, output_dir) for org in orgs]
+        for future in futures:
+            name, created = future.result()
+            results[name] = created
+    return results
+
+
+class LifecycleError(Exception):
+    '''Raised when a peer CLI command run through the cli container fails.'''
+
+
+def load_script_vars(path):
+    '''
+    Read the topology rendered into scripts/variables.sh: DOMAIN_NAME,
+    ENDORSEMENT_POLICY (strings) and ORG_INDICES, PEER_INDICES, ORG_PEERS
+    (lists).
+    '''
+    found = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r'^(\w+)=(.*)$', line.strip())
+            if not m:
+                continue
+            name, value = m.groups()
+            if value.startswith('('):
+                found[name] = value.strip('()').split()
+            else:
+                found[name] = shlex.split(value)[0] if value else ''
+    return found
+
+
+def _docker_exec(container, env, argv):
+    cmd = ['docker', 'exec']
+    for k, v in sorted(env.items()):
+        cmd.extend(('-e', '{}={}'.format(k, v)))
+    proc = subprocess.run(cmd + [container] + list(argv),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc.returncode, proc.stdout.decode(), proc.stderr.decode()
+
+
+class FabricCLI(object):
+    '''
+    Runs `peer` commands in the cli container as any peer.  The environment
+    setGlobals in luther_utils.sh exports is computed once per peer up front
+    and handed to docker exec, so no helper scripts or subshells are involved.
+
+    runner(env, argv) -> (returncode, stdout, stderr) may be swapped out; it
+    defaults to `docker exec` into container.
+    '''
+
+    def __init__(self, script_vars, container='cli', runner=None):
+        self.domain = script_vars['DOMAIN_NAME']
+        self.orgs = list(script_vars['ORG_INDICES'])
+        self.peers = list(script_vars['PEER_INDICES'])
+        # ORG_PEERS lists each org's own peers; older variables.sh files
+        # predate it and describe uniform orgs.
+        pairs = script_vars.get('ORG_PEERS') or [
+            '{}:{}'.format(org, peer) for org in self.orgs for peer in self.peers]
+        self._all_peers = [tuple(reversed(pair.split(':', 1))) for pair in pairs]
+        self.policy = script_vars['ENDORSEMENT_POLICY']
+        self.orderer = 'orderer0.{}:7050'.format(self.domain)
+        self.orderer_ca = ('/crypto-config/ordererOrganizations/{0}/orderers/orderer0.{0}'
+                           '/msp/tlscacerts/tlsca.{0}-cert.pem'.format(self.domain))
+        self.env = {(peer, org): self._peer_env(peer, org)
+                    for peer, org in self._all_peers}
+        if runner is None:
+            runner = functools.partial(_docker_exec, container)
+        self._runner = runner
+        self._installed = {}
+
+    def _peer_env(self, peer, org):
+        org_dir = '/crypto-config/peerOrganizations/org{}.{}'.format(org, self.domain)
+        tls_dir = '{}/peers/{}/tls'.format(org_dir, self.peer_name(peer, org))
+        return {
+            'CORE_PEER_LOCALMSPID': self.msp_id(org),
+            'CORE_PEER_MSPCONFIGPATH': '{}/users/Admin@org{}.{}/msp'.format(
+                org_dir, org, self.domain),
+            'CORE_PEER_ADDRESS': self.peer_address(peer, org),
+            'CORE_PEER_TLS_CERT_FILE': tls_dir + '/server.crt',
+            'CORE_PEER_TLS_KEY_FILE': tls_dir + '/server.key',
+            'CORE_PEER_TLS_ROOTCERT_FILE': tls_dir + '/ca.crt',
+            'CORE_PEER_TLS_CLIENTCERT_FILE': tls_dir + '/server.crt',
+            'CORE_PEER_TLS_CLIENTKEY_FILE': tls_dir + '/server.key',
+            'CORE_PEER_TLS_CLIENTAUTHREQUIRED': 'true',
+        }
+
+    def peer_name(self, peer, org):
+        return 'peer{}.org{}.{}'.format(peer, org, self.domain)
+
+    def peer_address(self, peer, org):
+        return self.peer_name(peer, org) + ':7051'
+
+    def msp_id(self, org):
+        return 'Org{}MSP'.format(org)
+
+    def first_peer(self):
+        return self.peers[0]
+
+    def all_peers(self):
+        return list(self._all_peers)
+
+    def run(self, peer, org, argv):
+        '''Run argv as peer{peer}.org{org}; return stdout or raise LifecycleError.'''
+        code, out, err = self._runner(self.env[(peer, org)], argv)
+        if code != 0:
+            detail = (err or out).strip().splitlines()
+            raise LifecycleError('{} on {}: {}'.format(
+                ' '.join(argv[:4]), self.peer_name(peer, org),
+                detail[-1] if detail else 'exit status {}'.format(code)))
+        return out
+
+    def _orderer_args(self, peer, org):
+        env = self.env[(peer, org)]
+        return ['--tls', '--cafile', self.orderer_ca, '--orderer', self.orderer,
+                '--clientauth', '--certfile', env['CORE_PEER_TLS_CERT_FILE'],
+                '--keyfile', env['CORE_PEER_TLS_KEY_FILE']]
+
+    def _definition_args(self, channel, name, version, sequence, init_required):
+        args = ['--channelID', channel, '--name', name, '--version', version,
+                '--collections-config', '/collections.json',
+                '--signature-policy', self.policy, '--sequence', str(sequence)]
+        if init_required:
+            args.append('--init-required')
+        return args
+
+    def join(self, peer, org, channel):
+        self.run(peer, org, ['peer', 'channel', 'join', '-b', '{}.block'.format(channel)])
+
+    def update_anchor_peer(self, peer, org, channel):
+        self.run(peer, org, ['peer', 'channel', 'update', '-o', self.orderer, '-c', channel,
+                             '-f', '/channel-artifacts/{}anchors.tx'.format(self.msp_id(org)),
+                             '--tls', 'true', '--cafile', self.orderer_ca, '--clientauth',
+                             '--certfile', self.env[(peer, org)]['CORE_PEER_TLS_CERT_FILE'],
+                             '--keyfile', self.env[(peer, org)]['CORE_PEER_TLS_KEY_FILE']])
+
+    def query_installed(self, peer, org, refresh=False):
+        '''
+        Map of installed package label -> package ID on a peer.  Answers are
+        kept until install() changes the peer, so later phases reuse them.
+        '''
+        if refresh or (peer, org) not in self._installed:
+            out = self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'queryinstalled',
+                                       '-O', 'json'])
+            installed = json.loads(out or '{}').get('installed_chaincodes') or []
+            self._installed[(peer, org)] = {cc['label']: cc['package_id'] for cc in installed}
+        return dict(self._installed[(peer, org)])
+
+    def install(self, peer, org, package_path):
+        self._installed.pop((peer, org), None)
+        self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'install', package_path])
+
+    def query_committed(self, peer, org, channel, name):
+        '''The committed definition of name on channel, or None if there is none.'''
+        try:
+            out = self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'querycommitted',
+                                       '--channelID', channel, '--name', name,
+                                       '--output', 'json'])
+        except LifecycleError:
+            return None
+        return json.loads(out) if out.strip() else None
+
+    def check_commit_readiness(self, peer, org, channel, name, version, sequence,
+                               init_required=False):
+        '''Map of MSP ID -> approved for the given definition.'''
+        out = self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'checkcommitreadiness']
+                       + self._definition_args(channel, name, version, sequence,
+                                               init_required)
+                       + ['--output', 'json'])
+        return json.loads(out).get('approvals', {})
+
+    def approve(self, peer, org, channel, name, version, sequence, package_id,
+                init_required=False):
+        self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'approveformyorg']
+                 + self._orderer_args(peer, org)
+                 + self._definition_args(channel, name, version, sequence, init_required)
+                 + ['--package-id', package_id])
+
+    def commit(self, channel, name, version, sequence, init_required=False):
+        peer, org = self.first_peer(), self.orgs[0]
+        endorsers = []
+        for o in self.orgs:
+            endorsers.extend(('--peerAddresses', self.peer_address(self.first_peer(), o),
+                              '--tlsRootCertFiles',
+                              self.env[(self.first_peer(), o)]['CORE_PEER_TLS_ROOTCERT_FILE']))
+        self.run(peer, org, ['peer', 'lifecycle', 'chaincode', 'commit'] + endorsers
+                 + self._orderer_args(peer, org)
+                 + self._definition_args(channel, name, version, sequence, init_required))
+
+
+def wait_until(check, deadline=30.0, initial=0.05, max_delay=2.0):
+    '''
+    Call check() until it returns a true value, backing off exponentially from
+    initial seconds up to max_delay between attempts and giving up once
+    deadline seconds have passed; LifecycleErrors count as not ready.  Returns
+    (ready, seconds waited).
+    '''
+    start = time.monotonic()
+    delay = initial
+    while True:
+        try:
+            if check():
+                return True, time.monotonic() - start
+        except LifecycleError:
+            pass
+        elapsed = time.monotonic() - start
+        if elapsed + delay > deadline:
+            return False, elapsed
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def retry(fn, deadline=60.0, initial=0.05, max_delay=2.0, jitter=0.5):
+    '''
+    Call fn() until it stops raising LifecycleError, sleeping a jittered,
+    exponentially growing delay (each scaled by a random factor in
+    [1 - jitter, 1 + jitter]) between attempts.  Returns (value, attempts);
+    once deadline seconds have passed the last error is re-raised with the
+    attempt count.
+    '''
+    start = time.monotonic()
+    delay = initial
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return fn(), attempts
+        except LifecycleError as err:
+            pause = delay * random.uniform(1 - jitter, 1 + jitter)
+            if time.monotonic() - start + pause > deadline:
+                raise LifecycleError('{} (gave up after {} attempts)'.format(err, attempts))
+        time.sleep(pause)
+        delay = min(delay * 2, max_delay)
+
+
+class LifecycleReport(object):
+    '''Per-target outcome and duration of every lifecycle step.'''
+
+    def __init__(self):
+        self.results = []
+        self._lock = threading.Lock()
+
+    def step(self, step, target, fn, *args, group=None):
+        '''
+        Run fn(*args), recording its outcome under step (and group, e.g. the
+        chaincode it belongs to); returns (ok, value).
+        '''
+        start = time.monotonic()
+        try:
+            value, ok = fn(*args), True
+            detail = value if isinstance(value, str) else ''
+        except LifecycleError as err:
+            value, ok, detail = None, False, str(err)
+        result = {'step': step, 'target': target, 'group': group, 'ok': ok,
+                  'seconds': time.monotonic() - start, 'detail': detail}
+        with self._lock:
+            self.results.append(result)
+        print('  {:<8} {:<40} {:<6} {:6.2f}s {}'.format(
+            step, target, 'ok' if ok else 'FAILED', result['seconds'], detail))
+        return ok, value
+
+    def failures(self):
+        return [r for r in self.results if not r['ok']]
+
+    def group_summary(self):
+        '''One line per group: status, busy time per step and in total.'''
+        groups = []
+        for r in self.results:
+            if r['group'] is not None and r['group'] not in groups:
+                groups.append(r['group'])
+        lines = []
+        for group in groups:
+            rs = [r for r in self.results if r['group'] == group]
+            failed = next((r['step'] for r in rs if not r['ok']), None)
+            steps = []
+            for r in rs:
+                if r['step'] not in steps:
+                    steps.append(r['step'])
+            lines.append('{:<24} {:<18} {:>8.2f}s  {}'.format(
+                group, 'FAILED at ' + failed if failed else 'ok',
+                sum(r['seconds'] for r in rs),
+                ' '.join('{}={:.2f}s'.format(step, sum(
+                    r['seconds'] for r in rs if r['step'] == step)) for step in steps)))
+        return '\n'.join(lines)
+
+    def summary(self):
+        lines = ['{:<8} {:>5} {:>7} {:>9} {:>9}'.format(
+            'STEP', 'RUNS', 'FAILED', 'TOTAL', 'SLOWEST')]
+        steps = []
+        for r in self.results:
+            if r['step'] not in steps:
+                steps.append(r['step'])
+        for step in steps:
+            rs = [r for r in self.results if r['step'] == step]
+            lines.append('{:<8} {:>5} {:>7} {:>8.2f}s {:>8.2f}s'.format(
+                step, len(rs), sum(not r['ok'] for r in rs),
+                sum(r['seconds'] for r in rs), max(r['seconds'] for r in rs)))
+        return '\n'.join(lines)
+
+
+def _parallel(report, step, jobs, parallelism, groups=None):
+    '''
+    Run report.step over jobs [(target, fn, args...)] with bounded concurrency.
+    groups, when given, is passed through as each job's report group.
+    '''
+    groups = groups or [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        futures = [pool.submit(report.step, step, job[0], job[1], *job[2:], group=group)
+                   for job, group in zip(jobs, groups)]
+        return [f.result() for f in futures]
+
+
+def join_channel(cli, report, channel, parallelism=8, deadline=60.0):
+    '''
+    Join every peer to channel concurrently.  Each peer retries on its own
+    jittered backoff, so peers that are still starting do not hold up the
+    rest; a peer that already has the ledger counts as joined.  Returns True
+    when every peer joined.
+    '''
+    def join(peer, org):
+        def attempt():
+            try:
+                cli.join(peer, org, channel)
+            except LifecycleError as err:
+                if 'already exists' not in str(err):
+                    raise
+                return 'already joined'
+        value, attempts = retry(attempt, deadline)
+        return value or 'joined after {} attempt(s)'.format(attempts)
+
+    results = _parallel(report, 'join', [
+        (cli.peer_name(peer, org), join, peer, org) for peer, org in cli.all_peers()
+    ], parallelism)
+    return all(ok for ok, _ in results)
+
+
+def update_anchor_peers(cli, report, channel, parallelism=8):
+    '''Submit every org's anchor peer update concurrently.'''
+    first = cli.first_peer()
+    results = _parallel(report, 'anchor', [
+        (cli.msp_id(org), cli.update_anchor_peer, first, org, channel) for org in cli.orgs
+    ], parallelism)
+    return all(ok for ok, _ in results)
+
+
+def lifecycle_snapshot(cli, report, channel, names, version, init_required=False,
+                       parallelism=8):
+    '''
+    Query the lifecycle state install_chaincodes needs in one concurrent
+    round: installed packages on every peer, then per chaincode the committed
+    definition and, unless version is already committed, the approvals for
+    the next sequence.  Returns {name: plan} for the chaincodes whose state
+    could be read, where a plan names the sequence to use, the peers still
+    missing the package, the orgs still to approve and whether a commit is
+    needed.
+    '''
+    first = cli.first_peer()
+    _parallel(report, 'snapshot', [
+        (cli.peer_name(peer, org), cli.query_installed, peer, org)
+        for peer, org in cli.all_peers()], parallelism)
+
+    def plan(name):
+        label = '{}-{}'.format(name, version)
+        committed = cli.query_committed(first, cli.orgs[0], channel, name)
+        missing = [(peer, org) for peer, org in cli.all_peers()
+                   if label not in cli.query_installed(peer, org)]
+        if committed and committed.get('version') == version:
+            return {'sequence': committed['sequence'], 'install': missing,
+                    'approve': [], 'commit': False}
+        sequence = committed['sequence'] + 1 if committed else 1
+        approvals = cli.check_commit_readiness(first, cli.orgs[0], channel, name, version,
+                                               sequence, init_required)
+        return {'sequence': sequence, 'install': missing,
+                'approve': [org for org in cli.orgs if not approvals.get(cli.msp_id(org))],
+                'commit': True}
+
+    results = _parallel(report, 'snapshot', [(name, plan, name) for name in names],
+                        parallelism, groups=names)
+    return {name: value for name, (ok, value) in zip(names, results) if ok}
+
+
+def install_chaincodes(cli, report, channel, names, version, package_dir,
+                       init_required=False, parallelism=8):
+    '''
+    Install, approve and commit several chaincodes as a pipeline.  A single
+    lifecycle_snapshot() decides what each chaincode still needs; then each
+    phase (install, approve, ready, commit, verify) runs only those actions,
+    for every chaincode at once, fanned out across peers or orgs with bounded
+    concurrency, before the next phase starts.  A chaincode that fails a
+    phase drops out of the later ones without affecting the others, and one
+    whose version is already committed everywhere costs only the snapshot.
+
+    Returns {name: failed phase} for the chaincodes that did not complete.
+    '''
+    first = cli.first_peer()
+    plans = lifecycle_snapshot(cli, report, channel, names, version, init_required,
+                               parallelism)
+    failed = {name: 'snapshot' for name in names if name not in plans}
+
+    def label(name):
+        return '{}-{}'.format(name, version)
+
+    def phase(step, make_jobs):
+        jobs = [(name, job) for name in names if name not in failed
+                for job in make_jobs(name, plans[name])]
+        results = _parallel(report, step, [job for _, job in jobs], parallelism,
+                            groups=[name for name, _ in jobs])
+        for (name, _), (ok, _) in zip(jobs, results):
+            if not ok:
+                failed.setdefault(name, step)
+
+    def install_one(name, peer, org):
+        cli.install(peer, org, posixpath.join(package_dir, label(name) + '.tar.gz'))
+
+    def approve_one(name, org):
+        package_id = cli.query_installed(first, org).get(label(name))
+        if package_id is None:
+            raise LifecycleError('{} is not installed on {}'.format(
+                label(name), cli.peer_name(first, org)))
+        cli.approve(first, org, channel, name, version, plans[name]['sequence'], package_id,
+                    init_required)
+
+    def ready(name, org):
+        sequence = plans[name]['sequence']
+        ok, waited = wait_until(lambda: all(cli.check_commit_readiness(
+            first, org, channel, name, version, sequence, init_required).values()))
+        if not ok:
+            raise LifecycleError('commit readiness not confirmed on {} after {:.2f}s'.format(
+                cli.peer_name(first, org), waited))
+        return 'waited {:.2f}s'.format(waited)
+
+    def commit(name):
+        cli.commit(channel, name, version, plans[name]['sequence'], init_required)
+
+    def committed_on(name, org):
+        def check():
+            definition = cli.query_committed(first, org, channel, name)
+            return definition is not None and definition.get('version') == version
+        ok, waited = wait_until(check)
+        if not ok:
+            raise LifecycleError('{} not committed on {} after {:.2f}s'.format(
+                label(name), cli.peer_name(first, org), waited))
+        return 'waited {:.2f}s'.format(waited)
+
+    def per_org(fn, orgs=None):
+        return lambda name, plan: [
+            ('{} {}'.format(name, cli.msp_id(org)), fn, name, org)
+            for org in (cli.orgs if orgs is None else orgs(plan))
+        ] if plan['commit'] else []
+
+    phase('install', lambda name, plan: [
+        ('{} {}'.format(name, cli.peer_name(peer, org)), install_one, name, peer, org)
+        for peer, org in plan['install']])
+    phase('approve', per_org(approve_one, lambda plan: plan['approve']))
+    phase('ready', per_org(ready))
+    phase('commit', lambda name, plan: [(name, commit, name)] if plan['commit'] else [])
+    phase('verify', per_org(committed_on))
+    return failed
+
+
+def channel_artifact_jobs(channel, org_count):
+    '''
+    (artifact file name, configtxgen arguments up to the output path) for
+    everything generateChannelArtifacts in byfn.sh produces.
+    '''
+    jobs = [('genesis.block', ['-profile', 'AnyOrgsOrdererGenesis',
+                               '-channelID', 'byfn-sys-channel', '-outputBlock']),
+            ('channel.tx', ['-profile', 'AnyOrgsChannel', '-channelID', channel,
+                            '-outputCreateChannelTx'])]
+    for i in range(1, org_count + 1):
+        msp = 'Org{}MSP'.format(i)
+        jobs.append(('{}anchors.tx'.format(msp),
+                     ['-profile', 'AnyOrgsChannel', '-channelID', channel, '-asOrg', msp,
+                      '-outputAnchorPeersUpdate']))
+    return jobs
+
+
+def _configtxgen(cwd, argv):
+    proc = subprocess.run(['configtxgen'] + argv, cwd=cwd, capture_output=True, text=True,
+                          env=dict(os.environ, FABRIC_CFG_PATH=os.path.abspath(cwd)))
+    if proc.returncode != 0:
+        lines = (proc.stderr or proc.stdout).strip().splitlines()
+        raise LifecycleError('configtxgen: {}'.format(
+            lines[-1] if lines else 'exit status {}'.format(proc.returncode)))
+
+
+def generate_channel_artifacts(dest, channel, org_count, report, parallelism=None):
+    '''
+    Run the independent configtxgen invocations for the genesis block, the
+    channel creation tx and every org's anchor peer update concurrently
+    (bounded by parallelism, default CPU count).  Each writes to a private
+    staging directory inside channel-artifacts/ and is renamed into place
+    only if every invocation succeeded.  Returns True on success.
+    '''
+    if shutil.which('configtxgen') is None:
+        raise SystemExit('configtxgen tool not found')
+    out_dir = os.path.join(dest, 'channel-artifacts')
+    os.makedirs(out_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=out_dir, prefix='.configtxgen-')
+    try:
+        jobs = channel_artifact_jobs(channel, org_count)
+        results = _parallel(report, 'configtxgen', [
+            (name, _configtxgen, dest, argv + [os.path.join(staging, name)])
+            for name, argv in jobs], parallelism or os.cpu_count() or 1)
+        if not all(ok for ok, _ in results):
+            return False
+        for name, _ in jobs:
+            os.replace(os.path.join(staging, name), os.path.join(out_dir, name))
+        return True
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+# Every entry in a chaincode package carries this mtime (2016-01-01T00:00:00Z),
+# matching `tar --mtime` in generateChaincode, so packages are reproducible.
+CHAINCODE_PACKAGE_MTIME = 1451606400
+
+# connection.json for CCaaS packages; peers expand {{.index}} themselves.
+_CCAAS_CONNECTION = """  {{
+    "address": "{name}-peer{{{{.index}}}}:8080",
+    "dial_timeout": "10s",
+    "tls_required": false,
+    "client_auth_required": false
+  }}
+"""
+
+
+def _tar_gz_bytes(members):
+    '''
+    A deterministic .tar.gz of (name, data) pairs: fixed mtime and ownership,
+    no gzip timestamp.
+    '''
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT) as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = CHAINCODE_PACKAGE_MTIME
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _ccaas_code_archive(name):
+    '''The code.tar.gz of a CCaaS package: just its connection.json.'''
+    return _tar_gz_bytes([('connection.json',
+                           _CCAAS_CONNECTION.format(name=name).encode('utf-8'))])
+
+
+def _chaincode_metadata(label, ccaas=False):
+    return (json.dumps({'path': 'main', 'type': 'ccaas' if ccaas else 'golang',
+                        'label': label}, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+# Bytes of code.tar.gz read from the source tarball per streaming step.
+_PACKAGE_CHUNK = 1 << 20
+
+
+class _HashingSink(object):
+    '''File-like sink that hashes everything written through it.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+class _PackageWriter(object):
+    '''
+    Streams a chaincode package, a deterministic .tar.gz, into a temp file
+    beside path.  Members are written header first and their contents chunk
+    by chunk, so no member has to be held in memory, and the package's sha256
+    is computed from the compressed bytes on the way to disk.
+    '''
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.digest = None
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                        prefix='.{}.'.format(os.path.basename(path)))
+        os.chmod(self.tmp, stat.S_IMODE(os.stat(path).st_mode)
+                 if os.path.exists(path) else mode)
+        self._file = os.fdopen(fd, 'wb')
+        self._sink = _HashingSink(self._file)
+        self._gz = gzip.GzipFile(fileobj=self._sink, mode='wb', mtime=0)
+        self._offset = 0
+        self._remaining = 0
+
+    def begin(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = CHAINCODE_PACKAGE_MTIME
+        info.mode = 0o644
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+        self._gz.write(header)
+        self._offset += len(header)
+        self._remaining = size
+
+    def write(self, chunk):
+        if len(chunk) > self._remaining:
+            raise SystemExit('{}: member longer than its header'.format(self.path))
+        self._gz.write(chunk)
+        self._remaining -= len(chunk)
+
+    def end(self, size):
+        if self._remaining:
+            raise SystemExit('{}: member truncated by {} bytes'.format(
+                self.path, self._remaining))
+        pad = -size % tarfile.BLOCKSIZE
+        self._gz.write(tarfile.NUL * pad)
+        self._offset += size + pad
+
+    def add(self, name, data):
+        self.begin(name, len(data))
+        self.write(data)
+        self.end(len(data))
+
+    def close(self):
+        # End-of-archive blocks and record padding, as TarFile.close() writes.
+        self._offset += 2 * tarfile.BLOCKSIZE
+        self._gz.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE
+                                      + -self._offset % tarfile.RECORDSIZE))
+        self._gz.close()
+        self._file.close()
+        self.digest = self._sink.sha.hexdigest()
+
+    def commit(self):
+        os.replace(self.tmp, self.path)
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+def _write_atomic(path, data, mode):
+    tmp = _stage_file(path, data)
+    if not os.path.exists(path):
+        os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+# Bump when the package layout changes, so older cached packages are not reused.
+CHAINCODE_PACKAGE_FORMAT = 1
+
+
+def chaincode_cache_key(source_digest, label, ccaas, connection):
+    '''
+    Content address of a built package: everything that goes into it, i.e. the
+    source tarball's digest (None for CCaaS), the label, the CCaaS flag and
+    the connection.json contents (None for non-CCaaS).
+    '''
+    return _sha256(json.dumps({'format': CHAINCODE_PACKAGE_FORMAT, 'source': source_digest,
+                               'label': label, 'ccaas': bool(ccaas),
+                               'connection': connection}, sort_keys=True))
+
+
+def _stream_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_PACKAGE_CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _copy_atomic(src, path, mode):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix='.{}.'.format(os.path.basename(path)))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class ChaincodePackageCache(object):
+    '''
+    Built packages and their .id files stored under chaincode_cache_key() in
+    the fabric-network-builder cache directory, so unchanged packages are
+    copied instead of rebuilt.
+    '''
+
+    def __init__(self, root=None):
+        self.root = root or cache_dir('chaincode-packages')
+
+    def _paths(self, key):
+        base = os.path.join(self.root, key[:2], key)
+        return base + '.tar.gz', base + '.id'
+
+    def get(self, key, label):
+        '''
+        (cached package path, package ID), or None on a miss.  The package is
+        re-hashed against the ID, and an entry that does not match (truncated or
+        corrupted on disk) is deleted and treated as a miss.
+        '''
+        if self.root is None:
+            return None
+        package, id_file = self._paths(key)
+        try:
+            with open(id_file) as f:
+                package_id = f.read().strip()
+        except OSError:
+            return None
+        if not package_id.startswith(label + ':') or not os.path.isfile(package):
+            return None
+        try:
+            digest = _stream_sha256(package)
+        except OSError:
+            digest = None
+        if digest != package_id[len(label) + 1:]:
+            self._discard(key)
+            return None
+        return package, package_id
+
+    def _discard(self, key):
+        for path in self._paths(key):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def put(self, key, package_path, package_id):
+        if self.root is None:
+            return
+        package, id_file = self._paths(key)
+        try:
+            os.makedirs(os.path.dirname(package), exist_ok=True)
+            _copy_atomic(package_path, package, 0o644)
+            _write_atomic(id_file, (package_id + '\n').encode('utf-8'), 0o644)
+        except OSError:
+            pass
+
+
+def generate_chaincode_packages(src_path, names, version, ccaas=False, workers=None,
+                                cache=True):
+    '''
+    Write <name>-<version>.tar.gz and its .id file beside src_path for each
+    chaincode variant, without extracting anything to disk.  For non-CCaaS
+    chaincode the code.tar.gz member is streamed out of the source tarball in
+    a single pass and fed to every variant's package at once, compressing in
+    parallel, while each package's ID (label:sha256) is hashed as it is
+    written.  Outputs are staged beside their targets, so concurrent runs
+    never share scratch files.
+
+    With cache, packages whose inputs match an earlier build are copied from
+    the ChaincodePackageCache and only the rest are built.  Returns
+    {name: (package path, package ID, whether it came from the cache)}.
+    '''
+    out_dir = os.path.dirname(src_path)
+    mode = 0o666 & ~_umask()
+    labels = {name: '{}-{}'.format(name, version) for name in names}
+    packages = {}
+    store = None
+    if cache:
+        store = ChaincodePackageCache()
+        source_digest = None if ccaas else _stream_sha256(src_path)
+        keys = {name: chaincode_cache_key(
+            source_digest, labels[name], ccaas,
+            _CCAAS_CONNECTION.format(name=name) if ccaas else None) for name in names}
+        for name in names:
+            hit = store.get(keys[name], labels[name])
+            if hit is not None:
+                path = os.path.join(out_dir, labels[name] + '.tar.gz')
+                _copy_atomic(hit[0], path, mode)
+                _write_atomic(os.path.join(out_dir, labels[name] + '.id'),
+                              (hit[1] + '\n').encode('utf-8'), mode)
+                packages[name] = (path, hit[1], True)
+    build = [name for name in names if name not in packages]
+    if not build:
+        return packages
+    writers = {}
+    try:
+        for name in build:
+            writers[name] = _PackageWriter(os.path.join(out_dir, labels[name] + '.tar.gz'),
+                                           mode)
+        with ThreadPoolExecutor(max_workers=workers or len(build)) as pool:
+            def each(fn):
+                list(pool.map(fn, build))
+
+            each(lambda name: writers[name].add('metadata.json',
+                                                _chaincode_metadata(labels[name], ccaas)))
+            if ccaas:
+                each(lambda name: writers[name].add('code.tar.gz', _ccaas_code_archive(name)))
+            else:
+                with tarfile.open(src_path, 'r|*') as src:
+                    member = next((m for m in src
+                                   if posixpath.normpath(m.name) == 'code.tar.gz'), None)
+                    if member is None:
+                        raise SystemExit(
+                            '{}: no code.tar.gz in chaincode archive'.format(src_path))
+                    code = src.extractfile(member)
+                    each(lambda name: writers[name].begin('code.tar.gz', member.size))
+                    for chunk in iter(lambda: code.read(_PACKAGE_CHUNK), b''):
+                        each(lambda name: writers[name].write(chunk))
+                    each(lambda name: writers[name].end(member.size))
+            each(lambda name: writers[name].close())
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        raise
+    for name in build:
+        writer = writers[name]
+        package_id = '{}:{}'.format(labels[name], writer.digest)
+        writer.commit()
+        _write_atomic(os.path.join(out_dir, labels[name] + '.id'),
+                      (package_id + '\n').encode('utf-8'), mode)
+        if store is not None:
+            store.put(keys[name], writer.path, package_id)
+        packages[name] = (writer.path, package_id, False)
+    return {name: packages[name] for name in names}
 
-    return sorted(certs_info)
 
 if __name__ == '__main__':
     Network().main()
@@ -20,6 +20,7 @@ echo "Channel name : "$CHANNEL_NAME
 echo "Creating channel..."
 createChannel ${CHANNEL_NAME}
 
+waitSummary
 echo
 echo "========= All GOOD, Channel created successfully =========== "
 echo
@@ -17,9 +17,13 @@ CC_SRC_PATH=$4
 shift 4
 
 initopt=""
-if [ "$1" == "--init-required" ]; then
-    initopt="--init-required"
-fi
+pipelined=""
+for arg in "$@"; do
+    case "$arg" in
+    --init-required) initopt="--init-required" ;;
+    --pipelined) pipelined=1 ;;
+    esac
+done
 
 # import utils
 . /scripts/luther_utils.sh
@@ -30,16 +34,112 @@ echo "CHANNEL=$CHANNEL CC_VERSION=$CC_VERSION CC_NAMES=$CC_NAMES"
 echo "CC_SRC_PATH=$CC_SRC_PATH"
 echo
 
-for CC_NAME in $CC_NAMES
-do
-  forEachPeer installChaincode "$CC_SRC_PATH" "$CC_NAME" "$CC_VERSION"
-  seq_no="$(nextSequenceNumber "$CHANNEL" "$CC_NAME" "$CC_VERSION")"
-  echo -e "next sequence number: ${seq_no}\n"
-  forEachOrg approveChaincode "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
-  forEachOrg waitForChaincodeCommitReadiness "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
-  commitChaincode "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
-  forEachOrg waitForCommittedVersion "$CHANNEL" "$CC_NAME" "$CC_VERSION"
-done
+# Pipelined phases. Each runs in its chaincode's own scratch directory (so
+# log.txt and the sequence file never collide) and exits non-zero on failure.
+installPhase() {
+  forEachPeer installChaincode "$CC_SRC_PATH" "$1" "$CC_VERSION"
+}
+
+sequencePhase() {
+  nextSequenceNumber "$CHANNEL" "$1" "$CC_VERSION" >seq
+  echo -e "next sequence number: $(<seq)\n"
+}
+
+approvePhase() {
+  forEachOrg approveChaincode "$CHANNEL" "$1" "$CC_VERSION" "$(<seq)" "$initopt"
+}
+
+readyPhase() {
+  forEachOrg waitForChaincodeCommitReadiness "$CHANNEL" "$1" "$CC_VERSION" "$(<seq)" "$initopt"
+}
+
+commitPhase() {
+  commitChaincode "$CHANNEL" "$1" "$CC_VERSION" "$(<seq)" "$initopt"
+}
+
+verifyPhase() {
+  forEachOrg waitForCommittedVersion "$CHANNEL" "$1" "$CC_VERSION"
+}
+
+PHASES="install sequence approve ready commit verify"
+declare -A FAILED
+
+# runPhase PHASE
+#
+# Run PHASE for every chaincode that has not failed yet, all at once, then
+# print their logs in order and mark the ones that failed.
+runPhase() {
+  local phase=$1
+  local cc
+  local -A pids
+  for cc in $CC_NAMES; do
+    [ -n "${FAILED[$cc]}" ] && continue
+    (
+      cd "$WORK_DIR/$cc" || exit 1
+      start=$(nowMs)
+      "${phase}Phase" "$cc"
+      res=$?
+      echo $(($(nowMs) - start)) >"$phase.ms"
+      exit $res
+    ) >"$WORK_DIR/$cc/$phase.log" 2>&1 &
+    pids[$cc]=$!
+  done
+  for cc in $CC_NAMES; do
+    [ -n "${pids[$cc]}" ] || continue
+    wait "${pids[$cc]}" || FAILED[$cc]=$phase
+    echo "----- $phase $cc -----"
+    cat "$WORK_DIR/$cc/$phase.log"
+  done
+}
+
+timingReport() {
+  local cc phase ms total
+  echo
+  printf '%-24s %-18s %s\n' CHAINCODE STATUS TIMES
+  for cc in $CC_NAMES; do
+    total=0
+    local times=""
+    for phase in $PHASES; do
+      [ -f "$WORK_DIR/$cc/$phase.ms" ] || continue
+      ms=$(<"$WORK_DIR/$cc/$phase.ms")
+      total=$((total + ms))
+      times+="$(printf ' %s=%d.%03ds' "$phase" $((ms / 1000)) $((ms % 1000)))"
+    done
+    printf '%-24s %-18s %d.%03ds%s\n' "$cc" \
+      "$([ -n "${FAILED[$cc]}" ] && echo "FAILED at ${FAILED[$cc]}" || echo ok)" \
+      $((total / 1000)) $((total % 1000)) "$times"
+  done
+}
+
+if [ -n "$pipelined" ]; then
+  WORK_DIR=$(mktemp -d)
+  trap 'rm -rf "$WORK_DIR"' EXIT
+  for CC_NAME in $CC_NAMES; do
+    mkdir -p "$WORK_DIR/$CC_NAME"
+  done
+  pipeline_start=$(nowMs)
+  for phase in $PHASES; do
+    runPhase $phase
+  done
+  timingReport
+  elapsed=$(($(nowMs) - pipeline_start))
+  printf 'total %d.%03ds\n' $((elapsed / 1000)) $((elapsed % 1000))
+  if [ ${#FAILED[@]} -ne 0 ]; then
+    verifyResult 1 "Chaincode install failed for ${!FAILED[*]}"
+  fi
+else
+  for CC_NAME in $CC_NAMES
+  do
+    forEachPeer installChaincode "$CC_SRC_PATH" "$CC_NAME" "$CC_VERSION"
+    seq_no="$(nextSequenceNumber "$CHANNEL" "$CC_NAME" "$CC_VERSION")"
+    echo -e "next sequence number: ${seq_no}\n"
+    forEachOrg approveChaincode "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
+    forEachOrg waitForChaincodeCommitReadiness "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
+    commitChaincode "$CHANNEL" "$CC_NAME" "$CC_VERSION" "$seq_no" "$initopt"
+    forEachOrg waitForCommittedVersion "$CHANNEL" "$CC_NAME" "$CC_VERSION"
+  done
+  waitSummary
+fi
 
 echo
 echo "========= All GOOD, Chaincode installed on all peers =========== "
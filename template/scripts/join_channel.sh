@@ -26,6 +26,7 @@ do
   updateAnchorPeers 0 "${i}"
 done
 
+waitSummary
 echo
 echo "========= All GOOD, Channel initialized successfully =========== "
 echo
@@ -20,6 +20,64 @@ verifyResult() {
 	fi
 }
 
+# Readiness waits poll with exponential backoff: the first retry comes after
+# WAIT_INITIAL_MS, each later one doubles up to WAIT_MAX_MS, and the whole wait
+# gives up after WAIT_DEADLINE seconds.
+: ${WAIT_INITIAL_MS:=50}
+: ${WAIT_MAX_MS:=2000}
+: ${WAIT_DEADLINE:=30}
+WAIT_TOTAL_MS=0
+
+nowMs() {
+	if [ -n "$EPOCHREALTIME" ]; then
+		local us=${EPOCHREALTIME/[.,]/}
+		echo $((10#$us / 1000))
+	else
+		echo $((SECONDS * 1000))
+	fi
+}
+
+sleepMs() {
+	sleep "$(printf '%d.%03d' $(($1 / 1000)) $(($1 % 1000)))"
+}
+
+# waitUntil STEP COMMAND [ARGS...]
+#
+# Run COMMAND until it succeeds, backing off between attempts, and report how
+# long STEP waited. Returns non-zero if the deadline passes first.
+waitUntil() {
+	local step=$1
+	shift
+	local start=$(nowMs)
+	local deadline=$((start + WAIT_DEADLINE * 1000))
+	local delay=$WAIT_INITIAL_MS
+	local attempts=0
+	local res=1
+	while true; do
+		attempts=$((attempts + 1))
+		"$@"
+		res=$?
+		local now=$(nowMs)
+		if [ $res -eq 0 ] || [ $((now + delay)) -gt $deadline ]; then
+			break
+		fi
+		sleepMs $delay
+		delay=$((delay * 2))
+		if [ $delay -gt $WAIT_MAX_MS ]; then
+			delay=$WAIT_MAX_MS
+		fi
+	done
+	local waited=$(($(nowMs) - start))
+	WAIT_TOTAL_MS=$((WAIT_TOTAL_MS + waited))
+	printf 'wait: %s %d.%03ds (%d attempts%s)\n' "$step" $((waited / 1000)) $((waited % 1000)) \
+		$attempts "$([ $res -eq 0 ] || echo ', deadline exceeded')" >&2
+	return $res
+}
+
+waitSummary() {
+	printf 'wait: total %d.%03ds\n' $((WAIT_TOTAL_MS / 1000)) $((WAIT_TOTAL_MS % 1000)) >&2
+}
+
 firstPeer() {
 	echo "${PEER_INDICES[0]}"
 }
@@ -29,48 +87,51 @@ firstOrg() {
 }
 
 peerAddress() {
-	PEER=$1
-	ORG=$2
-	echo "peer${PEER}.org${ORG}.${DOMAIN_NAME}:7051"
+	echo "peer${1}.org${2}.${DOMAIN_NAME}:7051"
 }
 
 peerRootCert() {
-	PEER=$1
-	ORG=$2
-	echo "/crypto-config/peerOrganizations/org${ORG}.${DOMAIN_NAME}/peers/peer${PEER}.org${ORG}.${DOMAIN_NAME}/tls/ca.crt"
+	echo "/crypto-config/peerOrganizations/org${2}.${DOMAIN_NAME}/peers/peer${1}.org${2}.${DOMAIN_NAME}/tls/ca.crt"
 }
 
 peerArgs() {
-	PEER=$1
-	ORG=$2
-	echo "--peerAddresses $(peerAddress "$PEER" "$ORG") --tlsRootCertFiles $(peerRootCert "$PEER" "$ORG")"
+	echo "--peerAddresses $(peerAddress "$1" "$2") --tlsRootCertFiles $(peerRootCert "$1" "$2")"
 }
 
+# The --peerAddresses/--tlsRootCertFiles pairs for the first peer of every
+# org, built once when this file is sourced.
+PEER_ARGS_EACH_ORG=()
+for _org in "${ORG_INDICES[@]}"; do
+	_peer="peer${PEER_INDICES[0]}.org${_org}.${DOMAIN_NAME}"
+	PEER_ARGS_EACH_ORG+=(--peerAddresses "${_peer}:7051"
+		--tlsRootCertFiles "/crypto-config/peerOrganizations/org${_org}.${DOMAIN_NAME}/peers/${_peer}/tls/ca.crt")
+done
+unset _org _peer
+
 peerArgsEachOrg() {
-	{ set +x; } 2>/dev/null
-	local peer_args=""
-	local first_peer="$(firstPeer)"
-	for orgIdx in "${ORG_INDICES[@]}"; do
-		peer_args="${peer_args} $(peerArgs "$first_peer" "$orgIdx")"
-	done
-	echo "$peer_args"
+	echo "${PEER_ARGS_EACH_ORG[*]}"
 }
 
 setGlobals() {
 	PEER=$1
 	ORG=$2
 
+	local org_dir="/crypto-config/peerOrganizations/org${ORG}.${DOMAIN_NAME}"
+	local tls_dir="${org_dir}/peers/peer${PEER}.org${ORG}.${DOMAIN_NAME}/tls"
 	export CORE_PEER_LOCALMSPID="Org${ORG}MSP"
-	export CORE_PEER_MSPCONFIGPATH="/crypto-config/peerOrganizations/org${ORG}.${DOMAIN_NAME}/users/Admin@org${ORG}.${DOMAIN_NAME}/msp"
-	export CORE_PEER_TLS_CERT_FILE="/crypto-config/peerOrganizations/org${ORG}.${DOMAIN_NAME}/peers/peer${PEER}.org${ORG}.${DOMAIN_NAME}/tls/server.crt"
-	export CORE_PEER_TLS_KEY_FILE="/crypto-config/peerOrganizations/org${ORG}.${DOMAIN_NAME}/peers/peer${PEER}.org${ORG}.${DOMAIN_NAME}/tls/server.key"
-	export CORE_PEER_ADDRESS="$(peerAddress "$PEER" "$ORG")"
-	export CORE_PEER_TLS_ROOTCERT_FILE="$(peerRootCert "$PEER" "$ORG")"
+	export CORE_PEER_MSPCONFIGPATH="${org_dir}/users/Admin@org${ORG}.${DOMAIN_NAME}/msp"
+	export CORE_PEER_TLS_CERT_FILE="${tls_dir}/server.crt"
+	export CORE_PEER_TLS_KEY_FILE="${tls_dir}/server.key"
+	export CORE_PEER_ADDRESS="peer${PEER}.org${ORG}.${DOMAIN_NAME}:7051"
+	export CORE_PEER_TLS_ROOTCERT_FILE="${tls_dir}/ca.crt"
 	export CORE_PEER_TLS_CLIENTCERT_FILE="${CORE_PEER_TLS_CERT_FILE}"
 	export CORE_PEER_TLS_CLIENTKEY_FILE="${CORE_PEER_TLS_KEY_FILE}"
 	export CORE_PEER_TLS_CLIENTAUTHREQUIRED=true
 
-	env | grep CORE >&2
+	local v
+	for v in "${!CORE_@}"; do
+		echo "${v}=${!v}"
+	done >&2
 }
 
 updateAnchorPeers() {
@@ -92,16 +153,16 @@ updateAnchorPeers() {
 	cat log.txt
 	verifyResult $res "Anchor peer update failed"
 	echo "===================== Anchor peers for org \"$CORE_PEER_LOCALMSPID\" on \"$CHANNEL_NAME\" is updated successfully ===================== "
-	sleep $DELAY
 	echo
 }
 
-createChannel() {
-	CHANNEL_NAME=$1
-	DELAY=3
-	setGlobals 0 1
-
-	sleep $DELAY
+# createChannelOnce
+#
+# peer channel create is not idempotent: if an earlier attempt reached the
+# orderer but its response was lost, retrying fails because the channel now
+# exists. Treat that as success and fetch the genesis block that the create
+# would have written instead.
+createChannelOnce() {
 	if [ -z "$CORE_PEER_TLS_ENABLED" -o "$CORE_PEER_TLS_ENABLED" = "false" ]; then
 		set -x
 		peer channel create -o orderer0."$DOMAIN_NAME":7050 -c $CHANNEL_NAME -f /channel-artifacts/channel.tx >&log.txt
@@ -113,6 +174,35 @@ createChannel() {
 		res=$?
 		set +x
 	fi
+	if [ $res -ne 0 ] && grep -qE "already exists|existing channel" log.txt; then
+		fetchChannelBlock
+		res=$?
+	fi
+	return $res
+}
+
+fetchChannelBlock() {
+	if [ -z "$CORE_PEER_TLS_ENABLED" -o "$CORE_PEER_TLS_ENABLED" = "false" ]; then
+		set -x
+		peer channel fetch 0 $CHANNEL_NAME.block -o orderer0."$DOMAIN_NAME":7050 -c $CHANNEL_NAME >&log.txt
+		res=$?
+		set +x
+	else
+		set -x
+		peer channel fetch 0 $CHANNEL_NAME.block -o orderer0."$DOMAIN_NAME":7050 -c $CHANNEL_NAME --tls $CORE_PEER_TLS_ENABLED --cafile $ORDERER_CA --clientauth --certfile $CORE_PEER_TLS_CERT_FILE --keyfile $CORE_PEER_TLS_KEY_FILE >&log.txt
+		res=$?
+		set +x
+	fi
+	return $res
+}
+
+createChannel() {
+	CHANNEL_NAME=$1
+	setGlobals 0 1
+
+	# the orderer may still be starting; retry until it accepts the request
+	waitUntil "create channel $CHANNEL_NAME" createChannelOnce
+	res=$?
 	cat log.txt
 	verifyResult $res "Channel creation failed"
 	echo "===================== Channel \"$CHANNEL_NAME\" is created successfully ===================== "
@@ -121,44 +211,36 @@ createChannel() {
 
 joinChannel() {
 	CHANNEL_NAME=$1
-	DELAY=3
-
-	for i in "${ORG_INDICES[@]}"; do
-		for j in "${PEER_INDICES[@]}"; do
-			joinChannelWithRetry "$j" "$i" $CHANNEL_NAME $DELAY 1 5
-			echo "===================== peer${j}.org${i} joined on the channel \"$CHANNEL_NAME\" ===================== "
-			sleep $DELAY
-			echo
-		done
+
+	for pair in "${ORG_PEERS[@]}"; do
+		i=${pair%%:*}
+		j=${pair#*:}
+		joinChannelWithRetry "$j" "$i" $CHANNEL_NAME
+		echo "===================== peer${j}.org${i} joined on the channel \"$CHANNEL_NAME\" ===================== "
+		echo
 	done
 }
 
-## Sometimes Join takes time hence RETRY so this recursive function takes an
-## iteration counter and a maximum number of iterations as its 5th and 6th
-## arguments.
+joinChannelOnce() {
+	set -x
+	peer channel join -b $CHANNEL_NAME.block >&log.txt
+	res=$?
+	set +x
+	return $res
+}
+
+## Sometimes Join takes time (the peer may still be starting) hence the
+## backoff retry until WAIT_DEADLINE.
 joinChannelWithRetry() {
 	PEER=$1
 	ORG=$2
 	CHANNEL_NAME=$3
-	DELAY=$4
-	COUNTER=$5
-	MAX_RETRY=$6
 	setGlobals $PEER $ORG
 
-	set -x
-	peer channel join -b $CHANNEL_NAME.block >&log.txt
+	waitUntil "join peer${PEER}.org${ORG}" joinChannelOnce
 	res=$?
-	set +x
-
 	cat log.txt
-	if [ $res -ne 0 -a $COUNTER -lt $MAX_RETRY ]; then
-		COUNTER=$(expr $COUNTER + 1)
-		echo "peer${PEER}.org${ORG} failed to join the channel, Retry after $DELAY seconds"
-		sleep $DELAY
-		joinChannelWithRetry $PEER $ORG $CHANNEL_NAME $DELAY $COUNTER $MAX_RETRY
-	else
-		verifyResult $res "After $MAX_RETRY attempts, peer${PEER}.org${ORG} has failed to Join the Channel"
-	fi
+	verifyResult $res "After ${WAIT_DEADLINE}s, peer${PEER}.org${ORG} has failed to Join the Channel"
 }
 
 generateChaincode() {
@@ -228,11 +310,18 @@ installChaincode() {
 	set +x
 	cat log.txt
 	verifyResult $res "Chaincode installation on peer${PEER}.org${ORG} has Failed"
-	peer lifecycle chaincode queryinstalled -O json
+	unset "INSTALLED_JSON[${PEER},${ORG}]"
 	echo "===================== Chaincode is installed on peer${PEER}.org${ORG} ===================== "
 	echo
 }
 
+# queryinstalled output per "peer,org", kept for the life of the script and
+# dropped when installChaincode changes a peer.
+declare -A INSTALLED_JSON
+
+# Print (and set PACKAGE_ID to) the package ID of CC_NAME-CC_VERSION on a
+# peer; returns non-zero when it is not installed. Call it without $(...) to
+# keep the query cache.
 queryChaincodePackage() {
 	PEER=$1
 	ORG=$2
@@ -240,36 +329,25 @@ queryChaincodePackage() {
 	CC_VERSION=$4
 
 	CC_LABEL=${CC_NAME}-${CC_VERSION}
+	PACKAGE_ID=""
 
-	echo "Querying installed chaincodes on peer${PEER}.org${ORG}..." >&2
-	echo >&2
-	setGlobals $PEER $ORG &>/dev/null
-	set -x
-	peer lifecycle chaincode queryinstalled -O json >chaincodes.json
-	res=$?
-	set +x
-	if [ $res -ne 0 ]; then
-		return 1
-	fi
-	query=$(
-		cat <<EOF
-.installed_chaincodes[]
-  | select(.label == "${CC_LABEL}")
-  | .package_id
-EOF
-	)
-	set -x
-	jq -er '. == {}' chaincodes.json >&2
-	res=$?
-	set +x
-	if [ $res -eq 0 ]; then
-		return 1
+	if [ -z "${INSTALLED_JSON[${PEER},${ORG}]+set}" ]; then
+		echo "Querying installed chaincodes on peer${PEER}.org${ORG}..." >&2
+		echo >&2
+		setGlobals $PEER $ORG &>/dev/null
+		set -x
+		INSTALLED_JSON[${PEER},${ORG}]="$(peer lifecycle chaincode queryinstalled -O json)"
+		res=$?
+		{ set +x; } 2>/dev/null
+		if [ $res -ne 0 ]; then
+			unset "INSTALLED_JSON[${PEER},${ORG}]"
+			return 1
+		fi
 	fi
-	set -x
-	jq -er "$query" chaincodes.json
-	res=$?
-	set +x
-	return $res
+	PACKAGE_ID="$(jq -er --arg cc_label "$CC_LABEL" \
+		'first(.installed_chaincodes[]? | select(.label == $cc_label) | .package_id)' \
+		<<<"${INSTALLED_JSON[${PEER},${ORG}]}")" || return 1
+	echo "$PACKAGE_ID"
 }
 
 approveChaincode() {
@@ -281,8 +359,9 @@ approveChaincode() {
 	SEQ_NO=$6
 	shift 6
 
-	package_id="$(queryChaincodePackage "$PEER" "$ORG" "$CC_NAME" "$CC_VERSION")"
+	queryChaincodePackage "$PEER" "$ORG" "$CC_NAME" "$CC_VERSION" >/dev/null
 	verifyResult $? "queryChaincodePackage on peer${PEER}.org${ORG} has Failed"
+	package_id="$PACKAGE_ID"
 	echo package_id="$package_id"
 	echo
 
@@ -330,67 +409,36 @@ chaincodeApprovedForOrg() {
 	setGlobals $PEER $ORG &>/dev/null
 	msp="$CORE_PEER_LOCALMSPID"
 
-	echo "Checking chaincode approval for $MSP..."
+	echo "Checking chaincode approval for $msp..."
 	echo
-	checkChaincodeCommitReadiness \
+	local status
+	status="$(checkChaincodeCommitReadiness \
 		"$PEER" "$ORG" \
 		"$CHANNEL_NAME" \
 		"$CC_NAME" "$CC_VERSION" \
-		"$SEQ_NO" "$@" >status.json
-	res=$?
-	if [ $res -ne 0 ]; then
-		return 1
-	fi
+		"$SEQ_NO" "$@")" || return 1
 
-	set -x
-	jq -er ".approvals.${msp} == true" status.json
-	res=$?
-	set +x
-	return $res
+	jq -e --arg msp "$msp" '.approvals[$msp] == true' <<<"$status"
+}
+
+chaincodeCommitReady() {
+	local status
+	status="$(checkChaincodeCommitReadiness "$@")" || return 1
+	echo "$status" >&2
+	jq -e '.approvals | all' <<<"$status" >/dev/null
 }
 
 waitForChaincodeCommitReadiness() {
 	PEER=$1
 	ORG=$2
-	CHANNEL_NAME=$3
-	CC_NAME=$4
-	CC_VERSION=$5
-	SEQ_NO=$6
-	shift 6
-
-	DELAY=3
-	MAX_RETRY=5
 
 	echo "Waiting for chaincode commit readiness on peer${PEER}.org${ORG}..."
 	echo
 	setGlobals $PEER $ORG &>/dev/null
-	counter=0
-	while [ $counter -lt $MAX_RETRY ]; do
-		counter=$(expr $counter + 1)
-		sleep $DELAY
-		set -x
-		checkChaincodeCommitReadiness \
-			"$PEER" "$ORG" \
-			"$CHANNEL_NAME" \
-			"$CC_NAME" "$CC_VERSION" \
-			"$SEQ_NO" "$@" >status.json
-		res=$?
-		set +x
-		if [ $res -ne 0 ]; then
-			continue
-		fi
-		set -x
-		cat status.json | jq
-		jq -e '.approvals | all' status.json
-		res=$?
-		set +x
-		if [ $res -eq 0 ]; then
-			echo "===================== Chaincode commit readiness confirmed on peer${PEER}.org${ORG} ===================== "
-			echo
-			return
-		fi
-	done
-	verifyResult 1 "Chaincode commit readiness confirmation on peer${PEER}.org${ORG} has Failed"
+	waitUntil "commit readiness peer${PEER}.org${ORG}" chaincodeCommitReady "$@"
+	verifyResult $? "Chaincode commit readiness confirmation on peer${PEER}.org${ORG} has Failed"
+	echo "===================== Chaincode commit readiness confirmed on peer${PEER}.org${ORG} ===================== "
+	echo
 }
 
 checkChaincodeCommitReadiness() {
@@ -429,7 +477,7 @@ commitChaincode() {
 	echo
 	set -x
 	peer lifecycle chaincode commit \
-		$(peerArgsEachOrg) \
+		"${PEER_ARGS_EACH_ORG[@]}" \
 		--channelID "$CHANNEL_NAME" --tls --cafile "$ORDERER_CA" \
 		--orderer orderer0."$DOMAIN_NAME":7050 \
 		--collections-config /collections.json \
@@ -446,6 +494,12 @@ commitChaincode() {
 	echo
 }
 
+chaincodeVersionCommitted() {
+	local committed
+	committed="$(queryCommitted "$@")" || return 1
+	[ "$(jq -r '.version' <<<"$committed")" == "$5" ]
+}
+
 waitForCommittedVersion() {
 	PEER=$1
 	ORG=$2
@@ -453,34 +507,13 @@ waitForCommittedVersion() {
 	CC_NAME=$4
 	CC_VERSION=$5
 
-	DELAY=3
-	MAX_RETRY=5
-
 	echo "Waiting for chaincode version $CC_VERSION (for $CC_NAME) to be committed on peer${PEER}.org${ORG}..." >&2
 	echo >&2
-	counter=0
-	while [ $counter -lt $MAX_RETRY ]; do
-		counter=$(expr $counter + 1)
-		sleep $DELAY
-		queryCommitted "$PEER" "$ORG" "$CHANNEL_NAME" "$CC_NAME" "$CC_VERSION" >committed.json
-		res=$?
-		if [ $res -ne 0 ]; then
-			continue
-		fi
-		set -x
-		installed_ver="$(jq -er '.version' committed.json)"
-		res=$?
-		set +x
-		if [ $res -ne 0 ]; then
-			continue
-		fi
-		if [ "$installed_ver" == "$CC_VERSION" ]; then
-			echo "===================== Query chaincode definition successful on peer${PEER}.org${ORG} ===================== " >&2
-			echo >&2
-			return
-		fi
-	done
-	verifyResult 1 "Query chaincode definition failed on peer${PEER}.org${ORG} has Failed"
+	waitUntil "committed $CC_NAME:$CC_VERSION peer${PEER}.org${ORG}" \
+		chaincodeVersionCommitted "$PEER" "$ORG" "$CHANNEL_NAME" "$CC_NAME" "$CC_VERSION"
+	verifyResult $? "Query chaincode definition failed on peer${PEER}.org${ORG} has Failed"
+	echo "===================== Query chaincode definition successful on peer${PEER}.org${ORG} ===================== " >&2
+	echo >&2
 }
 
 nextSequenceNumber() {
@@ -488,25 +521,14 @@ nextSequenceNumber() {
 	CC_NAME=$2
 	CC_VERSION=$3
 
-	PEER="$(firstPeer)"
-	ORG="$(firstOrg)"
-
-	queryCommitted "$PEER" "$ORG" "$CHANNEL_NAME" "$CC_NAME" "$CC_VERSION" >committed.json
-	res=$?
-	if [ $res -ne 0 ]; then
-		echo 1
-		return
-	fi
-	set -x
-	seq_num="$(jq -er 'select(.version = "$CC_VERSION") | .sequence' committed.json)"
-	res=$?
-	set +x
-	if [ $res -ne 0 ]; then
+	local committed seq_num
+	if committed="$(queryCommitted "${PEER_INDICES[0]}" "${ORG_INDICES[0]}" \
+		"$CHANNEL_NAME" "$CC_NAME" "$CC_VERSION")" &&
+		seq_num="$(jq -er '.sequence' <<<"$committed")"; then
+		echo $((seq_num + 1))
+	else
 		echo 1
-		return
 	fi
-
-	echo $(($seq_num + 1))
 }
 
 queryCommitted() {
@@ -530,17 +552,16 @@ forEachOrg() {
 	local command=$1
 	shift
 	for orgIdx in "${ORG_INDICES[@]}"; do
-		"${command}" "$(firstPeer)" "${orgIdx}" "$@"
+		"${command}" "${PEER_INDICES[0]}" "${orgIdx}" "$@"
 	done
 }
 
 forEachPeer() {
 	local command=$1
 	shift
-	for orgIdx in "${ORG_INDICES[@]}"; do
-		for peerIdx in "${PEER_INDICES[@]}"; do
-			"${command}" "${peerIdx}" "${orgIdx}" "$@"
-		done
+	local pair
+	for pair in "${ORG_PEERS[@]}"; do
+		"${command}" "${pair#*:}" "${pair%%:*}" "$@"
 	done
 
 }
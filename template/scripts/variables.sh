@@ -3,4 +3,6 @@
 DOMAIN_NAME="luther.systems"
 ORG_INDICES=( 1 2 )
 PEER_INDICES=( 0 1 )
+# org:peer index pairs of every peer; orgs may differ in peer count
+ORG_PEERS=( 1:0 1:1 2:0 2:1 )
 ENDORSEMENT_POLICY="OR('Org1MSP.member', 'Org2MSP.member')"
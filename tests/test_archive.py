@@ -0,0 +1,127 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network import (  # noqa: E402
+    ARCHIVE_FORMATS,
+    ARCHIVE_MANIFEST,
+    apply_archive_delta,
+    archive_delta,
+    read_archive_manifest,
+    tree_manifest,
+    write_archive,
+)
+
+NAMES = ['crypto-config', 'configtx.yaml']
+
+
+def _tree(root):
+    os.makedirs(os.path.join(root, 'crypto-config', 'peerOrganizations', 'org1'))
+    with open(os.path.join(root, 'crypto-config', 'peerOrganizations', 'org1', 'ca.pem'),
+              'w') as f:
+        f.write('cert\n' * 1000)
+    with open(os.path.join(root, 'configtx.yaml'), 'w') as f:
+        f.write('Profiles: {}\n')
+    with open(os.path.join(root, 'ignored.txt'), 'w') as f:
+        f.write('not archived\n')
+
+
+class WriteArchiveTest(unittest.TestCase):
+    def _roundtrip(self, fmt, level=None):
+        with tempfile.TemporaryDirectory() as d:
+            _tree(os.path.join(d, 'src'))
+            path = os.path.join(d, 'out.tar')
+            write_archive(path, os.path.join(d, 'src'), NAMES, fmt, level)
+            if fmt == 'zstd':
+                # tarfile cannot read zstd itself
+                opened = tarfile.open(fileobj=io.BytesIO(
+                    subprocess.check_output(['zstd', '-dc', path])))
+            else:
+                opened = tarfile.open(path)
+            with opened as tar:
+                return {m.name: tar.extractfile(m).read() if m.isfile() else None
+                        for m in tar.getmembers()}
+
+    def test_formats_roundtrip(self):
+        for fmt, (command, _, _) in sorted(ARCHIVE_FORMATS.items()):
+            if command is not None and shutil.which(command[0]) is None:
+                continue
+            with self.subTest(fmt=fmt):
+                members = self._roundtrip(fmt)
+                self.assertEqual(members['crypto-config/peerOrganizations/org1/ca.pem'],
+                                 b'cert\n' * 1000)
+                self.assertEqual(members['configtx.yaml'], b'Profiles: {}\n')
+                self.assertNotIn('ignored.txt', members)
+
+    def test_bad_level_rejected_before_writing(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'out.tar.gz')
+            with self.assertRaises(SystemExit):
+                write_archive(path, d, [], 'gzip', 12)
+            self.assertFalse(os.path.exists(path))
+
+    def test_failure_removes_partial_archive(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'out.tar.gz')
+            with self.assertRaises(FileNotFoundError):
+                write_archive(path, d, ['missing'], 'gzip')
+            self.assertFalse(os.path.exists(path))
+
+
+def _write(root, rel, text):
+    path = os.path.join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class DeltaTest(unittest.TestCase):
+    def _delta(self, d, fmt='gzip'):
+        src, remote = os.path.join(d, 'src'), os.path.join(d, 'remote')
+        _tree(src)
+        full = os.path.join(d, 'full.tar')
+        write_archive(full, src, NAMES, fmt,
+                      manifest={'version': 1, 'files': tree_manifest(src, NAMES)})
+        os.makedirs(remote)
+        with tarfile.open(full) as tar:
+            tar.extractall(remote)
+        _write(src, 'crypto-config/peerOrganizations/org2/ca.pem', 'new org\n')
+        _write(src, 'configtx.yaml', 'Profiles: {changed: true}\n')
+        delta = archive_delta(read_archive_manifest(full), tree_manifest(src, NAMES))
+        path = os.path.join(d, 'delta.tar')
+        write_archive(path, src, delta['added'] + delta['changed'], fmt, manifest=delta)
+        return src, remote, path
+
+    def test_delta_holds_only_new_and_changed_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            src, remote, path = self._delta(d)
+            with tarfile.open(path) as tar:
+                names = tar.getnames()
+            self.assertEqual(names, [ARCHIVE_MANIFEST, 'crypto-config/peerOrganizations/org2/ca.pem',
+                                     'configtx.yaml'])
+            manifest = apply_archive_delta(path, remote)
+            self.assertEqual(manifest['removed'], [])
+            self.assertEqual(tree_manifest(remote, NAMES), tree_manifest(src, NAMES))
+            self.assertEqual(read_archive_manifest(os.path.join(remote, ARCHIVE_MANIFEST))['files'],
+                             tree_manifest(src, NAMES))
+
+    def test_apply_refuses_a_diverged_tree(self):
+        with tempfile.TemporaryDirectory() as d:
+            src, remote, path = self._delta(d)
+            _write(remote, 'configtx.yaml', 'edited remotely\n')
+            with self.assertRaises(SystemExit) as cm:
+                apply_archive_delta(path, remote)
+            self.assertIn('configtx.yaml', str(cm.exception))
+            self.assertFalse(os.path.exists(
+                os.path.join(remote, 'crypto-config/peerOrganizations/org2/ca.pem')))
+
+
+if __name__ == '__main__':
+    unittest.main()
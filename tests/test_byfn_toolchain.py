@@ -0,0 +1,98 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BYFN = os.path.join(REPO, 'byfn.sh')
+
+
+def _extract(*names):
+    '''Pull the named functions and variables out of byfn.sh.'''
+    lines = open(BYFN).read().splitlines()
+    out = []
+    for name in names:
+        if name.isupper():
+            out.append(next(l for l in lines if l.startswith(name + '=')))
+            continue
+        start = next(i for i, l in enumerate(lines) if l.startswith('function ' + name + '('))
+        end = next(i for i in range(start + 1, len(lines)) if lines[i] == '}')
+        out.extend(lines[start:end + 1])
+    return '\n'.join(out)
+
+
+FUNCS = _extract('BLACKLISTED_VERSIONS', 'TOOLCHAIN_CACHE_DIR',
+                 'toolchainKey', 'probeToolchain', 'checkPrereqs')
+
+FAKE_DOCKER = '''#!/bin/bash
+echo "$*" >>"$CALLS"
+case "$1" in
+image) cat "$IMAGE_ID" ;;
+run) echo " Version: $DOCKER_VERSION" ;;
+esac
+'''
+
+FAKE_CONFIGTXLATOR = '''#!/bin/bash
+echo "configtxlator $*" >>"$CALLS"
+echo " Version: $LOCAL_VERSION"
+'''
+
+
+class ToolchainCacheTest(unittest.TestCase):
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.dir = d.name
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        for name, body in (('docker', FAKE_DOCKER), ('configtxlator', FAKE_CONFIGTXLATOR)):
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as f:
+                f.write(body)
+            os.chmod(path, 0o755)
+        self.configtxlator = os.path.join(bin_dir, 'configtxlator')
+        self.image_id = os.path.join(self.dir, 'image-id')
+        self.calls = os.path.join(self.dir, 'calls')
+        self._set_image('sha256:aaa')
+        self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'],
+                        FNB_CACHE_DIR=os.path.join(self.dir, 'cache'), CALLS=self.calls,
+                        IMAGE_ID=self.image_id, IMAGENS='hyperledger', IMAGETAG='2.5',
+                        LOCAL_VERSION='v2.5.16', DOCKER_VERSION='v2.5.16')
+
+    def _set_image(self, image_id):
+        with open(self.image_id, 'w') as f:
+            f.write(image_id + '\n')
+
+    def _check(self, **env):
+        open(self.calls, 'w').close()
+        r = subprocess.run(['bash', '-c', FUNCS + '\ncheckPrereqs\n'],
+                           env=dict(self.env, **env), capture_output=True, text=True)
+        with open(self.calls) as f:
+            runs = [l for l in f.read().splitlines() if not l.startswith('image ')]
+        return r, runs
+
+    def test_probe_reused_until_binary_or_image_changes(self):
+        r, runs = self._check()
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(len(runs), 2)
+        r, runs = self._check()
+        self.assertIn('Using cached toolchain versions', r.stdout)
+        self.assertIn('DOCKER_IMAGE_VERSION=v2.5.16', r.stdout)
+        self.assertEqual(runs, [])
+        self._set_image('sha256:bbb')
+        r, runs = self._check()
+        self.assertEqual(len(runs), 2)
+        os.utime(self.configtxlator, (1, 1))
+        r, runs = self._check()
+        self.assertEqual(len(runs), 2)
+
+    def test_blacklist_still_applies_to_cached_versions(self):
+        self._check(LOCAL_VERSION='1.0.6')
+        r, runs = self._check(LOCAL_VERSION='v2.5.16')
+        self.assertEqual(runs, [])
+        self.assertEqual(r.returncode, 1)
+        self.assertIn('Local Fabric binary version of 1.0.6', r.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
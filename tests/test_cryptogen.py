@@ -0,0 +1,155 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import yaml
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network import (  # noqa: E402
+    discover_leaf_certs,
+    generate_crypto_material,
+    load_crypto_config,
+    resolve_ca,
+)
+
+
+def _config(path, org_count=2, peer_count=2, node_ous=False, orderer_count=1,
+            peer_sans=None):
+    peer_template = {'Count': peer_count}
+    if peer_sans:
+        peer_template['SANS'] = peer_sans
+    config = {
+        'OrdererOrgs': [{
+            'Name': 'Orderer', 'Domain': 'example.com', 'EnableNodeOUs': node_ous,
+            'Template': {'Count': orderer_count},
+        }],
+        'PeerOrgs': [{
+            'Name': 'Org{}'.format(i), 'Domain': 'org{}.example.com'.format(i),
+            'EnableNodeOUs': node_ous, 'Template': dict(peer_template),
+            'Users': {'Count': 1}, 'CA': {'Hostname': 'ca'},
+        } for i in range(1, org_count + 1)],
+    }
+    Path(path).write_text(yaml.safe_dump(config))
+    return path
+
+
+def _verify(cert, ca_cert):
+    ca_cert.public_key().verify(cert.signature, cert.tbs_certificate_bytes,
+                                ec.ECDSA(cert.signature_hash_algorithm))
+
+
+def _cert(path):
+    return x509.load_pem_x509_certificate(Path(path).read_bytes())
+
+
+class LoadConfigTest(unittest.TestCase):
+    def test_template_and_specs_expand_to_nodes(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = Path(d) / 'crypto-config.yaml'
+            path.write_text(yaml.safe_dump({'PeerOrgs': [{
+                'Name': 'Org1', 'Domain': 'org1.example.com',
+                'Specs': [{'Hostname': 'foo', 'SANS': ['10.0.0.1']}],
+                'Template': {'Count': 2, 'Start': 5,
+                             'SANS': ['{{.Hostname}}.alt.example.com']},
+            }]}))
+            org, = load_crypto_config(str(path))
+        names = [n['common_name'] for n in org['nodes']]
+        self.assertEqual(names, ['foo.org1.example.com', 'peer5.org1.example.com',
+                                 'peer6.org1.example.com'])
+        self.assertEqual(org['nodes'][0]['sans'], ['foo.org1.example.com', 'foo', '10.0.0.1'])
+        self.assertIn('peer5.alt.example.com', org['nodes'][1]['sans'])
+        self.assertEqual(org['users'], [])
+
+
+class GenerateTest(unittest.TestCase):
+    def test_cryptogen_layout(self):
+        with tempfile.TemporaryDirectory() as d:
+            out = Path(d) / 'crypto-config'
+            generate_crypto_material(_config(Path(d) / 'c.yaml'), str(out), workers=2)
+            org = out / 'peerOrganizations' / 'org1.example.com'
+            for rel in ('ca/ca.org1.example.com-cert.pem', 'ca/priv_sk',
+                        'tlsca/tlsca.org1.example.com-cert.pem', 'tlsca/priv_sk',
+                        'msp/cacerts/ca.org1.example.com-cert.pem',
+                        'msp/tlscacerts/tlsca.org1.example.com-cert.pem',
+                        'msp/admincerts/Admin@org1.example.com-cert.pem',
+                        'peers/peer1.org1.example.com/msp/signcerts/peer1.org1.example.com-cert.pem',
+                        'peers/peer1.org1.example.com/msp/keystore/priv_sk',
+                        'peers/peer1.org1.example.com/msp/admincerts/Admin@org1.example.com-cert.pem',
+                        'peers/peer1.org1.example.com/tls/ca.crt',
+                        'peers/peer1.org1.example.com/tls/server.crt',
+                        'peers/peer1.org1.example.com/tls/server.key',
+                        'users/Admin@org1.example.com/tls/client.crt',
+                        'users/User1@org1.example.com/msp/signcerts/User1@org1.example.com-cert.pem'):
+                self.assertTrue((org / rel).is_file(), rel)
+            orderer = out / 'ordererOrganizations' / 'example.com' / 'orderers' / 'orderer0.example.com'
+            self.assertTrue((orderer / 'tls' / 'server.crt').is_file())
+            self.assertFalse((out / 'peerOrganizations' / 'org3.example.com').exists())
+
+    def test_certs_chain_to_org_cas_with_sans(self):
+        with tempfile.TemporaryDirectory() as d:
+            out = Path(d) / 'crypto-config'
+            generate_crypto_material(
+                _config(Path(d) / 'c.yaml', peer_sans=['{{.Hostname}}.alt.example.com']),
+                str(out), workers=2)
+            org = out / 'peerOrganizations' / 'org2.example.com'
+            ca = _cert(org / 'ca' / 'ca.org2.example.com-cert.pem')
+            tlsca = _cert(org / 'tlsca' / 'tlsca.org2.example.com-cert.pem')
+            peer = org / 'peers' / 'peer0.org2.example.com'
+            sign = _cert(peer / 'msp' / 'signcerts' / 'peer0.org2.example.com-cert.pem')
+            tls = _cert(peer / 'tls' / 'server.crt')
+            _verify(sign, ca)
+            _verify(tls, tlsca)
+            self.assertEqual(sign.issuer, ca.subject)
+            sans = tls.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+            self.assertEqual(sans, ['peer0.org2.example.com', 'peer0',
+                                    'peer0.alt.example.com'])
+            aki = sign.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier)
+            ski = ca.extensions.get_extension_for_class(x509.SubjectKeyIdentifier)
+            self.assertEqual(aki.value.key_identifier, ski.value.digest)
+
+    def test_node_ous(self):
+        with tempfile.TemporaryDirectory() as d:
+            out = Path(d) / 'crypto-config'
+            generate_crypto_material(_config(Path(d) / 'c.yaml', node_ous=True), str(out))
+            org = out / 'peerOrganizations' / 'org1.example.com'
+            self.assertIn('OrganizationalUnitIdentifier: peer',
+                          (org / 'msp' / 'config.yaml').read_text())
+            self.assertEqual(list((org / 'msp' / 'admincerts').iterdir()), [])
+            sign = _cert(org / 'peers' / 'peer0.org1.example.com' / 'msp' / 'signcerts'
+                         / 'peer0.org1.example.com-cert.pem')
+            self.assertIn('OU=peer', sign.subject.rfc4514_string())
+
+    def test_extend_only_adds_new_material(self):
+        with tempfile.TemporaryDirectory() as d:
+            out = Path(d) / 'crypto-config'
+            generate_crypto_material(_config(Path(d) / 'c.yaml'), str(out), workers=1)
+            peer0 = (out / 'peerOrganizations' / 'org1.example.com' / 'peers'
+                     / 'peer0.org1.example.com' / 'tls' / 'server.crt')
+            before = peer0.read_bytes()
+            created = generate_crypto_material(
+                _config(Path(d) / 'c.yaml', org_count=3, peer_count=3), str(out), workers=2)
+            self.assertEqual(peer0.read_bytes(), before)
+            self.assertEqual(created['Org1'], 1)          # just peer2
+            self.assertEqual(created['Org3'], 5)          # admin, user, 3 peers
+            self.assertEqual(created['Orderer'], 0)
+
+    def test_generated_tree_supports_reissue(self):
+        with tempfile.TemporaryDirectory() as d:
+            out = Path(d) / 'crypto-config'
+            generate_crypto_material(_config(Path(d) / 'c.yaml'), str(out), workers=2)
+            entries = discover_leaf_certs(str(out), ['signcert', 'tls'])
+            # per peer org: 2 peers x (signcert, tls) + 2 user signcerts;
+            # orderer org: orderer0 x (signcert, tls) + admin signcert
+            self.assertEqual(len(entries), 2 * (2 * 2 + 2) + 3)
+            for e in entries:
+                resolve_ca(e['ca_dir'], e['cert'])
+
+
+if __name__ == '__main__':
+    unittest.main()
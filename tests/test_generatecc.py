@@ -1,13 +1,24 @@
+import argparse
+import hashlib
+import io
+import json
 import os
 import sys
+import tarfile
 import tempfile
 import unittest
+from unittest import mock
 
 import yaml
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from network import Network  # noqa: E402
+import network  # noqa: E402
+from network import (  # noqa: E402
+    CHAINCODE_PACKAGE_MTIME,
+    Network,
+    generate_chaincode_packages,
+)
 
 SUBSTRATE_DEFAULT = 'luthersystems/substrate:$CHAINCODE_VERSION'
 
@@ -74,7 +85,6 @@ class ImageOverrideTest(unittest.TestCase):
             self.assertFalse(os.path.exists(os.path.join(d, 'docker-compose-ccaas.yaml')))
 
     def test_image_override_requires_ccaas(self):
-        import argparse
         args = argparse.Namespace(
             ccaas=False, image_override=['a=foo:1'],
             cc_name='a', cc_version='v1', cc_variants='a', cc_path='/tmp/x')
@@ -83,5 +93,146 @@ class ImageOverrideTest(unittest.TestCase):
         self.assertIn('--image-override requires --ccaas', str(cm.exception))
 
 
+def _source_archive(path, code=b'vendored go source', mode='w', prefix=''):
+    with tarfile.open(path, mode) as tar:
+        for name, data in (('metadata.json', b'{}'), ('code.tar.gz', code)):
+            info = tarfile.TarInfo(prefix + name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _members(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        return {m.name: (m, tar.extractfile(m).read()) for m in tar.getmembers()}
+
+
+class PackageTest(unittest.TestCase):
+    def setUp(self):
+        cache = tempfile.TemporaryDirectory()
+        self.addCleanup(cache.cleanup)
+        env = mock.patch.dict(os.environ, {'FNB_CACHE_DIR': cache.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_packages_are_reproducible_with_package_ids(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            _source_archive(src)
+            first = generate_chaincode_packages(src, ['a', 'b'], 'v1', cache=False)
+            with open(first['a'][0], 'rb') as f:
+                package = f.read()
+            with open(os.path.join(d, 'a-v1.id')) as f:
+                self.assertEqual(f.read(), first['a'][1] + '\n')
+            again = generate_chaincode_packages(src, ['a', 'b'], 'v1', cache=False)
+            with open(again['a'][0], 'rb') as f:
+                self.assertEqual(f.read(), package)
+        self.assertEqual(first, again)
+        self.assertEqual(first['a'][1], 'a-v1:' + hashlib.sha256(package).hexdigest())
+        self.assertNotEqual(first['a'][1].split(':')[1], first['b'][1].split(':')[1])
+        members = _members(package)
+        self.assertEqual(list(members), ['metadata.json', 'code.tar.gz'])
+        self.assertEqual(json.loads(members['metadata.json'][1]),
+                         {'path': 'main', 'type': 'golang', 'label': 'a-v1'})
+        self.assertEqual(members['code.tar.gz'][1], b'vendored go source')
+        self.assertEqual(members['code.tar.gz'][0].mtime, CHAINCODE_PACKAGE_MTIME)
+
+    def test_ccaas_package_carries_connection_json(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            (path, _, _), = generate_chaincode_packages(src, ['ext'], 'v2', ccaas=True).values()
+            with open(path, 'rb') as f:
+                members = _members(f.read())
+        self.assertEqual(json.loads(members['metadata.json'][1])['type'], 'ccaas')
+        code = _members(members['code.tar.gz'][1])
+        self.assertEqual(json.loads(code['connection.json'][1])['address'],
+                         'ext-peer{{.index}}:8080')
+
+    def test_compressed_source_streamed_in_chunks(self):
+        code = os.urandom(10000)
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            _source_archive(src, code, mode='w:gz')
+            with mock.patch.object(network, '_PACKAGE_CHUNK', 4096):
+                packages = generate_chaincode_packages(src, ['a', 'b'], 'v1')
+            for name, (path, package_id, _) in packages.items():
+                with open(path, 'rb') as f:
+                    package = f.read()
+                self.assertEqual(package_id.split(':')[1], hashlib.sha256(package).hexdigest())
+                self.assertEqual(_members(package)['code.tar.gz'][1], code)
+            self.assertEqual(sorted(os.listdir(d)),
+                             ['a-v1.id', 'a-v1.tar.gz', 'b-v1.id', 'b-v1.tar.gz', 'cc.car'])
+
+    def test_dot_prefixed_member_names_are_found(self):
+        # as written by `tar -czf cc.car .`
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            _source_archive(src, mode='w:gz', prefix='./')
+            (path, _, _), = generate_chaincode_packages(src, ['a'], 'v1').values()
+            with open(path, 'rb') as f:
+                members = _members(f.read())
+        self.assertEqual(members['code.tar.gz'][1], b'vendored go source')
+
+    def test_unchanged_inputs_reuse_cached_packages(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            _source_archive(src)
+            built = generate_chaincode_packages(src, ['a', 'b'], 'v1')
+            for name in ('a', 'b'):
+                os.unlink(built[name][0])
+            with mock.patch.object(network, '_PackageWriter') as writer:
+                cached = generate_chaincode_packages(src, ['a', 'b'], 'v1')
+            writer.assert_not_called()
+            with open(cached['a'][0], 'rb') as f:
+                self.assertEqual(built['a'][1].split(':')[1], hashlib.sha256(f.read()).hexdigest())
+            with open(os.path.join(d, 'b-v1.id')) as f:
+                self.assertEqual(f.read(), built['b'][1] + '\n')
+            _source_archive(src, b'changed source')
+            rebuilt = generate_chaincode_packages(src, ['a'], 'v2')
+            changed = generate_chaincode_packages(src, ['a', 'b'], 'v1')
+        self.assertEqual([p[2] for p in built.values()], [False, False])
+        self.assertEqual([p[2] for p in cached.values()], [True, True])
+        self.assertEqual(rebuilt['a'][2], False)
+        self.assertEqual([p[2] for p in changed.values()], [False, False])
+        self.assertNotEqual(changed['a'][1], built['a'][1])
+
+    def test_corrupted_cache_entry_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            _source_archive(src)
+            built = generate_chaincode_packages(src, ['a'], 'v1')
+            entry, = [os.path.join(root, f) for root, _, files in
+                      os.walk(os.environ['FNB_CACHE_DIR']) for f in files
+                      if f.endswith('.tar.gz')]
+            with open(entry, 'r+b') as f:
+                f.truncate(10)
+            os.unlink(built['a'][0])
+            rebuilt = generate_chaincode_packages(src, ['a'], 'v1')
+            with open(rebuilt['a'][0], 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with open(entry, 'rb') as f:
+                cached = hashlib.sha256(f.read()).hexdigest()
+        self.assertFalse(rebuilt['a'][2])
+        self.assertEqual(rebuilt['a'][1], built['a'][1])
+        self.assertEqual(digest, built['a'][1].split(':')[1])
+        self.assertEqual(cached, digest)
+
+    def test_ccaas_cache_keyed_without_source(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'missing.car')
+            generate_chaincode_packages(src, ['ext'], 'v1', ccaas=True)
+            (_, _, cached), = generate_chaincode_packages(src, ['ext'], 'v1',
+                                                          ccaas=True).values()
+        self.assertTrue(cached)
+
+    def test_source_without_code_archive_exits(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'cc.car')
+            with tarfile.open(src, 'w'):
+                pass
+            with self.assertRaises(SystemExit):
+                generate_chaincode_packages(src, ['a'], 'v1')
+            self.assertEqual(os.listdir(d), ['cc.car'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,257 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import network  # noqa: E402
+from network import (  # noqa: E402
+    FabricCLI,
+    LifecycleReport,
+    install_chaincodes,
+    load_script_vars,
+)
+
+SCRIPT_VARS = {'DOMAIN_NAME': 'example.com', 'ORG_INDICES': ['1', '2'],
+               'PEER_INDICES': ['0', '1'], 'ENDORSEMENT_POLICY': "OR('Org1MSP.member')"}
+
+
+class FakePeers(object):
+    '''
+    Stands in for `docker exec cli peer ...`, keeping installed packages per
+    peer, approvals per org and committed definitions per chaincode.
+    '''
+
+    def __init__(self, fail=(), flaky=None):
+        self.flaky = dict(flaky or {})
+        self.joined = set()
+        self.installed = {}
+        self.approved = {}
+        self.committed = {}
+        self.calls = []
+        self.fail = set(fail)
+        self._lock = threading.Lock()
+
+    def __call__(self, env, argv):
+        peer = env['CORE_PEER_ADDRESS'].split(':')[0]
+        msp = env['CORE_PEER_LOCALMSPID']
+        verb = argv[2] if argv[1] == 'channel' else argv[3]
+        opts = dict(zip(argv[4:], argv[5:]))
+        with self._lock:
+            self.calls.append((verb, peer))
+            if (verb, peer) in self.fail:
+                return 1, '', 'Error: failed {}\n'.format(verb)
+            if self.flaky.get((verb, peer)):
+                self.flaky[(verb, peer)] -= 1
+                return 1, '', 'Error: connection refused\n'
+            if verb == 'join':
+                if peer in self.joined:
+                    return 1, '', 'Error: LedgerID already exists\n'
+                self.joined.add(peer)
+                return 0, '', ''
+            if verb == 'update':
+                return 0, '', ''
+            if verb == 'queryinstalled':
+                pkgs = self.installed.get(peer, {})
+                return 0, json.dumps({'installed_chaincodes': [
+                    {'label': l, 'package_id': i} for l, i in pkgs.items()]}), ''
+            if verb == 'install':
+                label = os.path.basename(argv[4])[:-len('.tar.gz')]
+                self.installed.setdefault(peer, {})[label] = label + ':abc'
+                return 0, '', ''
+            name, seq = opts.get('--name'), opts.get('--sequence')
+            if verb == 'querycommitted':
+                if name not in self.committed:
+                    return 1, '', 'Error: namespace {} is not defined\n'.format(name)
+                return 0, json.dumps(self.committed[name]), ''
+            if verb == 'approveformyorg':
+                self.approved.setdefault((name, seq), set()).add(msp)
+                return 0, '', ''
+            if verb == 'checkcommitreadiness':
+                approved = self.approved.get((name, seq), set())
+                return 0, json.dumps({'approvals': {
+                    'Org1MSP': 'Org1MSP' in approved,
+                    'Org2MSP': 'Org2MSP' in approved}}), ''
+            if verb == 'commit':
+                self.committed[name] = {'sequence': int(seq), 'version': opts['--version']}
+                return 0, '', ''
+        raise AssertionError(argv)
+
+
+def _install(fake, names=('cc',), **kw):
+    cli = FabricCLI(SCRIPT_VARS, runner=fake)
+    report = LifecycleReport()
+    with contextlib.redirect_stdout(io.StringIO()), \
+            mock.patch.object(network.time, 'sleep'):
+        failed = install_chaincodes(cli, report, 'luther', list(names), 'v1',
+                                    '/chaincodes', **kw)
+    return not failed, report
+
+
+class FabricCLITest(unittest.TestCase):
+    def test_env_table_matches_set_globals(self):
+        cli = FabricCLI(SCRIPT_VARS, runner=FakePeers())
+        self.assertEqual(len(cli.env), 4)
+        env = cli.env[('1', '2')]
+        self.assertEqual(env['CORE_PEER_ADDRESS'], 'peer1.org2.example.com:7051')
+        self.assertEqual(env['CORE_PEER_LOCALMSPID'], 'Org2MSP')
+        self.assertEqual(env['CORE_PEER_MSPCONFIGPATH'],
+                         '/crypto-config/peerOrganizations/org2.example.com/users/'
+                         'Admin@org2.example.com/msp')
+        self.assertEqual(env['CORE_PEER_TLS_ROOTCERT_FILE'],
+                         '/crypto-config/peerOrganizations/org2.example.com/peers/'
+                         'peer1.org2.example.com/tls/ca.crt')
+
+    def test_load_script_vars(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'variables.sh')
+            with open(path, 'w') as f:
+                f.write('#!/usr/bin/env false\n\nDOMAIN_NAME="example.com"\n'
+                        'ORG_INDICES=( 1 2 3 )\nPEER_INDICES=( 0 1 )\n'
+                        'ENDORSEMENT_POLICY="OR(\'Org1MSP.member\',\'Org2MSP.member\')"\n')
+            found = load_script_vars(path)
+        self.assertEqual(found['ORG_INDICES'], ['1', '2', '3'])
+        self.assertEqual(found['ENDORSEMENT_POLICY'],
+                         "OR('Org1MSP.member','Org2MSP.member')")
+
+
+class WaitUntilTest(unittest.TestCase):
+    def test_backoff_returns_as_soon_as_ready(self):
+        answers = iter([False, False, True])
+        with mock.patch.object(network.time, 'sleep') as sleep:
+            ok, _ = network.wait_until(lambda: next(answers), initial=0.05)
+        self.assertTrue(ok)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.05, 0.1])
+
+    def test_gives_up_at_deadline(self):
+        with mock.patch.object(network.time, 'sleep'):
+            ok, _ = network.wait_until(lambda: False, deadline=0.01, initial=0.05)
+        self.assertFalse(ok)
+
+
+class JoinTest(unittest.TestCase):
+    def _join(self, fake, deadline=60.0):
+        cli = FabricCLI(SCRIPT_VARS, runner=fake)
+        report = LifecycleReport()
+        with contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch.object(network.time, 'sleep'):
+            ok = network.join_channel(cli, report, 'luther', 4, deadline)
+            if ok:
+                network.update_anchor_peers(cli, report, 'luther')
+        return ok, report
+
+    def test_flaky_peers_retry_independently(self):
+        fake = FakePeers(flaky={('join', 'peer1.org2.example.com'): 3})
+        fake.joined.add('peer0.org1.example.com')
+        ok, report = self._join(fake)
+        self.assertTrue(ok)
+        self.assertEqual(len(fake.joined), 4)
+        details = {r['target']: r['detail'] for r in report.results}
+        self.assertEqual(details['peer1.org2.example.com'], 'joined after 4 attempt(s)')
+        self.assertEqual(details['peer0.org1.example.com'], 'already joined')
+        self.assertEqual([v for v, _ in fake.calls].count('update'), 2)
+
+    def test_failures_aggregated_without_stopping_other_joins(self):
+        fake = FakePeers(fail={('join', 'peer0.org1.example.com'),
+                               ('join', 'peer1.org2.example.com')})
+        ok, report = self._join(fake, deadline=0)
+        self.assertFalse(ok)
+        self.assertEqual(sorted(r['target'] for r in report.failures()),
+                         ['peer0.org1.example.com', 'peer1.org2.example.com'])
+        self.assertEqual(fake.joined, {'peer1.org1.example.com', 'peer0.org2.example.com'})
+        self.assertNotIn('update', [v for v, _ in fake.calls])
+
+
+class InstallTest(unittest.TestCase):
+    def test_installs_everywhere_then_approves_and_commits_once(self):
+        fake = FakePeers()
+        ok, report = _install(fake)
+        self.assertTrue(ok)
+        self.assertEqual(len(fake.installed), 4)
+        self.assertEqual(fake.approved[('cc', '1')], {'Org1MSP', 'Org2MSP'})
+        self.assertEqual(fake.committed['cc'], {'sequence': 1, 'version': 'v1'})
+        self.assertEqual([v for v, _ in fake.calls].count('commit'), 1)
+        steps = [r['step'] for r in report.results]
+        self.assertEqual(steps.count('install'), 4)
+        self.assertEqual(steps.count('approve'), 2)
+        self.assertIn('install', report.summary())
+
+    def test_existing_install_skipped_and_sequence_bumped(self):
+        fake = FakePeers()
+        fake.installed['peer0.org1.example.com'] = {'cc-v1': 'cc-v1:abc'}
+        fake.committed['cc'] = {'sequence': 3, 'version': 'v0'}
+        ok, _ = _install(fake)
+        self.assertTrue(ok)
+        self.assertNotIn(('install', 'peer0.org1.example.com'), fake.calls)
+        self.assertEqual(fake.committed['cc'], {'sequence': 4, 'version': 'v1'})
+
+    def test_installed_queries_reused_across_phases(self):
+        fake = FakePeers()
+        for peer in ('peer0.org1', 'peer1.org1', 'peer0.org2', 'peer1.org2'):
+            fake.installed[peer + '.example.com'] = {'cc-v1': 'cc-v1:abc'}
+        ok, _ = _install(fake)
+        self.assertTrue(ok)
+        self.assertEqual([v for v, _ in fake.calls].count('queryinstalled'), 4)
+
+    def test_peer_failures_are_collected_before_stopping(self):
+        fake = FakePeers(fail={('install', 'peer1.org1.example.com'),
+                               ('install', 'peer0.org2.example.com')})
+        ok, report = _install(fake, parallelism=2)
+        self.assertFalse(ok)
+        self.assertEqual(len(report.failures()), 2)
+        self.assertEqual(len(fake.installed), 2)
+        self.assertFalse(fake.approved)
+
+    def test_deployed_version_costs_one_query_round(self):
+        fake = FakePeers()
+        ok, _ = _install(fake)
+        fake.calls.clear()
+        ok, report = _install(fake)
+        self.assertTrue(ok)
+        self.assertEqual(sorted(v for v, _ in fake.calls),
+                         ['querycommitted'] + ['queryinstalled'] * 4)
+        self.assertEqual({r['step'] for r in report.results}, {'snapshot'})
+
+    def test_plan_skips_orgs_that_already_approved(self):
+        fake = FakePeers()
+        fake.approved[('cc', '1')] = {'Org1MSP'}
+        ok, report = _install(fake)
+        self.assertTrue(ok)
+        approves = [r['target'] for r in report.results if r['step'] == 'approve']
+        self.assertEqual(approves, ['cc Org2MSP'])
+        self.assertEqual([v for v, _ in fake.calls].count('approveformyorg'), 1)
+
+    def test_pipeline_runs_each_phase_for_all_chaincodes_first(self):
+        fake = FakePeers()
+        ok, report = _install(fake, names=('a', 'b'))
+        self.assertTrue(ok)
+        self.assertEqual(set(fake.committed), {'a', 'b'})
+        steps = [r['step'] for r in report.results]
+        last_install = max(i for i, st in enumerate(steps) if st == 'install')
+        self.assertLess(last_install, steps.index('approve'))
+        self.assertEqual(steps.count('install'), 8)
+
+    def test_failed_chaincode_does_not_block_the_others(self):
+        fake = FakePeers(fail={('install', 'peer1.org2.example.com')})
+        fake.installed['peer1.org2.example.com'] = {'b-v1': 'b-v1:abc'}
+        cli = FabricCLI(SCRIPT_VARS, runner=fake)
+        report = LifecycleReport()
+        with contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch.object(network.time, 'sleep'):
+            failed = install_chaincodes(cli, report, 'luther', ['a', 'b'], 'v1', '/chaincodes')
+        self.assertEqual(failed, {'a': 'install'})
+        self.assertEqual(set(fake.committed), {'b'})
+        summary = report.group_summary().splitlines()
+        self.assertIn('FAILED at install', summary[0])
+        self.assertTrue(summary[1].startswith('b '))
+        self.assertIn(' ok ', summary[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS = os.path.join(REPO, 'template', 'scripts', 'luther_utils.sh')
+
+
+def _extract(*names):
+    '''Pull the named functions out of luther_utils.sh.'''
+    lines = open(UTILS).read().splitlines()
+    out = []
+    for name in names:
+        start = lines.index(name + '() {')
+        end = next(i for i in range(start + 1, len(lines)) if lines[i] == '}')
+        out.extend(lines[start:end + 1])
+    return '\n'.join(out)
+
+
+FUNCS = _extract('createChannelOnce', 'fetchChannelBlock')
+
+FAKE_PEER = '''#!/bin/bash
+echo "$*" >>"$CALLS"
+case "$2" in
+create) echo "$CREATE_OUTPUT"; exit $CREATE_STATUS ;;
+fetch) echo "Received block: 0" ;;
+esac
+'''
+
+
+class CreateChannelTest(unittest.TestCase):
+    def _run(self, output, status):
+        with tempfile.TemporaryDirectory() as tmp:
+            bindir = os.path.join(tmp, 'bin')
+            os.mkdir(bindir)
+            peer = os.path.join(bindir, 'peer')
+            with open(peer, 'w') as f:
+                f.write(FAKE_PEER)
+            os.chmod(peer, 0o755)
+            calls = os.path.join(tmp, 'calls')
+            env = dict(os.environ, PATH=bindir + os.pathsep + os.environ['PATH'],
+                       CALLS=calls, CREATE_OUTPUT=output, CREATE_STATUS=str(status),
+                       DOMAIN_NAME='example.com', CHANNEL_NAME='luther')
+            proc = subprocess.run(['bash', '-c', FUNCS + '\ncreateChannelOnce 2>/dev/null'],
+                                  cwd=tmp, env=env)
+            with open(calls) as f:
+                return proc.returncode, [l.split()[1] for l in f]
+
+    def test_existing_channel_fetches_genesis_block(self):
+        out = ('Error: got unexpected status: BAD_REQUEST -- error applying config '
+               "update to existing channel 'luther'")
+        self.assertEqual(self._run(out, 1), (0, ['create', 'fetch']))
+
+    def test_other_failures_are_not_masked(self):
+        out = 'Error: failed to create deliver client: connection refused'
+        self.assertEqual(self._run(out, 1), (1, ['create']))
+
+    def test_success_does_not_fetch(self):
+        self.assertEqual(self._run('', 0), (0, ['create']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network import (  # noqa: E402
+    CertMetrics,
+    OPENMETRICS_CONTENT_TYPE,
+    generate_crypto_material,
+    render_cert_metrics,
+    scan_crypto_config,
+)
+
+
+def _tree(d):
+    config = Path(d) / 'crypto-config.yaml'
+    config.write_text(yaml.safe_dump({
+        'OrdererOrgs': [{'Name': 'Orderer', 'Domain': 'example.com',
+                         'Template': {'Count': 1}}],
+        'PeerOrgs': [{'Name': 'Org1', 'Domain': 'org1.example.com',
+                      'Template': {'Count': 2}, 'Users': {'Count': 1}}],
+    }))
+    out = Path(d) / 'crypto-config'
+    generate_crypto_material(str(config), str(out), workers=1)
+    return out
+
+
+class RenderTest(unittest.TestCase):
+    def test_gauges_per_leaf_and_ca(self):
+        with tempfile.TemporaryDirectory() as d:
+            index = scan_crypto_config(_tree(d))
+            body = render_cert_metrics(index, datetime.now(timezone.utc))
+        lines = body.splitlines()
+        self.assertEqual(lines[-1], '# EOF')
+        samples = [l for l in lines if l.startswith('fabric_cert_not_after_seconds{')]
+        # peers 2x2 + users (Admin, User1) 2x1 + orderer 2 + orderer admin 1,
+        # plus ca and tlsca for both orgs
+        self.assertEqual(len(samples), 4 + 2 + 2 + 1 + 4)
+        self.assertTrue(any(l.startswith(
+            'fabric_cert_not_after_seconds{org="org1.example.com",'
+            'node="peer0.org1.example.com",kind="tls"} ') for l in samples))
+        self.assertIn('fabric_cert_not_after_seconds{org="example.com",node="",kind="tlsca"}',
+                      body)
+        self.assertEqual(len(set(l.rsplit(' ', 1)[0] for l in samples)), len(samples))
+
+
+class ExporterTest(unittest.TestCase):
+    def test_poll_reuses_index_and_serves_metrics(self):
+        with tempfile.TemporaryDirectory() as d:
+            exporter = CertMetrics(str(_tree(d)))
+            exporter.refresh()
+            self.assertEqual(exporter.refresh().parsed, 0)
+            server = exporter.serve('127.0.0.1', 0, 3600)
+            try:
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+                with urllib.request.urlopen(url) as resp:
+                    self.assertEqual(resp.headers['Content-Type'], OPENMETRICS_CONTENT_TYPE)
+                    self.assertEqual(resp.read().decode(), exporter.body)
+            finally:
+                exporter.stop()
+                server.shutdown()
+                server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
 import argparse
+import contextlib
+import csv
+import io
+import json
 import os
 import sys
 import tempfile
 import unittest
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from unittest import mock
 
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
@@ -13,11 +18,15 @@ from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import network  # noqa: E402
 from network import (  # noqa: E402
+    CAResolver,
     Network,
     build_reissued_cert,
+    cert_expiries,
     discover_leaf_certs,
     resolve_ca,
+    scan_crypto_config,
     _backup_path,
 )
 
@@ -176,7 +185,8 @@ def _build_tree(root, *, ca_not_after=None, peer1_not_after=None,
 def _ns(crypto_config, **over):
     base = dict(crypto_config=str(crypto_config), type='both', node=[],
                 all_expired=False, all=False, days=None, dry_run=False,
-                no_backup=False)
+                no_backup=False, jobs=None, format='text',
+                expiring_within=None)
     base.update(over)
     return argparse.Namespace(**base)
 
@@ -234,6 +244,174 @@ class DiscoveryTest(unittest.TestCase):
             self.assertEqual({e['kind'] for e in entries}, {'signcert'})
 
 
+class ScanTest(unittest.TestCase):
+    def test_each_distinct_cert_parsed_once(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            cacerts = root / 'peerOrganizations' / 'org1.example.com' / 'msp' / 'cacerts'
+            ca = next((cacerts.parent.parent / 'ca').glob('*.pem'))
+            _write(cacerts / ca.name, ca.read_bytes())
+            real = x509.load_pem_x509_certificate
+            with mock.patch.object(network.x509, 'load_pem_x509_certificate',
+                                   side_effect=real) as load:
+                index = scan_crypto_config(root, workers=4)
+            self.assertEqual(load.call_count, len(index.records))
+            self.assertEqual(index.parsed, len(index.records))
+            self.assertEqual(len(index.files), len(index.records) + 1)
+
+    def test_index_by_org_node_kind_and_issuer(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            info = _build_tree(root, second_org=True)
+            index = scan_crypto_config(root)
+            self.assertEqual({e['node'] for e in index.by_org['org2.example.com']},
+                             {'peer0.org2.example.com'})
+            self.assertEqual(sorted(e['kind'] for e in index.by_node['orderer0.example.com']),
+                             ['signcert', 'tls'])
+            tls = index.by_issuer[
+                info['orgs']['org1.example.com']['tlsca'].subject.rfc4514_string()]
+            self.assertEqual({e['kind'] for e in tls}, {'tls'})
+            self.assertEqual(len(tls), 4)
+            self.assertEqual(discover_leaf_certs(str(root), ['tls'], index=index),
+                             index.by_kind['tls'])
+
+    def test_cert_expiries_reports_shortest_copy(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            cacerts = root / 'peerOrganizations' / 'org1.example.com' / 'msp' / 'cacerts'
+            ca = next((cacerts.parent.parent / 'ca').glob('*.pem'))
+            _write(cacerts / ca.name, ca.read_bytes())
+            paths = [p for _, p in cert_expiries(str(root))]
+            self.assertIn(str(ca), paths)
+            self.assertNotIn(str(cacerts / ca.name), paths)
+            self.assertEqual(len(paths), len(set(paths)))
+
+    def test_non_certificate_pem_files_are_skipped(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            peer = root / 'peerOrganizations' / 'org1.example.com' / 'peers' / \
+                'peer1.org1.example.com'
+            key = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption())
+            _write(peer / 'msp' / 'signcerts' / 'a-key.pem', key)
+            _write(peer / 'tls' / 'key.pem', key)
+            _write(root / 'peerOrganizations' / 'org1.example.com' / 'ca' / 'key.pem', key)
+            for _ in range(2):  # parsed, then answered from the persistent index
+                index = scan_crypto_config(root)
+                self.assertNotIn(peer / 'tls' / 'key.pem', index.files)
+                signcert = next(e for e in index.by_node['peer1.org1.example.com']
+                                if e['kind'] == 'signcert')
+                self.assertTrue(signcert['cert_path'].name.endswith('-cert.pem'))
+            saved = json.loads(network.cert_index_path(root).read_text())['files']
+            self.assertEqual(
+                saved['peerOrganizations/org1.example.com/peers/peer1.org1.example.com'
+                      '/tls/key.pem']['error'], 'not a certificate')
+            _run(root, all_expired=True, no_backup=True)
+            self.assertGreater(_entry(discover_leaf_certs(str(root), ['signcert']),
+                                      'peer1', 'signcert')['expiry'], datetime.now(UTC))
+
+
+class CertIndexCacheTest(unittest.TestCase):
+    def test_steady_state_scan_parses_nothing(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            first = scan_crypto_config(root)
+            self.assertTrue(network.cert_index_path(root).is_file())
+            with mock.patch.object(network, '_read_digest') as read:
+                second = scan_crypto_config(root)
+            read.assert_not_called()
+            self.assertEqual(second.parsed, 0)
+            self.assertEqual(first.expiries(), second.expiries())
+            self.assertEqual(first.records, second.records)
+            peer = second.by_node['peer0.org1.example.com'][0]
+            self.assertEqual(peer['cert'].subject.rfc4514_string(),
+                             second.records[second.files[peer['cert_path']]]['subject'])
+
+    def test_only_changed_files_reparsed(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            scan_crypto_config(root)
+            _run(root, all_expired=True, type='tls', no_backup=True)
+            index = scan_crypto_config(root)
+            self.assertEqual(index.parsed, 1)
+            tls = next(e for e in index.by_node['peer1.org1.example.com']
+                       if e['kind'] == 'tls')
+            self.assertGreater(tls['expiry'], datetime.now(UTC))
+
+    def test_record_fields(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            info = _build_tree(root)
+            index = scan_crypto_config(root, cache=False)
+            self.assertFalse(network.cert_index_path(root).exists())
+            e = index.by_node['peer0.org1.example.com'][0]
+            rec = index.records[index.files[e['cert_path']]]
+            ca = info['orgs']['org1.example.com']['ca']
+            self.assertEqual(rec['issuer'], ca.subject.rfc4514_string())
+            self.assertEqual(rec['not_after'], int(e['expiry'].timestamp()))
+            self.assertEqual(len(rec['sha256']), 64)
+            self.assertIn('ski', rec)
+            self.assertIn('aki', rec)
+
+
+class RecordFormatTest(unittest.TestCase):
+    def _expiries(self, root, **over):
+        ns = argparse.Namespace(crypto_config=str(root), format='text',
+                                expiring_within=None)
+        vars(ns).update(over)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            object.__new__(Network).cert_expiries(ns)
+        return out.getvalue()
+
+    def test_ndjson_records_match_text_output(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            records = [json.loads(l) for l in
+                       self._expiries(root, format='ndjson').splitlines()]
+            text = [l.split('\t') for l in self._expiries(root).splitlines()]
+        self.assertEqual(sorted([r['expiry'], r['path']] for r in records), text)
+        peer1 = next(r for r in records if r['node'] == 'peer1.org1.example.com'
+                     and r['kind'] == 'tls')
+        self.assertEqual(peer1['org'], 'org1.example.com')
+        self.assertEqual(peer1['issuer'], 'CN=tlsca.org1.example.com')
+        self.assertLess(peer1['days_remaining'], 0)
+        ca = next(r for r in records if r['path'].endswith('/ca/ca.org1.example.com-cert.pem'))
+        self.assertEqual((ca['kind'], ca['node']), ('ca', None))
+
+    def test_expiring_within_filters_during_scan(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            rows = list(csv.DictReader(io.StringIO(
+                self._expiries(root, format='csv', expiring_within=30))))
+        self.assertEqual(sorted((r['node'], r['kind']) for r in rows),
+                         [('peer1.org1.example.com', 'signcert'),
+                          ('peer1.org1.example.com', 'tls')])
+
+    def test_reissue_json_reports_outcomes(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                _run(root, all_expired=True, format='json')
+        records = json.loads(out.getvalue())
+        self.assertEqual(len(records), 10)   # 5 identities x (signcert, tls)
+        done = [r for r in records if r['result'] == 'reissued']
+        self.assertEqual({r['node'] for r in done}, {'peer1.org1.example.com'})
+        self.assertTrue(all(r['selected'] and r['new_expiry'] for r in done))
+        self.assertFalse(any(r['selected'] for r in records if r not in done))
+
+
 class BuildReissuedTest(unittest.TestCase):
     def test_preserves_identity_chains_and_honors_validity(self):
         with tempfile.TemporaryDirectory() as d:
@@ -563,6 +741,53 @@ class ReissueCommandTest(unittest.TestCase):
             self.assertNotEqual(good_before, self._bytes(good))  # healthy org reissued
             self.assertEqual(bad_before, self._bytes(bad))       # broken org untouched
 
+    def test_each_ca_dir_loaded_once(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            entries = discover_leaf_certs(str(root), ['signcert', 'tls'])
+            resolver = CAResolver()
+            with mock.patch.object(resolver, '_load_dir',
+                                   wraps=resolver._load_dir) as load:
+                for e in entries:
+                    resolver.resolve(e['ca_dir'], e['cert'])
+            self.assertGreater(len(entries), 4)
+            self.assertEqual(len(resolver._dirs), 4)   # ca + tlsca for two orgs
+            self.assertEqual(load.call_count, len(entries))
+            self.assertEqual(len({str(c.args[0]) for c in load.call_args_list}), 4)
+
+    def test_failed_write_leaves_every_cert_untouched(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            paths = self._snapshot(root)
+            before = {k: self._bytes(p) for k, p in paths.items()}
+            real = network._stage_file
+            calls = []
+
+            def flaky(path, data):
+                calls.append(path)
+                if len(calls) == 3:
+                    raise OSError('disk full')
+                return real(path, data)
+
+            with mock.patch.object(network, '_stage_file', flaky):
+                with self.assertRaises(OSError):
+                    _run(root, all=True)
+            self.assertEqual(before, {k: self._bytes(p) for k, p in paths.items()})
+            self.assertEqual(_glob_baks(root), [])
+            leftovers = [p for p in root.rglob('.*') if p.is_file()]
+            self.assertEqual(leftovers, [])
+
+    def test_replaced_cert_keeps_mode(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d) / 'crypto-config'
+            _build_tree(root)
+            sc = self._snapshot(root)[('peer1.org1.example.com', 'signcert')]
+            os.chmod(sc, 0o640)
+            _run(root, all_expired=True, jobs=2)
+            self.assertEqual(os.stat(sc).st_mode & 0o777, 0o640)
+
 
 class BackupPathTest(unittest.TestCase):
     def test_unique_non_clobbering_backups(self):
@@ -0,0 +1,491 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import network  # noqa: E402
+from network import Network  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _gen_args(**over):
+    base = dict(cc_name='com_luthersystems_chaincode_substrate01',
+                domain_name='example.com', connect_domain_name=None,
+                enable_node_ous=False, org_count=2, peer_count=2,
+                min_endorsers=0, private_structure='shared',
+                req_peer_count=-1, max_peer_count=-1, execute_timeout=30,
+                orderer_type='etcdraft', orderer_count=1, template=True,
+                archive_path=None, orderer_san_domains=None,
+                peer_san_domains=None)
+    base.update(over)
+    return argparse.Namespace(**base)
+
+
+def _make_net(dest):
+    n = Network()
+    n.template_base_path = os.path.join(REPO, 'template')
+    n.destination_path = dest
+    return n
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self._cache = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(os.environ, {'FNB_CACHE_DIR': self._cache.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._cache.cleanup)
+        network._template_envs.clear()
+        self.addCleanup(network._template_envs.clear)
+
+    def _render(self, d, **over):
+        _make_net(d)._render_template(_gen_args(**over))
+
+    def test_renders_every_template(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            for name in ('crypto-config.yaml', 'configtx.yaml', 'core.yaml',
+                         'docker-compose-cli.yaml', 'base/docker-compose-base.yaml',
+                         'scripts/variables.sh', 'collections.json'):
+                self.assertTrue(os.path.isfile(os.path.join(d, name)), name)
+
+    def test_shared_context_ports_render_in_every_file(self):
+        # the render context is built once; zipped port lists must survive
+        # being iterated by more than one template.
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d, org_count=3, orderer_count=2)
+            with open(os.path.join(d, 'docker-compose-e2e-template.yaml')) as f:
+                e2e = yaml.safe_load(f)
+            with open(os.path.join(d, 'base/docker-compose-base.yaml')) as f:
+                base = yaml.safe_load(f)
+        self.assertEqual(e2e['services']['ca.org3.example.com']['ports'], ['9054:7054'])
+        self.assertEqual(base['services']['orderer1.example.com']['ports'],
+                         ['8050:7050', '127.0.0.1:11001:8443'])
+
+    def test_environment_is_shared_and_bytecode_cached(self):
+        path = os.path.join(REPO, 'template')
+        env = network.template_env(path)
+        self.assertIs(env, network.template_env(path))
+        env.get_template('core.yaml.j2')
+        self.assertTrue(os.listdir(os.path.join(self._cache.name, 'jinja')))
+
+    def test_repeat_render_is_identical(self):
+        with tempfile.TemporaryDirectory() as a, tempfile.TemporaryDirectory() as b:
+            self._render(a)
+            network._template_envs.clear()  # second run loads from bytecode
+            self._render(b)
+            for name in ('configtx.yaml', 'docker-compose-cli.yaml'):
+                with open(os.path.join(a, name)) as fa, open(os.path.join(b, name)) as fb:
+                    self.assertEqual(fa.read(), fb.read(), name)
+
+
+class FileBatchTest(unittest.TestCase):
+    def test_generate_spawns_no_subprocesses(self):
+        with tempfile.TemporaryDirectory() as d:
+            n = _make_net(d)
+            n.chown = '{}:{}'.format(os.getuid(), os.getgid())
+            with mock.patch('subprocess.check_call') as cc, \
+                    mock.patch('subprocess.check_output') as co:
+                n._render_template(_gen_args())
+            cc.assert_not_called()
+            co.assert_not_called()
+
+    def test_scripts_executable_and_templates_not(self):
+        with tempfile.TemporaryDirectory() as d:
+            _make_net(d)._render_template(_gen_args())
+            self.assertTrue(os.access(os.path.join(d, 'scripts/install.sh'), os.X_OK))
+            self.assertFalse(os.access(os.path.join(d, 'configtx.yaml'), os.X_OK))
+
+    def test_copy_keeps_mode_of_existing_destination(self):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'src')
+            with open(src, 'w') as f:
+                f.write('new')
+            os.chmod(src, 0o755)
+            batch = network.FileBatch(d)
+            dst = batch.write('dst', 'old')
+            os.chmod(dst, 0o600)
+            batch.copy(src, 'dst')
+            with open(dst) as f:
+                self.assertEqual(f.read(), 'new')
+            self.assertEqual(os.stat(dst).st_mode & 0o777, 0o600)
+
+    def test_parse_chown(self):
+        self.assertEqual(network.parse_chown('1000:1001'), (1000, 1001))
+        self.assertEqual(network.parse_chown('1000'), (1000, -1))
+        self.assertEqual(network.parse_chown(':1001'), (-1, 1001))
+        self.assertEqual(network.parse_chown('root:'), (0, -1))
+
+    def test_chown_paths_recursive_counts_every_entry(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'a', 'b'))
+            with open(os.path.join(d, 'a', 'b', 'f'), 'w'):
+                pass
+            spec = '{}:{}'.format(os.getuid(), os.getgid())
+            self.assertEqual(network.chown_paths([os.path.join(d, 'a')], spec, recursive=True), 3)
+
+
+class IncrementalTest(unittest.TestCase):
+    def _render(self, d, incremental=False, **over):
+        n = _make_net(d)
+        n.incremental = incremental
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            n._render_template(_gen_args(**over))
+        return out.getvalue()
+
+    def _mtimes(self, d):
+        found = {}
+        for root, _, files in os.walk(d):
+            for f in files:
+                path = os.path.join(root, f)
+                if f != network.MANIFEST_NAME:
+                    found[os.path.relpath(path, d)] = os.stat(path).st_mtime_ns
+        return found
+
+    def test_unchanged_rerun_rewrites_nothing(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            before = self._mtimes(d)
+            out = self._render(d, incremental=True)
+            self.assertEqual(before, self._mtimes(d))
+            self.assertNotIn('rendering template', out)
+            self.assertIn('affected services: none', out)
+
+    def test_config_change_rewrites_only_affected_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            before = self._mtimes(d)
+            out = self._render(d, incremental=True, peer_count=3)
+            after = self._mtimes(d)
+            changed = {k for k in before if before[k] != after[k]}
+            self.assertIn('docker-compose-cli.yaml', changed)
+            self.assertIn('base/docker-compose-base.yaml', changed)
+            self.assertNotIn('core.yaml', changed)
+            self.assertNotIn('scripts/luther_utils.sh', changed)
+            affected = next(l for l in out.splitlines()
+                            if l.startswith('affected services:')).split()[2:]
+            self.assertIn('peer2.org1.example.com', affected)
+            self.assertIn('cli', affected)  # depends_on and variables.sh changed
+            self.assertNotIn('orderer0.example.com', affected)
+
+    def test_hand_edited_output_is_restored(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            path = os.path.join(d, 'configtx.yaml')
+            with open(path) as f:
+                original = f.read()
+            with open(path, 'w') as f:
+                f.write('edited')
+            self._render(d, incremental=True)
+            with open(path) as f:
+                self.assertEqual(f.read(), original)
+
+    def _generate(self, d, **over):
+        n = _make_net(d)
+        n.incremental = True
+        n._extend_crypto = mock.Mock()
+        n._generate_channel_artifacts = mock.Mock()
+        with mock.patch.object(network, 'render_e2e_compose'), \
+                contextlib.redirect_stdout(io.StringIO()):
+            n._generate(_gen_args(template=None, **over))
+        return n._extend_crypto.called, n._generate_channel_artifacts.called
+
+    def test_incremental_generate_regenerates_from_changed_inputs(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            os.mkdir(os.path.join(d, 'crypto-config'))
+            network.record_generated_inputs(d, network.GENERATED_INPUTS)
+            self.assertEqual(self._generate(d), (False, False))
+            self.assertEqual(self._generate(d, org_count=3), (True, True))
+            # the new inputs were recorded, so a rerun has nothing to do
+            self.assertEqual(self._generate(d, org_count=3), (False, False))
+            self.assertEqual(self._generate(d, org_count=3, orderer_type='solo'),
+                             (False, True))
+
+    def test_incremental_generate_without_record_uses_rendered_changes(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            os.mkdir(os.path.join(d, 'crypto-config'))
+            self.assertEqual(self._generate(d), (False, False))
+            self.assertEqual(self._generate(d, peer_count=3), (True, True))
+
+    def test_incremental_skips_existing_artifact_check(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            n = _make_net(d)
+            with self.assertRaises(Exception):
+                n._check_gen_dest()
+            n.incremental = True
+            n._check_gen_dest()
+
+
+class E2EComposeTest(unittest.TestCase):
+    setUp = RenderTest.setUp
+    _render = RenderTest._render
+
+    def test_ca_keys_substituted_in_one_pass(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d, org_count=3)
+            for i in range(1, 4):
+                ca = os.path.join(d, 'crypto-config', 'peerOrganizations',
+                                  'org{}.example.com'.format(i), 'ca')
+                os.makedirs(ca)
+                open(os.path.join(ca, 'ca.org{}.example.com-cert.pem'.format(i)), 'w').close()
+                open(os.path.join(ca, 'key{}_sk'.format(i)), 'w').close()
+            network.render_e2e_compose(d, 'example.com')
+            with open(os.path.join(d, 'docker-compose-e2e.yaml')) as f:
+                text = f.read()
+            self.assertEqual(os.listdir(os.path.join(d, 'crypto-config')), ['peerOrganizations'])
+        self.assertNotIn('_PRIVATE_KEY', text)
+        e2e = yaml.safe_load(text)
+        self.assertIn('/etc/hyperledger/fabric-ca-server-config/key3_sk',
+                      e2e['services']['ca.org3.example.com']['command'])
+
+    def test_missing_ca_key_exits(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            os.makedirs(os.path.join(d, 'crypto-config', 'peerOrganizations',
+                                     'org1.example.com', 'ca'))
+            with self.assertRaises(SystemExit) as cm:
+                network.render_e2e_compose(d, 'example.com')
+            self.assertFalse(os.path.exists(os.path.join(d, 'docker-compose-e2e.yaml')))
+        self.assertIn('org1.example.com', str(cm.exception))
+
+
+TOPOLOGY = """
+domain-name: example.net
+channel: perf
+orgs:
+  - name: Retail
+    peers: 3
+  - name: Audit
+    ca_port: 9954
+    peers:
+      - {}
+      - {port: 9951, bootstrap: 0, anchor: false}
+orderers: 2
+"""
+
+
+class TopologyTest(unittest.TestCase):
+    setUp = RenderTest.setUp
+
+    def _load(self, d, text=TOPOLOGY):
+        path = os.path.join(d, 'network.yaml')
+        with open(path, 'w') as f:
+            f.write(text)
+        return network.load_topology_config(path)
+
+    def _render(self, d, text=TOPOLOGY):
+        settings, spec = self._load(d, text)
+        self.assertEqual(settings.pop('channel'), 'perf')
+        over = dict(settings, topology=spec, org_count=len(spec['orgs']),
+                    peer_count=None, orderer_count=None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _make_net(d)._render_template(_gen_args(**over))
+
+    def _yaml(self, d, name):
+        with open(os.path.join(d, name)) as f:
+            return yaml.safe_load(f)
+
+    def test_heterogeneous_orgs_render_from_one_index(self):
+        with tempfile.TemporaryDirectory() as d:
+            self._render(d)
+            crypto = self._yaml(d, 'crypto-config.yaml')
+            base = self._yaml(d, 'base/docker-compose-base.yaml')['services']
+            e2e = self._yaml(d, 'docker-compose-e2e-template.yaml')['services']
+            configtx = self._yaml(d, 'configtx.yaml')
+            client = self._yaml(d, 'fabric-client.yaml')
+            script_vars = network.load_script_vars(os.path.join(d, 'scripts', 'variables.sh'))
+        self.assertEqual([(o['Name'], o['Template']['Count']) for o in crypto['PeerOrgs']],
+                         [('Retail', 3), ('Audit', 2)])
+        peers = sorted(k for k in base if k.startswith('peer'))
+        self.assertEqual(len(peers), 5)
+        self.assertIn('peer2.org1.example.net', peers)
+        self.assertNotIn('peer2.org2.example.net', peers)
+        self.assertIn('9951:7051', base['peer1.org2.example.net']['ports'])
+        self.assertIn('9954:7054', e2e['ca.org2.example.net']['ports'])
+        self.assertIn('8050:7050', base['orderer1.example.net']['ports'])
+        org2 = next(o for o in configtx['Organizations'] if o['Name'] == 'Org2MSP')
+        self.assertEqual(org2['AnchorPeers'], [{'Host': 'peer0.org2.example.net', 'Port': 7051}])
+        self.assertEqual(client['organizations']['org2']['peers'],
+                         ['peer0.org2.example.net', 'peer1.org2.example.net'])
+        self.assertEqual(script_vars['ORG_PEERS'], ['1:0', '1:1', '1:2', '2:0', '2:1'])
+        cli = network.FabricCLI(script_vars, runner=lambda env, argv: (0, '', ''))
+        self.assertEqual(len(cli.all_peers()), 5)
+        self.assertNotIn(('2', '2'), cli.env)
+
+    def test_flags_render_the_uniform_index(self):
+        index = network.build_network_index(network.topology_spec(2, 2, 1), 'example.com')
+        self.assertEqual([p['name'] for p in index['peers']],
+                         ['peer0.org1.example.com', 'peer1.org1.example.com',
+                          'peer0.org2.example.com', 'peer1.org2.example.com'])
+        self.assertEqual([(p['port'], p['events_port']) for p in index['peers']],
+                         [('7051', '7053'), ('8051', '8053'), ('9051', '9053'),
+                          ('10051', '10053')])
+        self.assertEqual([o['ca_port'] for o in index['orgs']], ['7054', '8054'])
+
+    def test_invalid_topologies_exit(self):
+        cases = {
+            'orgs: [{name: A}, {name: A}]': 'duplicate org name A',
+            'orgs: [{peers: [{}, {bootstrap: 2}]}]': 'bootstrap must be a peer index',
+            'orgs: [{peers: [{anchor: false}]}]': 'at least one peer must be an anchor',
+            'orgs: [{peers: 0}]': 'at least one node',
+            'orgs: [{peers: 2, couch: true}]': 'unknown key(s) couch',
+            'orgs: [{peers: [{port: 7300}, {events_port: 7300}]}]': 'host port collision: 7300',
+            'ports: {peer: 7000-7060}\norgs: [{}]': 'port ranges overlap: peer 7000-7060',
+            'ports: {peers: 8000-8999}\norgs: [{}]': 'unknown key(s) peers',
+            'org-count: 3\norgs: [{}]': 'unknown key(s) org_count',
+        }
+        with tempfile.TemporaryDirectory() as d:
+            for text, message in cases.items():
+                with self.subTest(text=text):
+                    with self.assertRaises(SystemExit) as cm:
+                        settings, spec = self._load(d, text)
+                        network.build_network_index(spec, 'example.com',
+                                                    ranges=network.port_ranges(spec['ports']))
+                    self.assertIn(message, str(cm.exception))
+
+    def test_count_flags_conflict_with_config(self):
+        with tempfile.TemporaryDirectory() as d:
+            settings, spec = self._load(d)
+            with self.assertRaises(SystemExit):
+                _make_net(d)._render_context(_gen_args(topology=spec, org_count=2,
+                                                       peer_count=4, orderer_count=None))
+
+
+class PortAllocatorTest(unittest.TestCase):
+    setUp = RenderTest.setUp
+
+    def test_large_topology_gets_distinct_ports(self):
+        index = network.build_network_index(network.topology_spec(12, 40, 5), 'example.com')
+        nodes = index['port_map']['nodes']
+        ports = [port for assigned in nodes.values() for port in assigned.values()]
+        self.assertEqual(len(ports), 5 * 2 + 12 + 12 * 40 * 4)
+        self.assertEqual(len(set(ports)), len(ports))
+        self.assertLess(max(ports), 65536)
+        peers = index['peers']
+        # preferred ports up to 65051/65053, then the peer range
+        self.assertEqual((peers[58]['port'], peers[58]['events_port']), ('65051', '65053'))
+        self.assertEqual((peers[59]['port'], peers[59]['events_port']), ('7100', '7101'))
+        ranges = network.PORT_RANGES
+        for peer in peers:
+            for key, kind in (('couchdb_port', 'couchdb'), ('operations_port', 'operations')):
+                self.assertTrue(ranges[kind][0] <= int(peer[key]) <= ranges[kind][1])
+
+    def test_overridden_range_replaces_preferred_ports(self):
+        ranges = network.port_ranges({'peer': '20000-20999'})
+        index = network.build_network_index(network.topology_spec(1, 2, 1), 'example.com',
+                                            ranges=ranges)
+        self.assertEqual([(p['port'], p['events_port']) for p in index['peers']],
+                         [('20000', '20001'), ('20002', '20003')])
+        self.assertEqual(index['orgs'][0]['ca_port'], '7054')
+
+    def test_allocation_steps_around_explicit_ports(self):
+        spec = {'orgs': [{'peers': [{'port': 8051}, {}]}], 'orderers': [{'port': 7051}, {}]}
+        index = network.build_network_index(spec, 'example.com')
+        # peer1's preferred 8051 is taken, so it falls back to the peer range
+        self.assertEqual([(p['port'], p['events_port']) for p in index['peers']],
+                         [('8051', '7053'), ('7100', '8053')])
+        self.assertEqual([o['host_port'] for o in index['orderers']], ['7051', '8050'])
+
+    def test_exhausted_range_exits(self):
+        ranges = network.port_ranges({'peer': '7100-7104'})
+        with self.assertRaises(SystemExit) as cm:
+            network.build_network_index(network.topology_spec(1, 3, 1), 'example.com',
+                                        ranges=ranges)
+        self.assertIn('peer port range 7100-7104 is exhausted at peer2.org1.example.com',
+                      str(cm.exception))
+
+    def test_port_map_written_and_ccaas_ports_avoid_it(self):
+        # peer1.org1 claims a-peer0's preferred port and the start of the ccaas range
+        spec = {'orgs': [{'peers': [{}, {'port': 9080, 'events_port': 9100}]}, {'peers': 2}],
+                'orderers': 1}
+        with tempfile.TemporaryDirectory() as d:
+            with contextlib.redirect_stdout(io.StringIO()):
+                _make_net(d)._render_template(_gen_args(topology=spec, peer_count=None,
+                                                        orderer_count=None))
+            with open(os.path.join(d, network.PORT_MAP_NAME)) as f:
+                port_map = json.load(f)
+            ccaas = network.allocate_ccaas_ports(d, ['a-peer0', 'b-peer0'])
+        self.assertEqual(port_map['ranges']['ccaas'], [9100, 9199])
+        self.assertEqual(port_map['nodes']['peer1.org1.example.com'],
+                         {'port': 9080, 'events_port': 9100, 'couchdb_port': 10001,
+                          'operations_port': 11002})
+        self.assertEqual(port_map['nodes']['peer1.org2.example.com'],
+                         {'port': 10051, 'events_port': 10053, 'couchdb_port': 10003,
+                          'operations_port': 11004})
+        self.assertEqual(ccaas, {'a-peer0': 9101, 'b-peer0': 9081})
+
+
+FAKE_CONFIGTXGEN = '''#!/bin/bash
+# write "<args>" to the path following the -output* flag
+while [ $# -gt 0 ]; do
+  case "$1" in
+  -asOrg) [ "$2" == "$FAIL_ORG" ] && { echo "Error: bad org $2" >&2; exit 1; } ;;
+  -output*) out=$2 ;;
+  esac
+  shift
+done
+echo "$FABRIC_CFG_PATH" >"$out"
+'''
+
+
+class ChannelArtifactsTest(unittest.TestCase):
+    def setUp(self):
+        tools = tempfile.TemporaryDirectory()
+        self.addCleanup(tools.cleanup)
+        path = os.path.join(tools.name, 'configtxgen')
+        with open(path, 'w') as f:
+            f.write(FAKE_CONFIGTXGEN)
+        os.chmod(path, 0o755)
+        patcher = mock.patch.dict(os.environ, {
+            'PATH': tools.name + os.pathsep + os.environ['PATH'], 'FAIL_ORG': ''})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _generate(self, d, org_count=3):
+        report = network.LifecycleReport()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = network.generate_channel_artifacts(d, 'luther', org_count, report, 4)
+        return ok, report
+
+    def test_artifacts_generated_concurrently_into_place(self):
+        with tempfile.TemporaryDirectory() as d:
+            ok, report = self._generate(d)
+            out = os.path.join(d, 'channel-artifacts')
+            names = sorted(os.listdir(out))
+            with open(os.path.join(out, 'Org3MSPanchors.tx')) as f:
+                cfg_path = f.read().strip()
+        self.assertTrue(ok)
+        self.assertEqual(names, ['Org1MSPanchors.tx', 'Org2MSPanchors.tx', 'Org3MSPanchors.tx',
+                                 'channel.tx', 'genesis.block'])
+        self.assertEqual(cfg_path, os.path.abspath(d))
+        self.assertEqual(len(report.results), 5)
+        self.assertIn('configtxgen', report.summary())
+
+    def test_failure_leaves_no_partial_artifacts(self):
+        os.environ['FAIL_ORG'] = 'Org2MSP'
+        with tempfile.TemporaryDirectory() as d:
+            ok, report = self._generate(d)
+            names = os.listdir(os.path.join(d, 'channel-artifacts'))
+        self.assertFalse(ok)
+        self.assertEqual(names, [])
+        failure, = report.failures()
+        self.assertEqual(failure['target'], 'Org2MSPanchors.tx')
+        self.assertEqual(failure['detail'], 'configtxgen: Error: bad org Org2MSP')
+
+
+if __name__ == '__main__':
+    unittest.main()